@@ -2,12 +2,25 @@
 
     All config settings are in config.py
     To run the server, just execute run.py
+    To run it with several processes, use gunicorn with wsgi.py (see gunicorn.conf.py)
 """
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from app.database import Database
 
 app = Flask(__name__)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+db = Database(app)
 
-from app import views
\ No newline at end of file
+
+def create_app(upgrade_database=True):
+    """Returns the app, ready for any WSGI server. Safe to call in every worker.
+
+        See setup_app in data.py for what gets set up. Also starts writing the log (see logs.py).
+    """
+    from app.data import setup_app
+    setup_app(app, upgrade_database)
+    logs.configure_logging()
+    return app
+
+
+from app import metrics, logs, views
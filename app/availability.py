@@ -0,0 +1,108 @@
+"""Answers /api/availability: which periods a subject can be tutored in for the logged in student, and by whom.
+
+    This is the same matching create_pairing does for /tutor-request, without saving anything,
+    so a page can show what's free while the student is still picking a subject.
+
+    Every answer depends only on the data DataVersion counts (calendars, subjects, user types
+    and pairings) and on the day, since there's no tutoring later today. So answers are cached
+    here per (student, subject) for as long as the version and day stay the same, the most
+    recently used AVAILABILITY_CACHE_SIZE of them. The same things make the ETag, so a client
+    that already has the answer gets a 304 after the one query that reads the version.
+"""
+import datetime
+import hashlib
+import threading
+from collections import OrderedDict
+from .matching import get_index, weekday_label
+from .schema import get_schema
+from config import AVAILABILITY_CACHE_SIZE, AVAILABILITY_TUTORS_PER_SLOT, display_tutor_name
+
+
+class AvailabilityCache(object):
+    """An LRU cache of answers, all thrown away when the DataVersion or the day changes."""
+
+    def __init__(self, size=AVAILABILITY_CACHE_SIZE):
+        self.size = size
+        self._key = None  # (version, day) the cached answers are for
+        self._cache = OrderedDict()  # (uid, subject) -> answer, least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, version, day, uid, subject):
+        with self._lock:
+            if self._key != (version, day):
+                return None
+            answer = self._cache.get((uid, subject))
+            if answer is not None:
+                self._cache.move_to_end((uid, subject))
+            return answer
+
+    def put(self, version, day, uid, subject, answer):
+        with self._lock:
+            if self._key != (version, day):
+                if self._key is not None and (version, day) < self._key:
+                    return  # worked out from older data than what's cached now
+                self._key = (version, day)
+                self._cache.clear()
+            self._cache[(uid, subject)] = answer
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._key = None
+            self._cache.clear()
+
+
+cache = AvailabilityCache()
+
+
+def find_subject(name):
+    """Returns the subject column for a display name or column name (i.e. "Algebra 1" or "Algebra1"), or None."""
+    column = (name or '').replace(" ", "")
+    if column in get_schema().subject_list:
+        return column
+    return None
+
+
+def make_etag(version, day, uid, subject):
+    """Returns the ETag of an answer, without working the answer out."""
+    key = '{0}:{1}:{2}:{3}'.format(version, day, uid, subject)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def get_availability(student, subject, version, today=None):
+    """Returns the answer for the student and subject column, from the cache if it can.
+
+        version is the current models.get_data_version(). The answer is
+        {"subject": column, "version": version, "slots": [{"slot": "M1", "day": "Monday", "period": "1st Period",
+        "display": "Monday 1st", "tutor_count": 2, "tutors": ["Aaron", ...]}, ...]} in schedule order,
+        with the least busy tutors first, at most AVAILABILITY_TUTORS_PER_SLOT of them. "tutors" is
+        left out when display_tutor_name is off.
+    """
+    today = today or datetime.date.today()
+    day = today.isoformat()
+    answer = cache.get(version, day, student.uid, subject)
+    if answer is not None:
+        return answer
+
+    index = get_index(version)
+    free_cal, available_cal = student.get_calendar_0(), student.get_calendar_1()
+    student_mask = index.calendar_mask(free_cal) if free_cal is not None else 0
+    if available_cal is not None:  # create_pairing makes one with every period open if it's missing
+        student_mask &= index.calendar_mask(available_cal)
+    student_mask &= ~index.day_mask(weekday_label(today))  # no tutoring later today
+
+    slot_labels = get_schema().slot_labels
+    slots = []
+    for slot, uids in index.match(subject, student_mask, exclude=student.uid).items():
+        label = slot_labels[slot]
+        entry = {'slot': slot, 'day': label.day, 'period': label.name, 'display': label.display,
+                 'tutor_count': len(uids)}
+        if display_tutor_name:
+            least_busy = sorted(uids, key=lambda uid: (index.business[uid], index.usernames[uid]))
+            entry['tutors'] = [index.usernames[uid] for uid in least_busy[:AVAILABILITY_TUTORS_PER_SLOT]]
+        slots.append(entry)
+
+    answer = {'subject': subject, 'version': version, 'slots': slots}
+    cache.put(version, day, student.uid, subject, answer)
+    return answer
@@ -0,0 +1,269 @@
+"""Matches every waiting student with a tutor at once, for admins (see the /batch-assign page).
+
+    When /tutor-request finds nobody free, the student is added to the waiting list as a
+    PendingRequest. Matching them one at a time, the way create_pairing does, gives each the
+    least busy tutor right now, which can use up the only tutor somebody further down the list
+    could have had. Here the whole list is solved together as a bipartite matching:
+
+    - each request can take one (tutor, period) pair where the tutor tutors the subject
+      and both are free and not booked. Every pair can only be taken once.
+    - requests are matched oldest first, with augmenting paths (Kuhn's algorithm), so an
+      earlier request can be moved to another tutor or period to make room for a later one.
+      Nobody matched is ever unmatched, and the result matches as many requests as possible.
+    - tutors can only take requests up to a limit of booked periods, which is raised one step
+      at a time until nothing more can be matched, so the new work goes to the least busy tutors.
+
+    Each request keeps at most BATCH_MAX_OPTIONS pairs, least busy tutors first and spread over
+    the periods, so thousands of requests solve in a few seconds.
+
+    Everything found is written (pairings, bookings, emails and the requests marked matched)
+    in one transaction.
+"""
+import datetime
+import logging
+import time
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from app import db
+from . import matching
+from .emailing import tutor_message, student_message
+from .data import book_sessions
+from .models import User, Calendar, PendingRequest, TutorWorkload, TutoringSession, StudentTutorPairings, \
+    get_data_version
+from .outbox import queue_many
+from .schema import get_schema
+from config import BATCH_MAX_OPTIONS
+
+logger = logging.getLogger(__name__)
+
+
+def add_pending_request(student, subject):
+    """Puts the student on the waiting list for subject (the column name). Commits.
+
+        A student who's already waiting has their request changed to the new subject,
+        keeping their place.
+    """
+    pending = PendingRequest.query.filter_by(student_id=student.uid, status='pending').first()
+    if pending is None:
+        db.session.add(PendingRequest(student.uid, subject))
+    else:
+        pending.subject = subject
+    db.session.commit()
+
+
+def fulfil_pending_request(student, subject):
+    """Marks the student's waiting request for subject as matched, because they've booked a tutor for it themselves.
+
+        Called by the tutor selection page, so the next batch doesn't book them a second tutor. Doesn't commit.
+    """
+    PendingRequest.query.filter_by(student_id=student.uid, subject=subject, status='pending') \
+        .update({'status': 'matched', 'matched': datetime.datetime.utcnow()}, synchronize_session=False)
+
+
+def already_booked(student_uids, today):
+    """Returns {(student uid, subject)} for every student with a session from today on, in one query."""
+    if not student_uids:
+        return set()
+    return set(db.session.query(TutoringSession.user_id, StudentTutorPairings.subject)
+               .join(StudentTutorPairings, TutoringSession.pairing_id == StudentTutorPairings.id)
+               .filter(TutoringSession.role == 'student', TutoringSession.date >= today,
+                       TutoringSession.user_id.in_(student_uids), StudentTutorPairings.active == 1)
+               .distinct().all())
+
+
+def count_pending():
+    """Returns {subject: number of students waiting}."""
+    return dict(db.session.query(PendingRequest.subject, db.func.count(PendingRequest.id))
+                .filter(PendingRequest.status == 'pending')
+                .group_by(PendingRequest.subject).all())
+
+
+def best_options(matches, business, limit=BATCH_MAX_OPTIONS):
+    """Returns up to limit (tutor uid, slot) pairs from MatchingIndex.match's {slot: [uid, ...]}.
+
+        Pairs are taken a period at a time, least busy tutor first, so the options cover
+        as many periods as possible.
+    """
+    ranked = [sorted(uids, key=lambda uid: (business.get(uid, 0), uid)) for uids in matches.values()]
+    slots = list(matches)
+    options = []
+    depth = 0
+    while len(options) < limit and any(depth < len(uids) for uids in ranked):
+        for (slot, uids) in zip(slots, ranked):
+            if depth < len(uids) and len(options) < limit:
+                options.append((uids[depth], slot))
+        depth += 1
+    return options
+
+
+class Assignment(object):
+    """Solves the matching. See the top of this file.
+
+        requests - [request id, ...] oldest first
+        options - {request id: [(tutor uid, slot), ...]} best first
+        load - {tutor uid: periods already booked}
+    """
+
+    def __init__(self, requests, options, load):
+        self.requests = requests
+        self.options = options
+        self.load = dict(load)
+        self.holder = {}  # (tutor uid, slot) -> request id
+        self.assigned = {}  # request id -> (tutor uid, slot)
+
+    def solve(self):
+        """Returns {request id: (tutor uid, slot)} for every request that could be matched."""
+        tutors = {uid for choices in self.options.values() for (uid, slot) in choices}
+        if not tutors:
+            return {}
+        for uid in tutors:
+            self.load.setdefault(uid, 0)
+
+        limit = min(self.load[uid] for uid in tutors) + 1
+        while True:
+            skipped = []  # loads of tutors passed over for being at the limit
+            seen = set()
+            for request in self.requests:
+                if request not in self.assigned and self.options.get(request):
+                    if self._augment(request, limit, skipped, seen):
+                        seen = set()
+            if not skipped or len(self.assigned) == len(self.requests):
+                return dict(self.assigned)
+            limit = min(skipped) + 1
+
+    def _augment(self, start, limit, skipped, seen):
+        """Looks for a chain of moves that frees a pair for start, and makes them. Returns True if it found one.
+
+            seen is the pairs already looked at. When a search fails, nothing it looked at can help
+            another search until something moves, so it's kept until one succeeds.
+        """
+        wants = {}  # request id -> the taken pair it's trying to move the holder out of
+        stack = [(start, iter(self.options[start]))]
+        while stack:
+            request, choices = stack[-1]
+            for pair in choices:
+                if pair in seen:
+                    continue
+                seen.add(pair)
+                holder = self.holder.get(pair)
+                if holder is None:
+                    if self.load[pair[0]] >= limit:
+                        skipped.append(self.load[pair[0]])
+                        continue
+                    self.load[pair[0]] += 1
+                    self._take(request, pair)
+                    for (earlier, _) in reversed(stack[:-1]):
+                        self._take(earlier, wants[earlier])
+                    return True
+                wants[request] = pair
+                stack.append((holder, iter(self.options[holder])))
+                break
+            else:
+                stack.pop()
+        return False
+
+    def _take(self, request, pair):
+        self.holder[pair] = request
+        self.assigned[request] = pair
+
+
+def _availability_calendar(user, created):
+    """Returns the user's Calendar 1, making one if they don't have one yet (the same way create_pairing does)."""
+    calendar = created.get(user.uid) or user.get_calendar_1()
+    if calendar is None:
+        calendar = Calendar(tutor=user, cal_type=1)
+        for field in Calendar.get_attrs():
+            setattr(calendar, field, 1)
+        db.session.add(calendar)
+        created[user.uid] = calendar
+    return calendar
+
+
+def batch_assign(today=None):
+    """Matches every pending request it can, and books them in one transaction.
+
+        Requests from students who already have a session booked in that subject (they booked one
+        themselves after joining the waiting list) are marked matched without booking anything.
+        Raises IntegrityError (after rolling back) if somebody was booked for one of
+        the same periods while this was running, then it can just be run again.
+        Returns {'requests': waiting, 'matched': number matched, 'seconds': time taken}.
+    """
+    start = time.time()
+    today = today or datetime.datetime.utcnow().date()
+    pending = PendingRequest.query.filter_by(status='pending') \
+        .order_by(PendingRequest.created, PendingRequest.id).all()
+
+    # Students who've since booked a tutor for the subject themselves don't need another one
+    booked = already_booked({request.student_id for request in pending}, today)
+    now = datetime.datetime.utcnow()
+    for request in pending:
+        if (request.student_id, request.subject) in booked:
+            request.status = 'matched'
+            request.matched = now
+    pending = [request for request in pending if request.status == 'pending']
+    if not pending:
+        db.session.commit()
+        return {'requests': 0, 'matched': 0, 'seconds': time.time() - start}
+
+    index = matching.get_index(get_data_version())  # so the index has every booking made up to now
+    students = {user.uid: user for user in User.query.options(joinedload(User.all_calendars))
+                .filter(User.uid.in_({request.student_id for request in pending})).all()}
+    not_today = ~index.day_mask(matching.weekday_label(today))  # no tutoring later today
+
+    options = {}
+    for request in pending:
+        student = students.get(request.student_id)
+        free_cal = student.get_calendar_0() if student else None
+        if free_cal is None:
+            continue
+        available_cal = student.get_calendar_1()
+        mask = index.calendar_mask(free_cal) & not_today
+        if available_cal is not None:
+            mask &= index.calendar_mask(available_cal)
+        matches = index.match(request.subject, mask, exclude=student.uid)
+        matches = {slot: [uid for uid in uids if uid not in students]  # nobody tutors while waiting for a tutor
+                   for (slot, uids) in matches.items()}
+        options[request.id] = best_options({slot: uids for (slot, uids) in matches.items() if uids}, index.business)
+
+    tutor_uids = {uid for choices in options.values() for (uid, slot) in choices}
+    load = dict(db.session.query(TutorWorkload.user_id, TutorWorkload.booked_slots)
+                .filter(TutorWorkload.user_id.in_(tutor_uids)).all()) if tutor_uids else {}
+    assignments = Assignment([request.id for request in pending], options,
+                             {uid: booked or 0 for (uid, booked) in load.items()}).solve()
+
+    tutors = {user.uid: user for user in User.query.options(joinedload(User.all_calendars))
+              .filter(User.uid.in_({uid for (uid, slot) in assignments.values()})).all()} if assignments else {}
+    slot_labels = get_schema().slot_labels
+    created = {}  # uid -> Calendar 1 made here
+    emails = []
+    try:
+        for request in pending:
+            if request.id not in assignments:
+                continue
+            (tutor_uid, slot) = assignments[request.id]
+            student, tutor = students[request.student_id], tutors[tutor_uid]
+            tutor_cal_1 = _availability_calendar(tutor, created)
+            date = tutor_cal_1.get_next_weekday(slot).date()
+            book_sessions(_availability_calendar(student, created), tutor_cal_1, request.subject, slot, [date])
+
+            label = slot_labels[slot]
+            date_string = label.day + " " + str(date)  # Monday 2016-05-02
+            request.status = 'matched'
+            request.matched = now
+
+            emails.append(([tutor.email], tutor_message,
+                           dict(student=student.username, subject=request.subject, date=date_string,
+                                period_number=label.name, email=student.email)))
+            emails.append(([student.email], student_message,
+                           dict(tutor=tutor.username, subject=request.subject, date=date_string,
+                                period_number=label.name, email=tutor.email)))
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        raise
+
+    queue_many(emails)  # commits everything above along with the emails
+
+    report = {'requests': len(pending), 'matched': len(assignments), 'seconds': time.time() - start}
+    logger.info('Batch matched {matched} of {requests} waiting requests in {seconds:.2f}s'.format(**report))
+    return report
@@ -1,8 +1,17 @@
 """Helper functions that get called in views.py"""
-from .models import Calendar, Subjects, User, StudentTutorPairings
-from config import periods, days_attended, basedir, display_tutor_name, period_names, subjects, labels
+from .models import Calendar, CalendarSlot, Subjects, User, StudentTutorPairings, TutoringSession, TutorWorkload, \
+    refresh_workload, bump_data_version, get_data_version, mark_users_changed
+from .matching import get_index, weekday_label
+from .metrics import pairings_total
+from .schema import build_schema, get_schema
+from .emailing import tutor_reminder_message, student_reminder_message
+from config import periods, days_attended, basedir, display_tutor_name, period_names, subjects
 from app import db
+from sqlalchemy import inspect, MetaData, Table, or_, and_, exists
+from sqlalchemy.orm import aliased
 import os
+import threading
+import time
 import datetime
 from random import shuffle
 
@@ -30,21 +39,364 @@ def update_subjects():
     for i in range(len(subjects)):
         for x in range(len(subjects[i])):
             database_label = subjects[i][x].replace(" ", "")
-            setattr(Subjects, database_label, db.Column(db.Integer))
+            if database_label not in Subjects.__table__.c:  # so it's safe to run more than once
+                setattr(Subjects, database_label, db.Column(db.Integer))
+    build_schema()
+
+def _slot_property(slot):
+    """Makes calendar.slot read and write the CalendarSlot rows."""
+    return property(lambda self: self.get_slot(slot), lambda self, value: self.set_slot(slot, value))
+
+
+def _slot_date_property(slot):
+    """Makes calendar.slot_date read and write the CalendarSlot expiration."""
+    return property(lambda self: self.get_slot_date(slot), lambda self, date: self.set_slot_date(slot, date))
+
 
 def update_calendar():
-    """Add calendar fields based on config."""
-    for n in range(len(periods)):
-        for i in range(periods[n]):
-            label = labels[n]+str(i+1)
-            setattr(Calendar, label, db.Column(db.Integer))
-            setattr(Calendar, label+'_date', db.Column(db.Date))
-        before_label = labels[n]+'B'
-        setattr(Calendar, before_label, db.Column(db.Integer))
-        setattr(Calendar, before_label+'_date', db.Column(db.Date))
-        after_label = labels[n]+'A'
-        setattr(Calendar, after_label, db.Column(db.Integer))
-        setattr(Calendar, after_label+'_date', db.Column(db.Date))
+    """Add calendar fields based on config.
+
+        The fields are properties backed by CalendarSlot rows, so changing the
+        number of days or periods doesn't change the database layout.
+    """
+    schema = build_schema()
+    for label in schema.slots:
+        setattr(Calendar, label, _slot_property(label))
+        setattr(Calendar, label+'_date', _slot_date_property(label))
+
+
+def migrate_calendar():
+    """Moves calendars out of the old layout, with a column per period, into CalendarSlot rows.
+
+        Does nothing if the calendar table is already in the new layout.
+        Run this after db.create_all(), so the calendar_slot table exists.
+    """
+    inspector = inspect(db.engine)
+    if 'calendar' not in inspector.get_table_names():
+        return
+    kept = ('id', 'tutor_id', 'cal_type')
+    legacy_slots = [column['name'] for column in inspector.get_columns('calendar')
+                    if column['name'] not in kept and not column['name'].endswith('_date')]
+    if not legacy_slots:
+        return
+
+    legacy = Table('calendar', MetaData(), autoload=True, autoload_with=db.engine)
+
+    with db.engine.begin() as connection:
+        calendars = []
+        slot_rows = []
+        for row in connection.execute(legacy.select()):
+            calendars.append({'id': row['id'], 'tutor_id': row['tutor_id'], 'cal_type': row['cal_type']})
+            default = 0 if row['cal_type'] == 0 else 1
+            for slot in legacy_slots:
+                value = row[slot]
+                if value is not None and bool(value) != bool(default):
+                    expires = row[slot + '_date'] if slot + '_date' in row.keys() else None
+                    slot_rows.append({'calendar_id': row['id'], 'slot': slot, 'expires': expires})
+
+        legacy.drop(connection)
+        Calendar.__table__.create(connection)
+        if calendars:
+            connection.execute(Calendar.__table__.insert(), calendars)
+        if slot_rows:
+            connection.execute(CalendarSlot.__table__.insert(), slot_rows)
+
+    refresh_workload()
+    db.session.commit()
+
+
+def create_missing_sessions():
+    """Adds TutoringSession rows for pairings booked before sessions were kept (one week each).
+
+        Does nothing once every pairing has its sessions.
+    """
+    has_sessions = exists().where(TutoringSession.pairing_id == StudentTutorPairings.id)
+    pairings = StudentTutorPairings.query.filter(~has_sessions).all()
+    if not pairings:
+        return
+    slots = {(label.day, label.number): slot for (slot, label) in get_schema().slot_labels.items()}
+    names = {pairing.student for pairing in pairings} | {pairing.tutor for pairing in pairings}
+    uids = dict(db.session.query(User.username, User.uid).filter(User.username.in_(names)).all())
+    taken = set()  # (date, slot, uid), in case two old pairings overlap
+    for pairing in pairings:
+        slot = slots.get((pairing.day, pairing.period))
+        for (name, role) in ((pairing.student, 'student'), (pairing.tutor, 'tutor')):
+            key = (pairing.date, slot, uids.get(name))
+            if slot is None or key[2] is None or key in taken:
+                continue
+            taken.add(key)
+            session = TutoringSession(key[2], role, pairing.date, slot)
+            session.pairing_id = pairing.id
+            db.session.add(session)
+    db.session.commit()
+
+
+def session_dates(first, weeks=1, until=None):
+    """Returns the dates of a weekly booking starting on first: weeks of them, or every week up to until."""
+    if until is not None:
+        weeks = max(1, (until - first).days // 7 + 1)
+    return [first + datetime.timedelta(weeks=n) for n in range(weeks)]
+
+
+def find_conflicts(uids, slot, dates):
+    """Returns the TutoringSessions any of the users already have during slot on any of the dates.
+
+        One query on the (date, slot, user_id) index.
+    """
+    return TutoringSession.query.filter(TutoringSession.date.in_(dates),
+                                        TutoringSession.slot == slot,
+                                        TutoringSession.user_id.in_(uids)).all()
+
+
+def is_still_available(student, tutor, slot, dates=()):
+    """Returns True if the student and tutor are both still free, and not booked, during slot.
+
+        dates are the days of a booking about to be made, which are checked for sessions already booked.
+    """
+    if tutor is None:
+        return False
+    for user in (student, tutor):
+        free_cal = user.get_calendar_0()
+        available_cal = user.get_calendar_1()
+        if free_cal is None or available_cal is None:
+            return False
+        if not getattr(free_cal, slot) or not getattr(available_cal, slot):
+            return False
+    return not (dates and find_conflicts([student.uid, tutor.uid], slot, dates))
+
+
+def book_sessions(student_calendar, tutor_calendar, subject, slot, dates):
+    """Books a student and tutor (through their Calendar 1s) for slot on each of the dates, one per week.
+
+        Adds the StudentTutorPairings, a TutoringSession for each of them on each date, and marks slot
+        as booked in both calendars until the sessions are over (see expire_bookings). Doesn't commit.
+        Returns the new StudentTutorPairings.
+    """
+    student, tutor = student_calendar.tutor, tutor_calendar.tutor
+    student_calendar.set_0(slot, weeks=len(dates))
+    tutor_calendar.set_0(slot, weeks=len(dates))
+
+    pairing = StudentTutorPairings(student.username, tutor.username, subject, dates[0],
+                                   get_schema().slot_labels[slot].number)
+    for date in dates:
+        pairing.sessions.append(TutoringSession(student.uid, 'student', date, slot))
+        pairing.sessions.append(TutoringSession(tutor.uid, 'tutor', date, slot))
+    db.session.add(pairing)
+    return pairing
+
+
+def get_week_grid(user):
+    """Returns the user's schedule for the profile page, or None if they haven't set their free periods.
+
+        For the logged in user, both calendars are already loaded (see models.get_current_user).
+        The result is a list with one entry per day:
+        [("Monday", [("Before", True), ("1st", False), ...]), ...]
+        Only periods ticked in the free periods calendar are listed. The boolean is False
+        when the user is already booked that period.
+    """
+    free_cal = user.get_calendar_0()
+    available_cal = user.get_calendar_1()
+    if free_cal is None or available_cal is None:
+        return None
+
+    schema = get_schema()
+    grid = []
+    for (i, day) in enumerate(schema.day_slots):
+        day_periods = [(schema.slot_labels[slot].period, bool(getattr(available_cal, slot)))
+                       for slot in day if getattr(free_cal, slot)]
+        grid.append((days_attended[i], day_periods))
+    return grid
+
+
+def get_schedule_grid(monday, active_only=True):
+    """Returns every pairing meeting in the week starting on monday, sorted into a day x period grid.
+
+        Uses one query on the TutoringSession (date, slot, user_id) index, so pairings booked for
+        several weeks show up in every one of them. The result is a list with
+        one entry per day: [("Monday", [("Before School", [pairing, ...]), ("1st", [...]), ...]), ...]
+    """
+    query = db.session.query(TutoringSession.slot, StudentTutorPairings) \
+        .join(TutoringSession.pairing) \
+        .filter(TutoringSession.date >= monday,
+                TutoringSession.date < monday + datetime.timedelta(weeks=1),
+                TutoringSession.role == 'tutor')
+    if active_only:
+        query = query.filter(StudentTutorPairings.active == 1)
+
+    buckets = {}  # slot -> [pairing, ...]
+    for (slot, pairing) in query.order_by(TutoringSession.date, StudentTutorPairings.id).all():
+        buckets.setdefault(slot, []).append(pairing)
+
+    schema = get_schema()
+    grid = []
+    for (i, day) in enumerate(schema.day_slots):
+        columns = [(schema.pairing_periods[schema.slot_labels[slot].number], buckets.get(slot, [])) for slot in day]
+        grid.append((days_attended[i], columns))
+    return grid
+
+
+def widen_password_column():
+    """Makes users.pwdhash big enough for any hash, on databases made when it held 54 characters.
+
+        SQLite doesn't enforce lengths, so this only matters for database servers.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return
+    for column in inspect(db.engine).get_columns('users'):
+        if column['name'] == 'pwdhash' and (getattr(column['type'], 'length', None) or 255) < 255:
+            if db.engine.dialect.name == 'mysql':
+                db.engine.execute('ALTER TABLE users MODIFY pwdhash VARCHAR(255)')
+            else:
+                db.engine.execute('ALTER TABLE users ALTER COLUMN pwdhash TYPE VARCHAR(255)')
+
+
+def create_missing_indexes():
+    """Creates any index declared on the models that an existing database doesn't have yet.
+
+        db.create_all() only adds indexes when it creates a table, so this catches
+        databases made before an index was added.
+    """
+    inspector = inspect(db.engine)
+    tables = inspector.get_table_names()
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+
+
+def expire_bookings(today=None):
+    """Frees every booked period with no sessions left, and deactivates pairings with no sessions left.
+
+        The TutoringSession rows are what's booked. A booked period in someone's Calendar 1 is
+        freed once they have no session in that period from today on, however long ago it was
+        booked for. Works on whole tables at once (one DELETE and one UPDATE, each checking the
+        (date, slot, user_id) index) in a single transaction, instead of checking every calendar
+        period by period.
+        Returns {'freed': periods freed, 'deactivated': pairings deactivated, 'seconds': time taken}.
+    """
+    start = time.time()
+    if today is None:
+        today = datetime.datetime.utcnow().date()
+
+    booked_calendars = db.session.query(Calendar.id).filter(Calendar.cal_type == 1)
+    owner = db.session.query(Calendar.tutor_id).filter(Calendar.id == CalendarSlot.calendar_id) \
+        .correlate(CalendarSlot).as_scalar()
+    still_booked = exists().where(and_(TutoringSession.user_id == owner,
+                                       TutoringSession.slot == CalendarSlot.slot,
+                                       TutoringSession.date >= today))
+    expired = CalendarSlot.query.filter(CalendarSlot.calendar_id.in_(booked_calendars.subquery()), ~still_booked)
+
+    uids = [uid for (uid,) in db.session.query(Calendar.tutor_id).distinct()
+            .filter(Calendar.id.in_(expired.with_entities(CalendarSlot.calendar_id).subquery())).all()]
+    freed = expired.delete(synchronize_session=False)
+
+    upcoming = exists().where(and_(TutoringSession.pairing_id == StudentTutorPairings.id,
+                                   TutoringSession.date >= today))
+    deactivated = StudentTutorPairings.query \
+        .filter(StudentTutorPairings.active == 1, StudentTutorPairings.date < today, ~upcoming) \
+        .update({'active': 0}, synchronize_session=False)
+
+    refresh_workload(uids)
+    if freed or deactivated:
+        bump_data_version()  # the bulk statements above go around the ORM, so it can't notice them
+        mark_users_changed(uids)  # and the matching index reloads just the users with periods freed
+    db.session.commit()
+    db.session.expire_all()  # anything already loaded may have had rows deleted underneath it
+
+    return {'freed': freed, 'deactivated': deactivated, 'seconds': time.time() - start}
+
+
+def get_pairing_period_name(period):
+    """Returns the display name of a StudentTutorPairings.period.
+
+        0 is before school, -1 after school, and the period number + 1 otherwise.
+    """
+    return get_schema().pairing_periods[period]
+
+
+def get_reminders(today=None):
+    """Returns {email: [reminder, ...]} for everybody tutoring or being tutored today.
+
+        Uses one query on the TutoringSession (date, slot, user_id) index, joined to the pairings
+        and to users for both emails, so the work depends on how many sessions there are today
+        rather than how many users or pairings.
+    """
+    if today is None:
+        today = datetime.datetime.utcnow().date()
+
+    tutor = aliased(User)
+    student = aliased(User)
+    rows = db.session.query(StudentTutorPairings, tutor.email, student.email) \
+        .join(TutoringSession, TutoringSession.pairing_id == StudentTutorPairings.id) \
+        .outerjoin(tutor, tutor.username == StudentTutorPairings.tutor) \
+        .outerjoin(student, student.username == StudentTutorPairings.student) \
+        .filter(TutoringSession.date == today, TutoringSession.role == 'tutor',
+                StudentTutorPairings.active == 1) \
+        .all()
+    rows.sort(key=lambda row: (row[0].period == -1, row[0].period))  # after school goes last
+
+    reminders = {}
+    for pairing, tutor_email, student_email in rows:
+        period = get_pairing_period_name(pairing.period)
+        if tutor_email:
+            reminders.setdefault(tutor_email, []).append(tutor_reminder_message.format(
+                student=pairing.student, email=student_email, subject=pairing.subject, period=period))
+        if student_email:
+            reminders.setdefault(student_email, []).append(student_reminder_message.format(
+                tutor=pairing.tutor, email=tutor_email, subject=pairing.subject, period=period))
+    return reminders
+
+
+def get_subject_recipients(columns):
+    """Returns the email of every tutor who tutors at least one of the subject columns, in one query."""
+    if not columns:
+        return []
+    tutors_any = or_(*[getattr(Subjects, column) == 1 for column in columns])
+    rows = db.session.query(User.email).distinct() \
+        .join(Subjects, Subjects.tutor_id == User.uid) \
+        .filter(User.user_type == 1, tutors_any) \
+        .order_by(User.email) \
+        .all()
+    return [email for (email,) in rows if email]
+
+
+def update_workload():
+    """Fills in TutorWorkload for databases created before it existed."""
+    if TutorWorkload.query.first() is None:
+        refresh_workload()
+        db.session.commit()
+
+
+_setup_lock = threading.Lock()
+_database_ready = False
+
+
+def setup_app(app, upgrade_database=True):
+    """Gets the app ready to serve requests. Safe to call more than once, from any process.
+
+        Adds the period and subject fields and the template globals and filters.
+        If upgrade_database is set, also creates any missing tables and indexes, and converts
+        older databases. That only happens once per process.
+    """
+    global _database_ready
+    with _setup_lock:
+        update_environment_variables(app)
+        app.jinja_env.filters['date'] = _jinja2_datetime_filter
+        update_subjects()
+        update_calendar()
+        if upgrade_database and not _database_ready:
+            db.create_all()
+            migrate_calendar()
+            create_missing_indexes()
+            widen_password_column()
+            create_missing_sessions()
+            update_workload()
+            db.session.remove()
+            _database_ready = True
+    return app
 
 
 def create_pairing(subject):
@@ -57,25 +409,12 @@ def create_pairing(subject):
 
     """
 
-    period_names.insert(0, "Before")
-    period_names.append("After")
-
+    pairings_total.inc()
     student = User.query_from_cookie()
 
     subject = subject.replace(" ", "") # turns the pretty display subject into the one word version used by the database
 
-    schedule_keys = Calendar.sort_attrs()
-
-    day_names = {}  # {"Monday Before", "Monday First", ... "Friday After"}
-    x = 0
-    for i in range(len(periods)):
-        for n in range(periods[i]+2):
-            key = schedule_keys[x]
-            if n != periods[i] + 1:
-                day_names[key] = days_attended[i] + " " + period_names[n]
-            else:
-                day_names[key] = days_attended[i] + " " + period_names[-1]
-            x += 1
+    slot_labels = get_schema().slot_labels  # {"MB": SlotLabel(display="Monday Before", ...), ...}
 
     if not student.get_calendar_1():
         new_cal = Calendar(tutor=student, cal_type=1)
@@ -84,89 +423,21 @@ def create_pairing(subject):
         db.session.add(new_cal)
         db.session.commit()
 
-    student_schedule_1 = dict(Calendar.query_from_field(tutor=student, cal_type=1))
-    student_schedule_0 = dict(Calendar.query_from_field(tutor=student, cal_type=0))
-
-    student_schedule = {key: student_schedule_0[key] and student_schedule_1[key] for key in schedule_keys}
-    # This creates a merged calender, saved as a dict.
-    # The student is only available (stored as 1) when free, and not being tutored/tutoring
-
-    # The mess below this comment creates a merged calendar, saved as a dict.
-    # the tutor is only available (stored as 1) when:
-    # signed up to tutor
-    # not currently tutoring/being tutored
-    #
-
-    all_tutors = User.query.filter_by(user_type='1').all()
-
-    if student in all_tutors:
-        all_tutors.remove(student)
-
-    matching_subjects = []
-    for tutor in all_tutors:
-        tutor_subjects = dict(Subjects.query_from_field(tutor=tutor))
-        if tutor_subjects[subject]:
-            matching_subjects.append(tutor)
-
-    matching_and_free = []
-    for tutor in matching_subjects:
-        if not tutor.get_calendar_1():
-            new_cal = Calendar(tutor=tutor, cal_type=1)
-            for field in Calendar.get_attrs():
-                setattr(new_cal, field, 1)
-            db.session.add(new_cal)
-            db.session.commit()
-
-        tutor_schedule_1 = dict(tutor.get_calendar_1())
-        tutor_schedule_0 = dict(tutor.get_calendar_0())
-        tutor_schedule = {key: tutor_schedule_0[key] and tutor_schedule_1[key] for key in schedule_keys}
-
-        date = datetime.date.today().strftime('%A')
-
-        if date == 'Monday':
-            day_letter = 'M'
-        elif date == 'Tuesday':
-            day_letter = 'T'
-        elif date == 'Wednesday':
-            day_letter = 'W'
-        elif date == 'Thursday':
-            day_letter = 'R'
-        elif date == 'Friday':
-            day_letter = 'F'
-        elif date == 'Saturday':
-            day_letter = 'S'
-        elif date == 'Sunday':
-            day_letter = 'U'
-        else:
-            day_letter = ''
-
-        for key in schedule_keys:
-            if student_schedule[key] == tutor_schedule[key] == 1:
-                if not key.startswith(day_letter):
-                    matching_and_free.append([tutor, key])
-
-    matching_free_and_minimized = []  # sorts the tutors into which day/period they tutor, then who is least busy
-    minimized_buffer = {}  # { "MB": [Tutor, Tutor2], "T5": [Tutor3, Tutor4] }
-    for pair in matching_and_free:
-        tutor = pair[0]
-        day = pair[1]
-        if not (day in minimized_buffer):
-            minimized_buffer[day] = [tutor]
-        else:
-            minimized_buffer[day].append(tutor)
+    index = get_index(get_data_version())  # rebuilt if anything changed, in this process or another
+
+    # The student is only available (stored as 1) when free, and not being tutored/tutoring.
+    # Tutors are stored the same way in the index, so matching is just an AND of the two.
+    student_mask = index.calendar_mask(student.get_calendar_0()) & index.calendar_mask(student.get_calendar_1())
+    student_mask &= ~index.day_mask(weekday_label(datetime.date.today()))  # no tutoring later today
+
+    minimized_buffer = index.match(subject, student_mask, exclude=student.uid)  # { "MB": [uid, uid2], ... }
 
     # Tries to find the least busy tutors available
+    matching_free_and_minimized = []
     for day, group in minimized_buffer.items():
-        lowest_tutor = None
-        shuffle(group)
-        for tutor in group:
-            if not lowest_tutor:
-                lowest_tutor = tutor
-            else:
-                current_value = tutor.get_business_value()
-                if current_value < lowest_tutor.get_business_value():
-                    lowest_tutor = tutor
-        matching_free_and_minimized.append([lowest_tutor.username, day])
+        shuffle(group)  # so ties are broken randomly
+        lowest_tutor = min(group, key=lambda uid: index.business[uid])
+        matching_free_and_minimized.append([index.usernames[lowest_tutor], day])
 
     final_dict = {}
     for pair in matching_free_and_minimized:
@@ -174,17 +445,14 @@ def create_pairing(subject):
         day = pair[1]
         if day not in final_dict:  # If there isn't already a tutor for that period, which there shouldn't be anyways
             if display_tutor_name:  # config setting on
-                final_dict[day] = [("{name}, {period}".format(name=tutor, period=day_names[day])),
+                final_dict[day] = [("{name}, {period}".format(name=tutor, period=slot_labels[day].display)),
                                    tutor,
                                    subject,
                                    day]
             else:  # config setting off
-                final_dict[day] = [("{period}".format(period=day_names[day])),
+                final_dict[day] = [("{period}".format(period=slot_labels[day].display)),
                                    tutor,
                                    subject,
                                    day]
 
-    period_names.remove("Before")  # Removes the added before/after so it doesn't get added every time
-    period_names.remove("After")
-
     return final_dict
\ No newline at end of file
@@ -0,0 +1,64 @@
+"""Sets up the connection to the database.
+
+    The database comes from SQLALCHEMY_DATABASE_URI in config.py, which can be swapped for
+    a database server with the DATABASE_URL environment variable without touching the code.
+
+    Each process keeps a pool of DATABASE_POOL_SIZE connections, instead of SQLite's default
+    of opening a new connection for every request.
+
+    Every new SQLite connection gets SQLITE_PRAGMAS. The important ones are WAL, which lets
+    pages read while something else writes, and busy_timeout, which makes a write wait for
+    another to finish instead of failing with "database is locked".
+"""
+import sqlite3
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from config import DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_RECYCLE, SQLITE_PRAGMAS
+
+
+def apply_sqlite_pragmas(engine, pragmas=SQLITE_PRAGMAS):
+    """Runs PRAGMA name=value for every (name, value) in pragmas on each new connection the engine opens."""
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for (name, value) in pragmas:
+            cursor.execute('PRAGMA {0}={1}'.format(name, value))
+        cursor.close()
+    return engine
+
+
+if not hasattr(SQLAlchemy, 'create_engine'):
+    # Older versions never call Database.create_engine, so SQLite would quietly run without the pragmas
+    raise RuntimeError('Flask-SQLAlchemy 2.4 or newer is needed, run "pip install -r requirements.txt"')
+
+
+class Database(SQLAlchemy):
+    """Flask-SQLAlchemy with a connection pool for every database, and the SQLite pragmas.
+
+        Needs Flask-SQLAlchemy 2.4 or newer, the first to build engines through create_engine.
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        if sa_url.drivername.startswith('sqlite'):
+            if sa_url.database not in (None, '', ':memory:'):
+                # Flask-SQLAlchemy opens a new connection for every request unless a pool size is given.
+                # Connections are handed between threads by the pool, never used by two at once.
+                options.setdefault('poolclass', QueuePool)
+                options.setdefault('pool_size', DATABASE_POOL_SIZE)
+                options.setdefault('max_overflow', DATABASE_MAX_OVERFLOW)
+                options.setdefault('connect_args', {})['check_same_thread'] = False
+        else:
+            options.setdefault('pool_size', DATABASE_POOL_SIZE)
+            options.setdefault('max_overflow', DATABASE_MAX_OVERFLOW)
+            options.setdefault('pool_recycle', DATABASE_POOL_RECYCLE)
+            options.setdefault('pool_pre_ping', True)  # servers drop idle connections
+        return SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = SQLAlchemy.create_engine(self, sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite':
+            apply_sqlite_pragmas(engine)
+        return engine
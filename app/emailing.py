@@ -1,8 +1,20 @@
-"""Handles the actual emailing."""
-from smtplib import SMTP_SSL as SMTP
+"""Handles the actual emailing.
+
+    Connections to the mail server are slow to open (TLS handshake, then login),
+    so MailTransport keeps a small pool of logged in connections and reuses them
+    for every message. Idle connections are checked with a NOOP before being reused,
+    and are reopened if the server has dropped them.
+
+    send_email sends one message, send_many sends a batch over a single connection,
+    and send_bulk sends one message to a long list of people in BCC batches.
+"""
+import threading
+import time
+from smtplib import SMTP, SMTP_SSL, SMTPServerDisconnected, SMTPRecipientsRefused, SMTPException
 from email.mime.text import MIMEText
-from config import MY_EMAIL, EMAIL_SERVER, EMAIL_USERNAME, EMAIL_PASSWORD, confirmation, password_change, \
-    sent_to_tutor, sent_to_student, reminder, tutoring_service_name
+from config import MY_EMAIL, EMAIL_SERVER, EMAIL_USERNAME, EMAIL_PASSWORD, EMAIL_USE_TLS, EMAIL_POOL_SIZE, \
+    EMAIL_KEEPALIVE, EMAIL_TIMEOUT, MASS_EMAIL_BATCH_SIZE, confirmation, password_change, sent_to_tutor, sent_to_student, tutor_reminder, \
+    student_reminder, tutoring_service_name
 
 confirmation_message = confirmation
 
@@ -12,17 +24,131 @@ tutor_message = sent_to_tutor
 
 student_message = sent_to_student
 
-reminder = reminder
+tutor_reminder_message = tutor_reminder
 
-def send_email(recipients, message=confirmation_message, **kwargs):
-    """Sends an email to the recipient containing the message specified.
+student_reminder_message = student_reminder
 
-        kwargs are used to fill in things like {{username}} or {{email}}
+# The day's reminder email: the lines from data.py's get_reminders, already filled in from the two above
+reminders_message = "{reminders}"
 
-        recipients is a list of arbitrary length, however a check has been added
-        just in case.
+
+class MailTransport(object):
+    """A pool of logged in SMTP connections.
+
+        server is "host:port". Port 465 uses SSL from the start, any other port
+        upgrades with STARTTLS if use_tls is set. If username is empty, login is skipped.
     """
 
+    def __init__(self, server=EMAIL_SERVER, username=EMAIL_USERNAME, password=EMAIL_PASSWORD,
+                 use_tls=EMAIL_USE_TLS, pool_size=EMAIL_POOL_SIZE, keepalive=EMAIL_KEEPALIVE,
+                 timeout=EMAIL_TIMEOUT):
+        host, _, port = server.partition(':')
+        self.host = host
+        self.port = int(port) if port else 465
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self._idle = []  # [(connection, time it was last used)]
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.port == 465:
+            connection = SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            connection = SMTP(self.host, self.port, timeout=self.timeout)
+            if self.use_tls:
+                connection.starttls()
+        if self.username:
+            connection.login(self.username, self.password)
+        return connection
+
+    def _checkout(self):
+        """Returns an idle connection that still works, or a new one."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, last_used = self._idle.pop()
+            if time.time() - last_used < self.keepalive:
+                return connection
+            try:
+                if connection.noop()[0] == 250:
+                    return connection
+            except (SMTPException, OSError):
+                pass
+            self._close(connection)
+        return self._connect()
+
+    def _checkin(self, connection):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append((connection, time.time()))
+                return
+        self._close(connection)
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.quit()
+        except (SMTPException, OSError):
+            connection.close()
+
+    def send_many(self, messages):
+        """Sends [(recipient_list, message_string), ...] over one connection.
+
+            Returns a list of (recipient_list, error) for the messages that weren't sent. One message
+            failing doesn't stop the rest: after anything but the server refusing the recipients, the
+            connection is closed and the next message gets a new one.
+            If the server drops the connection part way, it's reopened and the message retried once.
+        """
+        failed = []
+        connection = None
+        try:
+            for recipient_list, message in messages:
+                try:
+                    if connection is None:
+                        connection = self._checkout()
+                    try:
+                        connection.sendmail(MY_EMAIL, recipient_list, message)
+                    except SMTPServerDisconnected:
+                        self._close(connection)
+                        connection = None
+                        connection = self._connect()
+                        connection.sendmail(MY_EMAIL, recipient_list, message)
+                except SMTPRecipientsRefused as error:
+                    failed.append((recipient_list, error))
+                except (SMTPException, OSError) as error:
+                    failed.append((recipient_list, error))
+                    if connection is not None:
+                        self._close(connection)
+                        connection = None
+        except BaseException:
+            if connection is not None:
+                self._close(connection)
+            raise
+        if connection is not None:
+            self._checkin(connection)
+        return failed
+
+    def close(self):
+        """Closes every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, last_used in idle:
+            self._close(connection)
+
+
+transport = MailTransport()
+
+
+def build_message(recipients, message=confirmation_message, **kwargs):
+    """Returns (recipient_list, message_string) ready to hand to the transport.
+
+        kwargs are used to fill in things like {{username}} or {{email}}
+    """
     text_to_send = message.format(**kwargs)
 
     if type(recipients) is not list:
@@ -34,12 +160,55 @@ def send_email(recipients, message=confirmation_message, **kwargs):
     msg['Subject'] = tutoring_service_name
     msg['To'] = ', '.join(recipient_list)
 
-    connection = SMTP("smtp.gmail.com")
-    connection.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+    return recipient_list, msg.as_string()
+
+
+def build_bulk_message(message):
+    """Returns the message string for an email sent to many people at once.
+
+        The text is sent exactly as written. Recipients only go in the envelope (BCC),
+        so the To header is our own address and nobody sees the rest of the list.
+    """
+    msg = MIMEText(message, 'plain')
+    msg['Subject'] = tutoring_service_name
+    msg['To'] = MY_EMAIL
+    return msg.as_string()
+
+
+def chunk_recipients(recipients, size=MASS_EMAIL_BATCH_SIZE):
+    """Splits a list of recipients into lists of at most size."""
+    return [recipients[i:i + size] for i in range(0, len(recipients), size)]
+
+
+def send_bulk(recipients, message, size=MASS_EMAIL_BATCH_SIZE):
+    """Sends one message to many recipients in BCC batches over one connection.
 
-    connection.sendmail(MY_EMAIL, recipient_list, msg.as_string())
+        The message is rendered once. Returns (sent, failed) counts of recipients. A batch that
+        can't be sent counts all of its recipients as failed, and the batches after it still go out.
+    """
+    body = build_bulk_message(message)
+    batches = chunk_recipients(recipients, size)
+    failed = transport.send_many([(batch, body) for batch in batches])
+    failed_count = sum(len(batch) for (batch, error) in failed)
+    return len(recipients) - failed_count, failed_count
 
-    connection.close()
 
+def send_email(recipients, message=confirmation_message, **kwargs):
+    """Sends an email to the recipient containing the message specified.
 
+        kwargs are used to fill in things like {{username}} or {{email}}
 
+        recipients is a list of arbitrary length, however a check has been added
+        just in case.
+    """
+    return transport.send_many([build_message(recipients, message, **kwargs)])
+
+
+def send_many(batch):
+    """Sends a batch of emails over one connection.
+
+        batch is a list of (recipients, message, kwargs) with the same meaning as send_email's arguments.
+        Returns a list of (recipient_list, error) for any that the server refused.
+    """
+    return transport.send_many([build_message(recipients, message, **kwargs)
+                                for (recipients, message, kwargs) in batch])
@@ -0,0 +1,125 @@
+"""Exports StudentTutorPairings as CSV for external recordkeeping.
+
+    iter_csv() streams every pairing without loading them all into memory,
+    and is used by the /schedule.csv download.
+
+    export_new_pairings() keeps StudentTutorPairings.csv up to date by appending only
+    the pairings created since the last export. The first column is the pairing id,
+    so the last line of the file is the watermark. Rows are never rewritten once exported,
+    so the file leaves out whether a pairing is still active, which changes when it expires.
+    For that, download /schedule.csv, which is read fresh every time. The new file is written to a
+    temporary file and renamed over the old one, so readers never see half an export
+    and two exports running at once can't interleave their rows.
+    It's run by check_date.py rather than when a page is viewed.
+"""
+import csv
+import io
+import os
+import shutil
+import tempfile
+from app import db
+from .models import StudentTutorPairings
+from config import CSV_location
+
+HEADER = ["id", "student", "tutor", "subject", "date", "active"]
+EXPORT_HEADER = HEADER[:-1]  # only the columns that never change
+
+CHUNK_SIZE = 500  # rows fetched from the database, and sent to the browser, at a time
+
+
+def _pairing_rows(after_id=0, active=True):
+    """Yields a CSV row for every pairing with an id greater than after_id, in id order.
+
+        The active column is left out if active is False.
+    """
+    columns = [StudentTutorPairings.id, StudentTutorPairings.student, StudentTutorPairings.tutor,
+               StudentTutorPairings.subject, StudentTutorPairings.date_str]
+    if active:
+        columns.append(StudentTutorPairings.active)
+    query = db.session.query(*columns) \
+        .filter(StudentTutorPairings.id > after_id) \
+        .order_by(StudentTutorPairings.id) \
+        .yield_per(CHUNK_SIZE)
+    for row in query:
+        yield list(row)
+
+
+def iter_csv():
+    """Yields the full CSV, header included, a chunk of rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HEADER)
+    for (i, row) in enumerate(_pairing_rows(), 1):
+        writer.writerow(row)
+        if i % CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _last_exported_id(path):
+    """Returns the id on the last line of an existing export, or 0 if there isn't one.
+
+        Files from before the active column was dropped also count as no export, so they're written again.
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path, newline='') as existing:
+        if next(csv.reader(existing), None) != EXPORT_HEADER:
+            return 0
+    with open(path, 'rb') as existing:
+        existing.seek(0, os.SEEK_END)
+        position = existing.tell()
+        if position == 0:
+            return 0
+        # walk backwards past the trailing newline to the start of the last line
+        line = b''
+        while position > 0:
+            step = min(1024, position)
+            position -= step
+            existing.seek(position)
+            line = existing.read(step) + line
+            if line.rstrip(b'\r\n').find(b'\n') != -1:
+                break
+        last_line = line.rstrip(b'\r\n').split(b'\n')[-1].decode()
+    try:
+        return int(next(csv.reader([last_line]))[0])
+    except (ValueError, IndexError, StopIteration):
+        return 0  # only the header, or not a file this module wrote
+
+
+def export_new_pairings(path=CSV_location):
+    """Appends pairings created since the last export to the CSV at path.
+
+        Returns the number of rows added.
+    """
+    after_id = _last_exported_id(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.StudentTutorPairings', suffix='.csv')
+
+    added = 0
+    try:
+        with os.fdopen(handle, 'w', newline='') as temp:
+            if after_id:
+                with open(path, newline='') as existing:
+                    shutil.copyfileobj(existing, temp)
+            else:
+                csv.writer(temp).writerow(EXPORT_HEADER)
+            writer = csv.writer(temp)
+            for row in _pairing_rows(after_id, active=False):
+                writer.writerow(row)
+                added += 1
+            temp.flush()
+            os.fsync(temp.fileno())
+
+        if added or not after_id:
+            os.replace(temp_path, path)
+        else:
+            os.remove(temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return added
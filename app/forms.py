@@ -11,10 +11,13 @@
 from flask_wtf import Form
 from flask import session
 import time
+import datetime
 from wtforms import StringField, PasswordField, SelectField, SelectMultipleField, widgets, TextAreaField
-from wtforms.validators import DataRequired, email, EqualTo
+from wtforms.fields.html5 import DateField
+from wtforms.validators import DataRequired, email, EqualTo, Optional
 from .models import User
-from config import tutor_password, periods, period_names, subjects, subject_names, days_attended, admin_password
+from config import tutor_password, periods, period_names, subjects, subject_names, days_attended, admin_password, \
+    BOOKING_MAX_WEEKS
 
 
 class MultiCheckboxField(SelectMultipleField):
@@ -220,20 +223,41 @@ class TutorRequestForm(Form):
 
 
 
-def create_tutor_selection_form():
-    """Goes outside the TutorSelectionForm in order to pass a session variable to the form."""
-    if 'tutor list' in session:
-        if session['tutor list']:
-            class TutorSelectionForm(Form):
-                """Makes a table of tutors who can be selected."""
+class TutorSelectionForm(Form):
+    """Makes a table of tutors who can be selected, and asks for how many weeks."""
+    potential_tutors = MultiCheckboxField('Available Tutors', choices=[])
+    weeks = SelectField('How often', coerce=int, default=1,
+                        choices=[(1, 'Just once')] + [(n, 'Every week for {0} weeks'.format(n))
+                                                      for n in range(2, BOOKING_MAX_WEEKS + 1)])
+    until = DateField('Or every week until (optional)', validators=[Optional()])
 
-                choices = [(key, session['tutor list'][key][0]) for key in session['tutor list']]
-                potential_tutors = MultiCheckboxField('Available Tutors', choices=choices)
+    def validate(self):
+        if not Form.validate(self):
+            return False
+        if self.until.data is not None:
+            today = datetime.date.today()
+            if not today < self.until.data <= today + datetime.timedelta(weeks=BOOKING_MAX_WEEKS):
+                self.until.errors.append('Please pick a date in the next {0} weeks'.format(BOOKING_MAX_WEEKS))
+                return False
+        return True
 
-            return TutorSelectionForm()
 
-        else:
-            return False
+class RetryEmailsForm(Form):
+    """The retry button on the Outbox page. Has no fields, it's only there for the CSRF token."""
+
+
+class BatchAssignForm(Form):
+    """The button on the Batch Assign page. Has no fields, it's only there for the CSRF token."""
+
+
+def create_tutor_selection_form(shortlist):
+    """Makes a TutorSelectionForm with a choice for every tutor in the shortlist (see data.py's create_pairing)."""
+    if not shortlist:
+        return False
+
+    form = TutorSelectionForm()
+    form.potential_tutors.choices = [(key, shortlist[key][0]) for key in shortlist]
+    return form
 
 
 class MassEmailForm(Form):
@@ -0,0 +1,244 @@
+"""Writes the website's log as one JSON object per line, without making requests wait on the disk.
+
+    The "app" loggers (app.views, app.outbox...) hand their records to a QueueHandler, which only
+    puts them on a queue. A QueueListener thread takes them off and does the writing.
+
+    Every line has time, level, logger, process and message, and whichever of user, route, method,
+    status, subject, slot and latency_ms (how long the request had been running) apply.
+    The request ones are filled in automatically, pass subject and slot with extra=,
+    i.e. logger.info('...', extra={'subject': subject, 'slot': slot}).
+
+    The file is LOG_FILE. It's moved to LOG_FILE.1 (and .1 to .2 and so on, keeping LOG_BACKUPS)
+    when it reaches LOG_MAX_BYTES, and at the first record of each new day.
+
+    Only one process can safely move the file. Under gunicorn, the main process runs a LogServer
+    on the Unix socket LOG_SOCKET (see gunicorn.conf.py) and is the only one that writes to it. The workers,
+    and scripts like check_date.py run while the website is up, send their records there instead.
+    Records are sent as JSON, never pickled, and the socket can only be opened by the user the website runs as.
+
+    Nothing is set up just by importing the app. create_app() (so run.py and wsgi.py), the gunicorn hooks
+    and check_date.py call configure_logging().
+"""
+import atexit
+import copy
+import datetime
+import errno
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SocketHandler
+from flask import g, request, session, has_request_context
+from app import app
+from config import LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS, LOG_REQUESTS, LOG_SOCKET
+
+FIELDS = ('user', 'route', 'method', 'status', 'subject', 'slot', 'latency_ms')
+SENT_FIELDS = ('name', 'levelno', 'levelname', 'msg', 'created', 'process', 'exc_text') + FIELDS
+
+request_logger = logging.getLogger('app.requests')
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a line of JSON."""
+
+    def format(self, record):
+        entry = {'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'process': record.process,
+                 'message': record.getMessage()}
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['error'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['error'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestQueueHandler(QueueHandler):
+    """Puts records on the queue, with the details of the request they were logged during.
+
+        The request is gone by the time the listener gets to the record, so this is the last chance.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if has_request_context():
+            if getattr(record, 'user', None) is None:
+                record.user = session.get('username')
+            record.route = request.endpoint
+            record.method = request.method
+            if 'request_started' in g:
+                record.latency_ms = round((time.perf_counter() - g.request_started) * 1000, 3)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class DailyRotatingFileHandler(RotatingFileHandler):
+    """A RotatingFileHandler that also starts a new file when the day changes."""
+
+    def __init__(self, filename, max_bytes, backups):
+        RotatingFileHandler.__init__(self, filename, maxBytes=max_bytes, backupCount=backups,
+                                     encoding='utf-8', delay=True)
+        if os.path.exists(filename):
+            self._day = datetime.date.fromtimestamp(os.path.getmtime(filename))
+        else:
+            self._day = datetime.date.today()
+
+    def shouldRollover(self, record):
+        if self._day != datetime.date.today() and os.path.exists(self.baseFilename) \
+                and os.path.getsize(self.baseFilename):
+            return 1
+        return RotatingFileHandler.shouldRollover(self, record)
+
+    def doRollover(self):
+        RotatingFileHandler.doRollover(self)
+        self._day = datetime.date.today()
+
+
+class JsonSocketHandler(SocketHandler):
+    """A SocketHandler that sends each record as a 4 byte length and then a JSON object, instead of a pickle."""
+
+    def makePickle(self, record):
+        entry = {field: getattr(record, field, None) for field in SENT_FIELDS}
+        entry['msg'] = record.getMessage()
+        data = json.dumps(entry, default=str).encode('utf-8')
+        return struct.pack('>L', len(data)) + data
+
+
+class _LogRecordReceiver(socketserver.StreamRequestHandler):
+    """Reads records sent by a JsonSocketHandler and logs them here."""
+
+    def handle(self):
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                return
+            length = struct.unpack('>L', header)[0]
+            try:
+                entry = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError:
+                return
+            if not isinstance(entry, dict):
+                return
+            record = logging.makeLogRecord({field: entry[field] for field in SENT_FIELDS
+                                            if entry.get(field) is not None})
+            logging.getLogger(record.name).handle(record)
+
+
+class LogServer(socketserver.ThreadingUnixStreamServer):
+    """Receives records from other processes and writes them with this process's log handlers.
+
+        The socket file is made readable and writable by its owner only.
+        Raises OSError (EADDRINUSE) if another LogServer is already listening at path,
+        i.e. a second gunicorn started from the same folder, rather than taking its socket.
+    """
+    daemon_threads = True
+
+    def __init__(self, path=LOG_SOCKET):
+        self._bound = False
+        socketserver.ThreadingUnixStreamServer.__init__(self, path, _LogRecordReceiver)
+
+    def server_bind(self):
+        if _server_running(self.server_address):
+            raise OSError(errno.EADDRINUSE, 'Another log server is already listening on', self.server_address)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)  # left behind by a server that didn't shut down
+        umask = os.umask(0o177)
+        try:
+            socketserver.ThreadingUnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        self._bound = True
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        socketserver.ThreadingUnixStreamServer.server_close(self)
+        if self._bound and os.path.exists(self.server_address):  # never another server's socket
+            os.remove(self.server_address)
+            self._bound = False
+
+
+def _server_running(path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(0.5)
+    try:
+        connection.connect(path)
+    except OSError:
+        return False
+    finally:
+        connection.close()
+    return True
+
+
+def start_log_server(path=LOG_SOCKET):
+    """Starts a LogServer in a background thread, and returns it."""
+    server = LogServer(path)
+    threading.Thread(target=server.serve_forever, name='log-server', daemon=True).start()
+    return server
+
+
+_listener = None
+_listener_pid = None
+
+
+def configure_logging(path=LOG_SOCKET):
+    """Sends the "app" loggers' records through a queue to the LogServer at path if one is running,
+        or straight to the log file otherwise.
+
+        Safe to call again, i.e. in a freshly started gunicorn worker, to replace the old setup.
+    """
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid != os.getpid():
+        for handler in _listener.handlers:  # inherited from the process this one was forked from
+            handler.close()
+    _stop_listener()
+
+    if path and _server_running(path):
+        target = JsonSocketHandler(path, None)  # no port means a Unix socket
+    else:
+        target = DailyRotatingFileHandler(LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS)
+        target.setFormatter(JsonFormatter())
+
+    records = queue.Queue(-1)
+    logger = logging.getLogger('app')
+    for handler in [handler for handler in logger.handlers if isinstance(handler, RequestQueueHandler)]:
+        logger.removeHandler(handler)
+    logger.addHandler(RequestQueueHandler(records))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    _listener = QueueListener(records, target)
+    _listener_pid = os.getpid()
+    _listener.start()
+
+
+@atexit.register
+def _stop_listener():
+    """Writes out whatever's still on the queue."""
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+@app.after_request
+def _log_request(response):
+    if LOG_REQUESTS and request.endpoint != 'static':
+        request_logger.info('{0} {1} {2}'.format(request.method, request.full_path.rstrip('?'), response.status_code),
+                            extra={'status': response.status_code})
+    return response
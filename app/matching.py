@@ -0,0 +1,218 @@
+"""In-memory index used to match students with tutors.
+
+    Instead of querying every tutor's calendars and subjects one by one,
+    the index loads them all at once and stores each tutor as two bitmasks:
+
+    availability - bit n is set when the tutor is free (Calendar 0) and
+                   not already booked (Calendar 1) during the nth slot of Calendar.sort_attrs()
+    subjects     - bit n is set when the tutor can tutor the nth subject column
+
+    An inverted index from subject column to tutors means a request only looks at
+    tutors of the right subject, and matching a student becomes a bitwise AND
+    per tutor.
+
+    The index is kept up to date with the DataVersion (see models.py), in any process. Every write to a
+    calendar, a subject table or a user type also stamps that user in TutorChange, so get_index()
+    only reloads the users changed since the version the index is at, on a copy of it.
+    Pairings and sessions don't change the index, so writing them only moves its version on.
+    It's only built from scratch the first time, after invalidate(), or when the periods or
+    subjects in config change.
+"""
+import copy
+import threading
+import time
+from .models import User, Calendar, Subjects, TutorWorkload, TutorChange, get_data_version
+from config import proto_labels
+
+
+def _count_bits(mask):
+    return bin(mask).count('1')
+
+
+class MatchingIndex(object):
+    """A snapshot of every tutor's availability and subjects, stored as bitmasks."""
+
+    def __init__(self, slots, subject_columns):
+        self.slots = slots
+        self.subject_columns = tuple(subject_columns)
+        self.slot_bits = {slot: 1 << i for (i, slot) in enumerate(slots)}
+        self.full_mask = (1 << len(slots)) - 1
+        self.subject_bits = {column: 1 << i for (i, column) in enumerate(subject_columns)}
+
+        self.usernames = {}  # uid -> username
+        self.availability = {}  # uid -> free and not booked slots
+        self.subject_masks = {}  # uid -> tutorable subjects
+        self.business = {}  # uid -> TutorWorkload.ratio, lower is less busy
+        self.by_subject = {column: frozenset() for column in subject_columns}  # subject -> uids
+
+        self.created = time.time()
+        self.version = None  # the DataVersion it's up to date with
+
+    @classmethod
+    def build(cls):
+        """Loads the DataVersion, every tutor, calendar, subject table and workload in five queries and builds the index."""
+        subject_columns = [column for category in Subjects.sort_attrs() for column in category]
+        index = cls(Calendar.sort_attrs(), subject_columns)
+        index.version = get_data_version()  # read first, so anything written while loading makes it out of date
+
+        added = index._add_tutors(User.query.filter_by(user_type=1).all())
+        index.by_subject = {column: frozenset(uids) for (column, uids) in added.items()}
+        return index
+
+    def updated(self, version):
+        """Returns a copy of the index brought up to version, with only the users changed since reloaded.
+
+            One query for the changed users (see models.TutorChange), and three more if any of them
+            are tutors now. The dictionaries are copied rather than changed, so requests still using
+            this index see it as it was.
+        """
+        changed = User.query.join(TutorChange, TutorChange.user_id == User.uid) \
+            .filter(TutorChange.version > self.version).all()
+        index = copy.copy(self)
+        index.version = version
+        if not changed:
+            return index
+
+        gone = {user.uid for user in changed}
+        for name in ('usernames', 'availability', 'subject_masks', 'business'):
+            setattr(index, name, {uid: value for (uid, value) in getattr(self, name).items() if uid not in gone})
+        added = index._add_tutors([user for user in changed if user.user_type == 1])
+        index.by_subject = dict(self.by_subject)
+        for (column, uids) in self.by_subject.items():
+            if added[column] or not gone.isdisjoint(uids):
+                index.by_subject[column] = (uids - gone) | added[column]
+        return index
+
+    def _add_tutors(self, tutors):
+        """Loads the tutors' calendars, subject tables and workloads in three queries, and adds them.
+
+            Tutors who haven't finished signing up are left out. Returns {subject column: {uid, ...}} of those added.
+        """
+        added = {column: set() for column in self.subject_columns}
+        uids = [tutor.uid for tutor in tutors]
+        if not uids:
+            return added
+
+        calendars = {}  # (uid, cal_type) -> Calendar, keeping the first like query_from_field does
+        for calendar in Calendar.query.filter(Calendar.tutor_id.in_(uids)).order_by(Calendar.id).all():
+            calendars.setdefault((calendar.tutor_id, calendar.cal_type), calendar)
+
+        subject_tables = {}
+        for table in Subjects.query.filter(Subjects.tutor_id.in_(uids)).order_by(Subjects.id).all():
+            subject_tables.setdefault(table.tutor_id, table)
+
+        ratios = dict(TutorWorkload.query.with_entities(TutorWorkload.user_id, TutorWorkload.ratio)
+                      .filter(TutorWorkload.user_id.in_(uids)).all())
+
+        for tutor in tutors:
+            free_cal = calendars.get((tutor.uid, 0))
+            table = subject_tables.get(tutor.uid)
+            if free_cal is None or table is None:
+                continue  # hasn't finished signing up, so can't be matched
+
+            free = self.calendar_mask(free_cal)
+            available_cal = calendars.get((tutor.uid, 1))
+            if available_cal is None:
+                available = self.full_mask  # create_pairing gives new calendars a 1 in every slot
+            else:
+                available = self.calendar_mask(available_cal)
+
+            subject_mask = 0
+            for column in self.subject_columns:
+                if getattr(table, column):
+                    subject_mask |= self.subject_bits[column]
+                    added[column].add(tutor.uid)
+
+            self.usernames[tutor.uid] = tutor.username
+            self.availability[tutor.uid] = free & available
+            self.subject_masks[tutor.uid] = subject_mask
+            if tutor.uid in ratios:
+                self.business[tutor.uid] = ratios[tutor.uid]
+            else:  # no workload row yet, count it the same way TutorWorkload does
+                booked = _count_bits(self.full_mask & ~available)
+                self.business[tutor.uid] = booked / (_count_bits(free) + 1)
+        return added
+
+    def calendar_mask(self, calendar):
+        """Returns a bitmask with a bit set for every slot that is 1 in the calendar."""
+        mask = 0
+        for slot in self.slots:
+            if getattr(calendar, slot):
+                mask |= self.slot_bits[slot]
+        return mask
+
+    def day_mask(self, label):
+        """Returns a bitmask of every slot on the day with the given label (M, T, W...)."""
+        mask = 0
+        for slot in self.slots:
+            if slot.startswith(label):
+                mask |= self.slot_bits[slot]
+        return mask
+
+    def match(self, subject, student_mask, exclude=None):
+        """Returns {slot: [uid, uid...]} of every tutor of subject who is available when the student is.
+
+            subject is the database column name, i.e. "Algebra1".
+            exclude is a uid to leave out, so tutors aren't matched with themselves.
+        """
+        matches = {}
+        for uid in self.by_subject.get(subject, ()):
+            if uid == exclude:
+                continue
+            shared = self.availability[uid] & student_mask
+            if not shared:
+                continue
+            for slot in self.slots:
+                if shared & self.slot_bits[slot]:
+                    matches.setdefault(slot, []).append(uid)
+
+        return {slot: matches[slot] for slot in self.slots if slot in matches}  # keep the schedule order
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def _same_layout(index):
+    """Returns False if the periods or subjects in config have changed since the index was built."""
+    return index.slots == Calendar.sort_attrs() and \
+        index.subject_columns == tuple(column for category in Subjects.sort_attrs() for column in category)
+
+
+def _behind(index, version):
+    return index is None or index.version < version or not _same_layout(index)
+
+
+def get_index(version=None):
+    """Returns the current MatchingIndex, brought up to version (from models.get_data_version, read here if not given).
+
+        Only builds it from scratch if there isn't one or the layout changed, otherwise just the users
+        changed since are reloaded (see MatchingIndex.updated).
+    """
+    global _index
+    if version is None:
+        version = get_data_version()
+    index = _index
+    if _behind(index, version):
+        with _lock:
+            index = _index
+            if index is None or not _same_layout(index):
+                index = MatchingIndex.build()
+            elif index.version < version:
+                index = index.updated(version)
+            _index = index
+    return index
+
+
+def invalidate():
+    """Throws away the current index, so the next get_index builds it from scratch.
+
+        Writes through the ORM, and ones that call models.mark_users_changed, don't need this.
+    """
+    global _index
+    _index = None
+
+
+def weekday_label(date):
+    """Returns the calendar label (M, T, W...) of the day the date falls on."""
+    return proto_labels[date.weekday()]
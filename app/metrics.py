@@ -0,0 +1,341 @@
+"""Counts requests, SQL queries and a few app events, and shows them in Prometheus' text format at /metrics.
+
+    The SQL query count for the current request is kept on flask.g, so it starts at 0 for
+    every request. When the app is in debug or testing mode it's also sent back in the
+    X-Query-Count header, so tests can assert on how many queries a page needs.
+
+    Everything else is added up in memory: a few dictionary updates per request and per
+    query, nothing is formatted until somebody asks for /metrics. Each process counts on
+    its own. Under gunicorn, the main process calls share_between_processes() before starting
+    the workers, and each worker then saves its numbers to a file of its own in METRICS_DIR, at
+    most every METRICS_SAVE_INTERVAL seconds. /metrics adds up every worker's file, so a scrape
+    sees the same totals whichever worker answers. Files of workers that have stopped are kept,
+    so the totals never go backwards. check_date.py runs as its own process, so its runs are
+    recorded in the JobRun table instead, and the outbox is counted from the database,
+    both only when /metrics is read.
+
+    Set METRICS_ENABLED to 0 in config.py to turn the counting off.
+"""
+import atexit
+import copy
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app, db
+from .models import JobRun, OutboundEmail
+from config import METRICS_ENABLED, METRICS_BUCKETS, METRICS_DIR, METRICS_SAVE_INTERVAL
+
+
+def _label_text(names, values):
+    """Returns the {name="value",...} part of a sample line."""
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in values)
+    return '{' + ','.join('{0}="{1}"'.format(name, value) for (name, value) in zip(names, escaped)) + '}'
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    """A number that only goes up, one per combination of label values."""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}  # (label value, ...) -> total
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def samples(self):
+        """Returns [(name, label names, label values, value)]."""
+        with self._lock:
+            return [(self.name, self.labels, values, total) for (values, total) in sorted(self._values.items())]
+
+    def snapshot(self):
+        """Returns the values as [[label values], value] pairs that can be saved as JSON."""
+        with self._lock:
+            return [[list(values), copy.copy(value)] for (values, value) in self._values.items()]
+
+    def combined(self, snapshots):
+        """Returns a copy of this metric with every snapshot (from other processes) added on."""
+        total = copy.copy(self)
+        total._lock = threading.Lock()
+        total._values = {}
+        for snapshot in [self.snapshot()] + list(snapshots):
+            for (values, value) in snapshot:
+                values = tuple(values)
+                total._values[values] = total._add(total._values.get(values), value)
+        return total
+
+    @staticmethod
+    def _add(current, value):
+        return (current or 0) + value
+
+
+class Gauge(Counter):
+    """A number that can go up and down. Only used for values read fresh at each scrape."""
+    kind = 'gauge'
+
+    def set(self, value, *values):
+        with self._lock:
+            self._values[values] = value
+
+
+class Histogram(Counter):
+    """Counts observations (i.e. seconds a request took) into buckets, one set per combination of label values."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=METRICS_BUCKETS):
+        Counter.__init__(self, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *values):
+        with self._lock:
+            counts = self._values.get(values)
+            if counts is None:
+                counts = self._values[values] = [0] * (len(self.buckets) + 1) + [0.0]  # buckets, +Inf, sum
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @staticmethod
+    def _add(current, value):
+        if current is None:
+            return list(value)
+        return [a + b for (a, b) in zip(current, value)]
+
+    def samples(self):
+        labels = self.labels + ('le',)
+        samples = []
+        with self._lock:
+            for (values, counts) in sorted(self._values.items()):
+                running = 0
+                for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+                    running += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append((self.name + '_bucket', labels, values + (le,), running))
+                samples.append((self.name + '_sum', self.labels, values, counts[-1]))
+                samples.append((self.name + '_count', self.labels, values, running))
+        return samples
+
+
+class Registry(object):
+    """The metrics /metrics shows."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, extra=(), snapshots=()):
+        """Returns every metric in Prometheus' text format.
+
+            extra is more metrics to add, made just for this scrape. snapshots is [{metric name: snapshot}],
+            the numbers of other processes to add on.
+        """
+        metrics = self.metrics
+        if snapshots:
+            metrics = [metric.combined(snapshot[metric.name] for snapshot in snapshots if metric.name in snapshot)
+                       for metric in metrics]
+        lines = []
+        for metric in list(metrics) + list(extra):
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            for (name, labels, values, value) in metric.samples():
+                lines.append('{0}{1} {2}'.format(name, _label_text(labels, values), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+requests_total = registry.add(Counter('tutoring_http_requests_total', 'Requests handled.',
+                                      ('endpoint', 'method', 'status')))
+request_seconds = registry.add(Histogram('tutoring_http_request_duration_seconds', 'Time taken to handle a request.',
+                                         ('endpoint',)))
+sql_queries_total = registry.add(Counter('tutoring_sql_queries_total', 'SQL statements run, by the endpoint that ran them.',
+                                         ('endpoint',)))
+sql_seconds_total = registry.add(Counter('tutoring_sql_duration_seconds_total',
+                                         'Time spent running SQL statements, by the endpoint that ran them.',
+                                         ('endpoint',)))
+pairings_total = registry.add(Counter('tutoring_create_pairing_total', 'Times tutors were looked up for a student.'))
+emails_total = registry.add(Counter('tutoring_emails_total', 'Emails this process tried to deliver, by result.',
+                                    ('result',)))
+started = time.time()
+
+_shared_dir = None  # set by share_between_processes
+_last_saved = 0
+_save_timer = None  # the save waiting to happen, so there's only ever one
+_save_lock = threading.Lock()
+
+
+def share_between_processes(folder=METRICS_DIR):
+    """Makes every process forked after this save its numbers in folder, and /metrics add them all up.
+
+        Run it once in the main process before the workers start (gunicorn.conf.py does).
+        Files left from the last time the website ran are deleted.
+    """
+    global _shared_dir
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for path in glob.glob(os.path.join(folder, '*.json')):
+        os.remove(path)
+    _shared_dir = folder
+
+
+def save_metrics():
+    """Writes this process's numbers to its file in the shared folder, if there is one."""
+    global _last_saved
+    if _shared_dir is None:
+        return
+    _last_saved = time.time()
+    data = {metric.name: metric.snapshot() for metric in registry.metrics}
+    handle, temp_path = tempfile.mkstemp(dir=_shared_dir, prefix='.', suffix='.tmp')
+    with os.fdopen(handle, 'w') as temp:
+        json.dump(data, temp)
+    os.replace(temp_path, os.path.join(_shared_dir, '{0}.json'.format(os.getpid())))
+
+
+def _save_soon():
+    """Saves within METRICS_SAVE_INTERVAL seconds, and at most once in that time, however many requests come in."""
+    global _save_timer
+    with _save_lock:
+        if _save_timer is None:
+            _save_timer = threading.Timer(max(0, _last_saved + METRICS_SAVE_INTERVAL - time.time()), _timed_save)
+            _save_timer.daemon = True
+            _save_timer.start()
+
+
+def _timed_save():
+    global _save_timer
+    with _save_lock:
+        _save_timer = None
+    save_metrics()
+
+
+def _other_processes():
+    """Returns [{metric name: snapshot}] from every other process's file."""
+    if _shared_dir is None:
+        return []
+    mine = os.path.join(_shared_dir, '{0}.json'.format(os.getpid()))
+    snapshots = []
+    for path in glob.glob(os.path.join(_shared_dir, '*.json')):
+        if path == mine:
+            continue
+        try:
+            with open(path) as saved:
+                snapshots.append(json.load(saved))
+        except (OSError, ValueError):
+            continue  # removed or being replaced right now
+    return snapshots
+
+
+def _endpoint():
+    """The endpoint of the current request, or "none" outside of one (the outbox worker, check_date.py...)."""
+    if has_request_context():
+        return request.endpoint or 'none'
+    return 'none'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = getattr(g, 'query_count', 0) + 1
+    if METRICS_ENABLED:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _time_query(conn, cursor, statement, parameters, context, executemany):
+    if METRICS_ENABLED and conn.info.get('query_started'):
+        seconds = time.perf_counter() - conn.info['query_started'].pop()
+        endpoint = _endpoint()
+        sql_queries_total.inc(endpoint)
+        sql_seconds_total.inc(endpoint, amount=seconds)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _forget_query(context):
+    """A statement that fails never gets to after_cursor_execute, so its start time is dropped here."""
+    started_at = context.connection.info.get('query_started') if context.connection is not None else None
+    if started_at:
+        started_at.pop()
+
+
+def query_count():
+    """Returns how many queries the current request has run so far."""
+    return getattr(g, 'query_count', 0)
+
+
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _add_query_count(response):
+    if METRICS_ENABLED and 'request_started' in g:
+        endpoint = request.endpoint or 'none'
+        requests_total.inc(endpoint, request.method, str(response.status_code))
+        request_seconds.observe(time.perf_counter() - g.request_started, endpoint)
+    if app.debug or app.testing:
+        response.headers['X-Query-Count'] = str(query_count())
+    if _shared_dir is not None:
+        _save_soon()
+    return response
+
+
+@atexit.register
+def _save_on_exit():
+    save_metrics()
+
+
+def record_job_run(name, seconds):
+    """Adds a run of a script like check_date.py to the JobRun table. Commits."""
+    job = JobRun.query.get(name)
+    if job is None:
+        job = JobRun(name)
+        db.session.add(job)
+    job.runs += 1
+    job.last_run = datetime.utcnow()
+    job.last_seconds = seconds
+    db.session.commit()
+
+
+def render_metrics():
+    """Returns the text for /metrics. Reads the JobRun table and counts the outbox, two queries."""
+    start_time = Gauge('tutoring_process_start_time_seconds', 'When this process started, as a unix timestamp.')
+    start_time.set(started)
+
+    outbox = Gauge('tutoring_outbox_emails', 'Emails in the outbox, by status.', ('status',))
+    for (status, count) in db.session.query(OutboundEmail.status, db.func.count(OutboundEmail.id)) \
+            .group_by(OutboundEmail.status):
+        outbox.set(count, status)
+
+    job_runs = Counter('tutoring_job_runs_total', 'Times each script has run.', ('job',))
+    last_run = Gauge('tutoring_job_last_run_timestamp_seconds', 'When each script last ran, as a unix timestamp.',
+                     ('job',))
+    last_seconds = Gauge('tutoring_job_last_duration_seconds', 'How long each script took the last time it ran.',
+                         ('job',))
+    for job in JobRun.query.order_by(JobRun.name):
+        job_runs.inc(job.name, amount=job.runs)
+        last_run.set((job.last_run - datetime(1970, 1, 1)).total_seconds(), job.name)
+        last_seconds.set(job.last_seconds, job.name)
+
+    return registry.render([start_time, outbox, job_runs, last_run, last_seconds], _other_processes())
@@ -1,9 +1,13 @@
 """Database stuff."""
 from app import db
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask import session
+from sqlalchemy import event, select, inspect
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm.collections import attribute_mapped_collection
+from flask import session, g, has_request_context
 from datetime import datetime, timedelta
-from config import periods, subjects, labels, days_attended, subject_names, proto_labels, period_names, proto_attended
+from .schema import get_schema
+from .passwords import hasher
+from config import subject_names, proto_labels, proto_attended
 
 ROLE_USER = 0   
 ROLE_TUTOR = 1
@@ -20,6 +24,8 @@ class QueryMixin(object):
     @classmethod
     def query_from_cookie(cls):
         if hasattr(cls, 'username'):
+            if has_request_context():
+                return get_current_user()
             return cls.query.filter_by(username=session['username']).first()
         else:
             return None
@@ -67,10 +73,14 @@ class User(db.Model, QueryMixin):
     username = db.Column(db.String(100), unique=True)
     user_type = db.Column(db.Integer)
     email = db.Column(db.String(120))
-    pwdhash = db.Column(db.String(54))
+    pwdhash = db.Column(db.String(255))
     calendars = db.relationship('Calendar', backref='tutor', lazy='dynamic')
     subjects = db.relationship('Subjects', backref='tutor', lazy='dynamic')
 
+    # The same rows as plain lists, so get_current_user can load them along with the user
+    all_calendars = db.relationship('Calendar', viewonly=True, order_by='Calendar.id')
+    all_subjects = db.relationship('Subjects', viewonly=True, order_by='Subjects.id')
+
 
     def __init__(self, username, password, user_type, email):
         self.username = username.title()
@@ -84,45 +94,72 @@ class User(db.Model, QueryMixin):
 
     def set_password(self, password):
         """Salts and hashes password."""
-        self.pwdhash = generate_password_hash(password)
+        self.pwdhash = hasher.hash(password)
 
     def check_password(self, password):
-        """Checks the password against the database."""
-        return check_password_hash(self.pwdhash, password)
+        """Checks the password against the database.
+
+            If it's right, but was stored with different settings than config.py has now,
+            it's stored again with the new ones.
+        """
+        if not hasher.verify(self.pwdhash, password):
+            return False
+        if hasher.needs_rehash(self.pwdhash):
+            self.set_password(password)
+            db.session.commit()
+        return True
 
     def get_calendar_0(self):
         """Returns the user's free periods calendar, if it exists."""
-        return Calendar.query_from_field(tutor=self, cal_type=0)
+        return self._get_calendar(0)
 
     def get_calendar_1(self):
         """Returns the user's schedule calendar, if it exists."""
-        return Calendar.query_from_field(tutor=self, cal_type=1)
+        return self._get_calendar(1)
+
+    def _get_calendar(self, cal_type):
+        if 'all_calendars' in self.__dict__:  # already loaded, see get_current_user
+            for calendar in self.all_calendars:
+                if calendar.cal_type == cal_type:
+                    return calendar
+            return None
+        return Calendar.query_from_field(tutor=self, cal_type=cal_type)
 
     def get_subjects(self):
         """Returns the subject table associated with the user."""
+        if 'all_subjects' in self.__dict__:
+            return self.all_subjects[0] if self.all_subjects else None
         return Subjects.query_from_field(tutor=self)
 
     def get_business_value(self):
         """Returns a ratio of free periods and available periods.
 
             Used to rank the relative busy-ness of tutors.
+            The value is kept up to date in TutorWorkload whenever a calendar changes.
         """
-        free_cal = self.get_calendar_0() # when you're theoretically free
-        available_cal = self.get_calendar_1() # when you're actually available
+        workload = TutorWorkload.query.get(self.uid)
+        if workload is None:
+            refresh_workload([self.uid])
+            workload = TutorWorkload.query.get(self.uid)
+        return workload.ratio
 
-        attrs = Calendar.sort_attrs()
-        free = 1
-        available = 0
-        for attr in attrs:
-            free_value = getattr(free_cal, attr)
-            available_value = getattr(available_cal, attr)
-            if free_value:
-                free += 1
-            if not available_value:
-                available += 1
 
-        ratio = available/free
-        return ratio
+def get_current_user():
+    """Returns the logged in User, or None.
+
+        The user is only looked up once per request, and their calendars (with every period)
+        and subjects are loaded in the same query, so get_calendar_0, get_calendar_1 and
+        get_subjects don't need queries of their own. Changes are seen as usual after a commit,
+        which expires everything loaded.
+    """
+    username = session.get('username')
+    if username is None:
+        return None
+    if g.get('current_username') != username:
+        g.current_user = User.query.options(joinedload(User.all_calendars), joinedload(User.all_subjects)) \
+            .filter_by(username=username).first()
+        g.current_username = username
+    return g.current_user
 
 
 class Subjects(db.Model, IterMixin, QueryMixin):
@@ -147,7 +184,7 @@ class Subjects(db.Model, IterMixin, QueryMixin):
         for (i, subject) in enumerate(attrs):
             category_list = []
             for (n, course) in enumerate(subject):
-                if dict(self)[course]:
+                if getattr(self, course):
                     category_list.append(n)
                 categories.append(category_list)
 
@@ -160,37 +197,41 @@ class Subjects(db.Model, IterMixin, QueryMixin):
         for (i, subject) in enumerate(attrs):
             category_list = []
             for (n, course) in enumerate(subject):
-                if dict(self)[course]:
+                if getattr(self, course):
                     category_list.append(n)
                 categories[subject_names[i]] = category_list
 
         return categories
 
+    @classmethod
+    def get_attrs(cls):
+        """Return the name of every subject column."""
+        return get_schema().subject_list
+
     @classmethod
     def sort_attrs(cls):
-        """Takes a list of attributes and sorts them as in config."""
-        final_list = []
-        for subject in subjects:
-            buffer = []
-            for (i, course) in enumerate(subject):
-                for attr in cls.get_attrs():
-                    if attr == course.replace(" ", ""):
-                        buffer.insert(i, attr)
-            final_list.append(buffer)
-        return final_list
+        """Returns the subject columns grouped by category, sorted as in config."""
+        return get_schema().subject_columns
 
 
 
 class Calendar(db.Model, IterMixin, QueryMixin):
     """Database of tutor's schedules.
 
-        Some of the database construction had to be generalized, and so could not be done
-        explicitly in this class. Instead, in data.py, a function defines it implicitly using
-        setattr.
+        Every period still reads and writes like an attribute (calendar.M1, calendar.M1_date),
+        but the values are stored in CalendarSlot rows rather than a column per period.
+        The attributes are properties added by update_calendar() in data.py based on config.
+
+        Only periods that differ from the calendar's default get a row:
+        cal_type 0 (free periods) defaults to 0, so a row means the user is free.
+        cal_type 1 (availability) defaults to 1, so a row means the user is booked. It stays until they have
+        no TutoringSession left in that period (see expire_bookings in data.py).
     """
     id = db.Column(db.Integer, primary_key=True)
     tutor_id = db.Column(db.Integer, db.ForeignKey('users.uid'))
     cal_type = db.Column(db.Integer)
+    slot_rows = db.relationship('CalendarSlot', backref='calendar', lazy='joined', cascade='all, delete-orphan',
+                                collection_class=attribute_mapped_collection('slot'))
 
     def __init__(self, tutor, cal_type=0): # 0: user defined calendar, 1: availability
         self.tutor = tutor  # Tutor can be any user (student, tutor, admin), despite the name
@@ -209,6 +250,36 @@ class Calendar(db.Model, IterMixin, QueryMixin):
 
         return "\n".join(iteratable)
 
+    def __iter__(self):
+        for attr in self.sort_attrs():
+            yield attr, self.get_slot(attr)
+
+    def get_slot(self, attr):
+        """Returns the 1 or 0 stored for a period."""
+        default = 0 if self.cal_type == 0 else 1
+        if attr in self.slot_rows:
+            return 1 - default
+        return default
+
+    def set_slot(self, attr, value):
+        """Stores a 1 or 0 for a period, adding or removing its CalendarSlot row."""
+        default = 0 if self.cal_type == 0 else 1
+        if bool(value) == bool(default):
+            self.slot_rows.pop(attr, None)
+        elif attr not in self.slot_rows:
+            self.slot_rows[attr] = CalendarSlot(slot=attr)
+
+    def get_slot_date(self, attr):
+        """Returns the expiration date stored for a period, if any."""
+        row = self.slot_rows.get(attr)
+        return row.expires if row is not None else None
+
+    def set_slot_date(self, attr, date):
+        """Stores an expiration date for a period. Periods at their default value have no date."""
+        row = self.slot_rows.get(attr)
+        if row is not None:
+            row.expires = date
+
     def get_date(self, attr):
         """Returns the date variable associated with an attribute attr."""
         return getattr(self, attr+'_date')
@@ -240,8 +311,7 @@ class Calendar(db.Model, IterMixin, QueryMixin):
 
     def check_expiration(self):
         """Checks the expiration on every attribute, and sets the attr to 1 if it's past the date."""
-        attrs = [attr for attr in self.sort_attrs()]
-        for attr in attrs:
+        for attr in self.sort_attrs():
             if getattr(self, attr+'_date'):
                 try:
                     if datetime.utcnow().date() > self.get_date(attr):
@@ -253,131 +323,67 @@ class Calendar(db.Model, IterMixin, QueryMixin):
 
     def check_weekday(self):
         """Checks if today is the same day that a user is busy, returns a list of tuples (user, attr)."""
-        attrs = [attr for attr in self.sort_attrs()]
+        schema = get_schema()
         final = []
-        for attr in attrs:
+        for attr in self.sort_attrs():
             if getattr(self, attr+'_date'):
                 if datetime.utcnow().weekday() == self.get_date(attr).weekday():
-                    period = attr[1]
-                    if period == 'B':
-                        period = 'Before School'
-                    elif period == 'A':
-                        period = 'After School'
-                    else:
-                        try:
-                            period = period_names[int(period) - 1]
-                        except TypeError:
-                            print('period name did not include an integer. {0}'.format(period))
-                    final.append(period)
+                    final.append(schema.pairing_periods[schema.slot_labels[attr].number])
         return final
 
 
 
     def get_data_list(self):
         """Returns a list of lists of data."""
-        categories = []
-        attrs = self.sort_attrs()
-        for (i, label) in enumerate(labels):
-            day_list = []
-            for attr in attrs:
-                if attr.startswith(label):
-                    if dict(self)[attr]:
-                        if attr.endswith('B'):
-                            day_list.append(0)
-                        elif attr.endswith('A'):
-                            day_list.append(periods[i]+1)
-                        else:
-                            day_list.append(int(attr[-1]))
-            categories.append(day_list)
-        return categories
+        schema = get_schema()
+        return [[schema.slot_days[attr][1] for attr in day if getattr(self, attr)] for day in schema.day_slots]
 
     def get_data_dict(self, weeks=0):
         """Returns a dictionary of lists of the data."""
+        schema = get_schema()
         categories = {}
-        attrs = self.sort_attrs()
-        for (i, label) in enumerate(labels):
-            day_list = []
-            for attr in attrs:
-                if attr.startswith(label):
-                    if dict(self)[attr]:
-                        if attr.endswith('B'):
-                            day_list.append(0)
-                        elif attr.endswith('A'):
-                            day_list.append(periods[i]+1)
-                        else:
-                            day_list.append(int(attr[-1]))
-                    categories[days_attended[i]] = day_list
-
+        for day in schema.day_slots:
+            day_name = schema.slot_days[day[0]][0]
+            categories[day_name] = [schema.slot_days[attr][1] for attr in day if getattr(self, attr)]
         return categories
 
+    @classmethod
+    def get_attrs(cls):
+        """Return the name of every period column (not including the _date columns)."""
+        return get_schema().slots
+
     @classmethod
     def sort_attrs(cls):
-        """Returns every available period, sorted, as one list.
+        """Returns every available period, sorted, as one tuple.
 
-        i.e. [MB, M1, M2, MA, TB, T1, T2... FA]
+        i.e. (MB, M1, M2, MA, TB, T1, T2... FA)
         """
-        M = []
-        T = []
-        W = []
-        R = []
-        F = []
-        S = []
-        U = []
-
-        day_dict = {'M': M, 'T': T, 'W': W, 'R': R, 'F': F, 'S': S, 'U': U}
-
-        for attr in cls.get_attrs():
-            for letter in labels:
-                if str(attr).startswith(letter):
-                    if str(attr).endswith('B'):
-                        day_dict[letter].insert(0, attr)
-                    elif str(attr).endswith('A'):
-                        day_dict[letter].append(attr)
-                    else:
-                        index = int(str(attr)[-1])
-                        day_dict[letter].insert(index, attr)
-
-        final_list = []
-        # print('--')
-        for letter in labels:
-            for i in day_dict[letter]:
-                # print(i)
-                final_list.append(i)
-        # print('--')
-        return final_list
+        return get_schema().slots
 
     @classmethod
     def get_attrs_list(cls):
-        """Returns every available period sorted into lists of lists.
+        """Returns every available period sorted into tuples of tuples.
 
-        i.e. [[MB, M1, M2, MA], [TB, T1, TA]]
+        i.e. ((MB, M1, M2, MA), (TB, T1, TA))
         """
-        M = []
-        T = []
-        W = []
-        R = []
-        F = []
-        S = []
-        U = []
-
-        day_dict = {'M': M, 'T': T, 'W': W, 'R': R, 'F': F, 'S': S, 'U': U}
-
-        for attr in cls.get_attrs():
-            for letter in labels:
-                if str(attr).startswith(letter):
-                    if str(attr).endswith('B'):
-                        day_dict[letter].insert(0, attr)
-                    elif str(attr).endswith('A'):
-                        day_dict[letter].append(attr)
-                    else:
-                        index = int(str(attr)[-1])
-                        day_dict[letter].insert(index, attr)
-
-        final_list = []
-        for letter in labels:
-            if day_dict[letter]:
-                final_list.append(day_dict[letter])
-        return final_list
+        return get_schema().day_slots
+
+
+class CalendarSlot(db.Model):
+    """A single period of a Calendar that isn't at the calendar's default value.
+
+        Keyed by the period's name (MB, M1, ... FA) rather than its position, so adding or
+        removing periods in config doesn't scramble existing calendars.
+        expires is only kept for the old calendar.M1_date attributes. Bookings end when their sessions do.
+    """
+    __tablename__ = 'calendar_slot'
+    id = db.Column(db.Integer, primary_key=True)
+    calendar_id = db.Column(db.Integer, db.ForeignKey('calendar.id'), nullable=False)
+    slot = db.Column(db.String(4), nullable=False)
+    expires = db.Column(db.Date)
+
+    __table_args__ = (db.UniqueConstraint('calendar_id', 'slot'),
+                      db.Index('ix_calendar_slot_slot_expires', 'slot', 'expires'))
 
 
 class StudentTutorPairings(db.Model, IterMixin):
@@ -395,6 +401,8 @@ class StudentTutorPairings(db.Model, IterMixin):
     day = db.Column(db.String)
     period = db.Column(db.Integer)
 
+    __table_args__ = (db.Index('ix_stp_active_date_day_period', 'active', 'date', 'day', 'period'),)
+
     def __init__(self, student, tutor, subject, date, period):
         self.student = student
         self.tutor = tutor
@@ -410,5 +418,324 @@ class StudentTutorPairings(db.Model, IterMixin):
             self.student, self.tutor, self.subject, self.date)
 
     def deactivate(self):
-        if datetime.now() < self.date:
-            self.active = 0
\ No newline at end of file
+        if self.date < datetime.utcnow().date():
+            self.active = 0
+
+
+class TutoringSession(db.Model):
+    """One date a pairing meets, with a row for the student and a row for the tutor.
+
+        A pairing booked for several weeks has a pair of rows for every week (see data.py's book_sessions).
+        The unique (date, slot, user_id) index stops anybody being booked twice for the same period,
+        and is what conflicts, reminders and the master schedule are looked up by.
+        role is "student" or "tutor".
+    """
+    __tablename__ = 'tutoring_session'
+    id = db.Column(db.Integer, primary_key=True)
+    pairing_id = db.Column(db.Integer, db.ForeignKey('student_tutor_pairings.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.uid'), nullable=False)
+    role = db.Column(db.String(8))
+    date = db.Column(db.Date, nullable=False)
+    slot = db.Column(db.String(4), nullable=False)
+    pairing = db.relationship('StudentTutorPairings', backref='sessions')
+
+    __table_args__ = (db.UniqueConstraint('date', 'slot', 'user_id', name='uq_session_date_slot_user'),
+                      db.Index('ix_tutoring_session_user_slot_date', 'user_id', 'slot', 'date'))
+
+    def __init__(self, user_id, role, date, slot):
+        self.user_id = user_id
+        self.role = role
+        self.date = date
+        self.slot = slot
+
+    def __repr__(self):
+        return "<TutoringSession {0} {1}, User: {2} ({3})>".format(self.date, self.slot, self.user_id, self.role)
+
+
+class OutboundEmail(db.Model, QueryMixin):
+    """An email waiting to be sent, or already sent, by the outbox worker (see outbox.py).
+
+        status is one of:
+        pending - waiting to be sent, no earlier than next_attempt
+        sending - claimed by a worker until next_attempt, after which another worker can claim it again
+        sent - delivered
+        dead - gave up after EMAIL_MAX_ATTEMPTS tries, last_error says why
+    """
+    __tablename__ = 'outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    recipients = db.Column(db.Text)  # comma separated
+    message = db.Column(db.Text)  # the whole email, headers included
+    status = db.Column(db.String(10))
+    attempts = db.Column(db.Integer)
+    next_attempt = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created = db.Column(db.DateTime)
+    sent = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index('ix_outbox_status_next_attempt', 'status', 'next_attempt'),)
+
+    def __init__(self, recipient_list, message):
+        self.recipients = ', '.join(recipient_list)
+        self.message = message
+        self.status = 'pending'
+        self.attempts = 0
+        self.created = datetime.utcnow()
+        self.next_attempt = self.created
+
+    def __repr__(self):
+        return "<Email to: {0}, Status: {1}, Attempts: {2}>".format(self.recipients, self.status, self.attempts)
+
+    def get_recipient_list(self):
+        return [recipient.strip() for recipient in self.recipients.split(',') if recipient.strip()]
+
+
+class Shortlist(db.Model):
+    """A list of tutors offered to a student, kept until they pick one (see shortlist.py).
+
+        data is the create_pairing() result as JSON.
+    """
+    token = db.Column(db.String(32), primary_key=True)
+    owner = db.Column(db.String)
+    data = db.Column(db.Text)
+    expires = db.Column(db.DateTime, index=True)
+
+    def __init__(self, token, owner, data, expires):
+        self.token = token
+        self.owner = owner
+        self.data = data
+        self.expires = expires
+
+    def __repr__(self):
+        return "<Shortlist for: {0}, Expires: {1}>".format(self.owner, self.expires)
+
+
+class PendingRequest(db.Model):
+    """A student waiting for a tutor, matched when an admin runs a batch (see batch.py).
+
+        subject is the database column name, i.e. "Algebra1". status is pending or matched.
+        Each student has at most one pending request.
+    """
+    __tablename__ = 'pending_request'
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('users.uid'), index=True)
+    subject = db.Column(db.String)
+    created = db.Column(db.DateTime)
+    status = db.Column(db.String(16), index=True)
+    matched = db.Column(db.DateTime)
+
+    def __init__(self, student_id, subject):
+        self.student_id = student_id
+        self.subject = subject
+        self.created = datetime.utcnow()
+        self.status = 'pending'
+
+    def __repr__(self):
+        return "<PendingRequest from: {0}, Subject: {1}, Status: {2}>".format(self.student_id, self.subject,
+                                                                             self.status)
+
+
+class JobRun(db.Model):
+    """Counts the runs of a script like check_date.py, which runs outside the website, for /metrics."""
+    __tablename__ = 'job_run'
+    name = db.Column(db.String(32), primary_key=True)
+    runs = db.Column(db.Integer)
+    last_run = db.Column(db.DateTime)
+    last_seconds = db.Column(db.Float)
+
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+
+    def __repr__(self):
+        return "<JobRun {0}, Runs: {1}, Last: {2}>".format(self.name, self.runs, self.last_run)
+
+
+class DataVersion(db.Model):
+    """A counter that goes up whenever calendars, subjects, user types or pairings change (see bump_data_version).
+
+        Anything worked out from those, like the /api/availability results, can be cached
+        for as long as the version stays the same, in any process.
+    """
+    __tablename__ = 'data_version'
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, name, version=0):
+        self.name = name
+        self.version = version
+
+    def __repr__(self):
+        return "<DataVersion {0}: {1}>".format(self.name, self.version)
+
+
+class TutorWorkload(db.Model):
+    """Stores how busy each user is, so tutors can be ranked without reading their calendars.
+
+        free_slots - periods ticked in the free periods calendar (Calendar 0)
+        booked_slots - periods already taken in the availability calendar (Calendar 1)
+        ratio - booked_slots / (free_slots + 1), lower is less busy
+
+        Rows are refreshed automatically whenever a Calendar is flushed, which covers
+        pairings being created (Calendar.set_0) and expiring (Calendar.set_1).
+    """
+    __tablename__ = 'workload'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.uid'), primary_key=True)
+    free_slots = db.Column(db.Integer)
+    booked_slots = db.Column(db.Integer)
+    ratio = db.Column(db.Float, index=True)
+
+
+def _count_workload(free_cal, available_cal):
+    """Returns (free_slots, booked_slots, ratio) for a user's two calendars, either of which may be None."""
+    free = 0
+    booked = 0
+    for attr in Calendar.sort_attrs():
+        if free_cal is not None and getattr(free_cal, attr):
+            free += 1
+        if available_cal is not None and not getattr(available_cal, attr):
+            booked += 1
+    return free, booked, booked / (free + 1)
+
+
+def refresh_workload(uids=None, session=None):
+    """Recomputes TutorWorkload for the given user ids, or for every user if uids is None."""
+    session = session or db.session()
+    with session.no_autoflush:
+        query = Calendar.query.with_session(session).order_by(Calendar.id)
+        if uids is not None:
+            uids = list(uids)
+            if not uids:
+                return
+            query = query.filter(Calendar.tutor_id.in_(uids))
+
+        calendars = {}  # (uid, cal_type) -> Calendar, keeping the first like query_from_field does
+        for calendar in query.all():
+            calendars.setdefault((calendar.tutor_id, calendar.cal_type), calendar)
+        if uids is None:
+            uids = {uid for (uid, cal_type) in calendars}
+
+        rows = []
+        for uid in uids:
+            free, booked, ratio = _count_workload(calendars.get((uid, 0)), calendars.get((uid, 1)))
+            rows.append({'user_id': uid, 'free_slots': free, 'booked_slots': booked, 'ratio': ratio})
+
+    table = TutorWorkload.__table__
+    connection = session.connection()
+    connection.execute(table.delete().where(table.c.user_id.in_(list(uids))))
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_workload(session, flush_context):
+    """Keeps TutorWorkload in step with every Calendar written in the flush."""
+    uids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, CalendarSlot):
+            obj = obj.calendar
+        if isinstance(obj, Calendar) and obj.tutor_id is not None:
+            uids.add(obj.tutor_id)
+    if uids:
+        refresh_workload(uids, session=session)
+
+
+class TutorChange(db.Model):
+    """The DataVersion a user's calendars, subjects or user type last changed at.
+
+        Written in the same transaction as the change (see mark_users_changed), so a MatchingIndex
+        built from an older DataVersion can reload just these users instead of everybody (see matching.py).
+    """
+    __tablename__ = 'tutor_change'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.uid'), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<TutorChange {0}: {1}>".format(self.user_id, self.version)
+
+
+VERSIONED = (Calendar, CalendarSlot, Subjects, StudentTutorPairings, TutoringSession)
+
+
+def get_data_version(session=None):
+    """Returns the current DataVersion, 0 if nothing has been written since it was added. One query."""
+    session = session or db.session()
+    table = DataVersion.__table__
+    version = session.connection().execute(
+        select([table.c.version]).where(table.c.name == 'availability')).scalar()
+    return version or 0
+
+
+def bump_data_version(session=None):
+    """Adds 1 to the DataVersion, as part of the session's transaction. Doesn't commit.
+
+        The ORM does this by itself when it flushes (see _mark_data_changed), this is for writes
+        that go around it, like the bulk UPDATEs and DELETEs in data.py's expire_bookings.
+    """
+    session = session or db.session()
+    table = DataVersion.__table__
+    connection = session.connection()
+    bumped = connection.execute(table.update().where(table.c.name == 'availability')
+                                .values(version=table.c.version + 1))
+    if not bumped.rowcount:
+        connection.execute(table.insert(), {'name': 'availability', 'version': 1})
+    session.info['data_version_bumped'] = True
+
+
+def mark_users_changed(uids, session=None):
+    """Stamps the users with the current DataVersion in TutorChange, as part of the session's transaction.
+
+        Call it after bump_data_version, for writes that go around the ORM and change calendars,
+        subjects or user types. Doesn't commit. Two statements, whatever the number of users.
+    """
+    uids = sorted({uid for uid in uids if uid is not None})
+    if not uids:
+        return
+    session = session or db.session()
+    table = TutorChange.__table__
+    versions = DataVersion.__table__
+    version = select([versions.c.version]).where(versions.c.name == 'availability').as_scalar()
+    connection = session.connection()
+    connection.execute(table.delete().where(table.c.user_id.in_(uids)))
+    connection.execute(table.insert().from_select(['user_id', 'version'],
+                                                  select([User.uid, version]).where(User.uid.in_(uids))))
+    session.info.setdefault('users_changed', set()).update(uids)
+
+
+def _changed_user(obj, session):
+    """Returns the uid whose place in the matching index obj changes, or None."""
+    if isinstance(obj, (Calendar, Subjects)):
+        return obj.tutor_id
+    if isinstance(obj, CalendarSlot):
+        return obj.calendar.tutor_id if obj.calendar is not None else None  # a removed row's Calendar is dirty too
+    if isinstance(obj, User) and (obj in session.new or inspect(obj).attrs.user_type.history.has_changes()):
+        return obj.uid
+    return None
+
+
+@event.listens_for(Session, 'after_flush')
+def _mark_data_changed(session, flush_context):
+    """Bumps the DataVersion, at most once a transaction, when a flush writes anything availability depends on,
+        and stamps the users whose calendars, subjects or user type it wrote (see mark_users_changed).
+
+        For users, only a change of user type counts (becoming a tutor), not logging in or changing passwords.
+        Pairings and sessions bump the version, but don't change anybody's place in the matching index.
+    """
+    changed = set()
+    versioned = False
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        uid = _changed_user(obj, session)
+        if uid is not None:
+            changed.add(uid)
+        versioned = versioned or uid is not None or isinstance(obj, VERSIONED)
+    if not versioned:
+        return
+    if not session.info.get('data_version_bumped'):
+        bump_data_version(session)
+    mark_users_changed(changed - session.info.get('users_changed', set()), session)
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _reset_data_changed(session):
+    session.info.pop('data_version_bumped', None)
+    session.info.pop('users_changed', None)
@@ -0,0 +1,176 @@
+"""Sends email in the background so pages never wait on the mail server.
+
+    Views call queue_email / queue_many, which only add OutboundEmail rows to the database.
+    A worker then delivers them:
+
+    - start_worker() runs one in a background thread of the web server (run.py does this)
+    - outbox_worker.py runs one as a separate process
+    - deliver_pending() delivers whatever is due right now, up to a limit, and deliver_all()
+      keeps calling it until nothing is left, check_date.py calls that
+
+    Rows are claimed with a conditional UPDATE before sending, so several workers can
+    run at once without sending anything twice. A claim lasts EMAIL_SENDING_TIMEOUT seconds,
+    after which another worker picks the row up again, so emails claimed by a worker that
+    died aren't stuck as "sending" forever. Failed sends are retried with
+    exponential backoff (EMAIL_RETRY_DELAY, doubled every attempt) and marked dead after
+    EMAIL_MAX_ATTEMPTS. Admins can see the state of the outbox at /outbox.
+"""
+import threading
+import logging
+from datetime import datetime, timedelta
+from smtplib import SMTPException
+from app import app, db
+from .models import OutboundEmail
+from .metrics import emails_total
+from .emailing import transport, build_message, build_bulk_message, chunk_recipients, confirmation_message
+from config import EMAIL_MAX_ATTEMPTS, EMAIL_RETRY_DELAY, EMAIL_WORKER_POLL, EMAIL_SENDING_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+_wake = threading.Event()  # set when something is queued, so a sleeping worker starts right away
+_worker = None
+
+
+def queue_email(recipients, message=confirmation_message, **kwargs):
+    """Queues an email. Takes the same arguments as emailing.send_email."""
+    return queue_many([(recipients, message, kwargs)])
+
+
+def queue_many(batch):
+    """Queues [(recipients, message, kwargs), ...] and commits."""
+    emails = [OutboundEmail(*build_message(recipients, message, **kwargs)) for (recipients, message, kwargs) in batch]
+    db.session.add_all(emails)
+    db.session.commit()
+    _wake.set()
+    return emails
+
+
+def queue_bulk(recipients, message):
+    """Queues one message for many recipients, as one email per BCC batch (see emailing.send_bulk).
+
+        The message is rendered once and shared by every batch.
+    """
+    body = build_bulk_message(message)
+    emails = [OutboundEmail(batch, body) for batch in chunk_recipients(recipients)]
+    db.session.add_all(emails)
+    db.session.commit()
+    _wake.set()
+    return emails
+
+
+def _claim(email, now):
+    """Marks an email as sending until EMAIL_SENDING_TIMEOUT from now. Returns False if another worker got there first.
+
+        Only succeeds if the row hasn't changed since it was loaded, which covers two workers
+        picking up the same abandoned "sending" row too.
+    """
+    table = OutboundEmail.__table__
+    result = db.session.execute(table.update()
+                                .where(table.c.id == email.id)
+                                .where(table.c.status == email.status)
+                                .where(table.c.next_attempt == email.next_attempt)
+                                .values(status='sending',
+                                        next_attempt=now + timedelta(seconds=EMAIL_SENDING_TIMEOUT)))
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def deliver_pending(limit=100):
+    """Sends every email that's due, up to limit, and any whose worker gave out part way. Returns (sent, failed)."""
+    now = datetime.utcnow()
+    due = OutboundEmail.query.filter(OutboundEmail.status.in_(('pending', 'sending')),
+                                     OutboundEmail.next_attempt <= now) \
+        .order_by(OutboundEmail.next_attempt).limit(limit).all()
+
+    sent = failed = 0
+    for email in due:
+        abandoned = email.status == 'sending'
+        if not _claim(email, now):
+            continue
+        if abandoned:
+            logger.warning('Emailing {0} again, the worker sending it stopped part way'.format(email.recipients))
+        db.session.refresh(email)
+        email.attempts += 1
+        try:
+            refused = transport.send_many([(email.get_recipient_list(), email.message)])
+            error = refused[0][1] if refused else None
+        except (SMTPException, OSError) as e:
+            error = e
+
+        if error is None:
+            email.status = 'sent'
+            email.sent = datetime.utcnow()
+            email.last_error = None
+            sent += 1
+            emails_total.inc('sent')
+        else:
+            email.last_error = repr(error)
+            if email.attempts >= EMAIL_MAX_ATTEMPTS:
+                email.status = 'dead'
+                logger.error('Gave up emailing {0}: {1}'.format(email.recipients, email.last_error))
+            else:
+                email.status = 'pending'
+                email.next_attempt = datetime.utcnow() + timedelta(seconds=EMAIL_RETRY_DELAY * 2 ** (email.attempts - 1))
+            failed += 1
+            emails_total.inc('dead' if email.status == 'dead' else 'failed')
+        db.session.commit()
+
+    return sent, failed
+
+
+def deliver_all(limit=100):
+    """Calls deliver_pending until nothing is due, limit emails at a time. Returns (sent, failed) for them all.
+
+        Every email it handles is either sent, dead or not due again until its retry, so this always stops.
+    """
+    sent = failed = 0
+    while True:
+        (batch_sent, batch_failed) = deliver_pending(limit)
+        if not batch_sent and not batch_failed:
+            return sent, failed
+        sent += batch_sent
+        failed += batch_failed
+
+
+def run_worker(stop=None):
+    """Delivers email until stop (a threading.Event) is set, checking at least every EMAIL_WORKER_POLL seconds."""
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        with app.app_context():
+            try:
+                deliver_pending()
+            except Exception:
+                logger.exception('Outbox worker failed')
+                db.session.rollback()
+            finally:
+                db.session.remove()
+        _wake.wait(EMAIL_WORKER_POLL)
+        _wake.clear()
+
+
+def start_worker():
+    """Starts a background thread that delivers queued email. Does nothing if one is already running."""
+    global _worker
+    if _worker is None or not _worker.is_alive():
+        _worker = threading.Thread(target=run_worker, name='outbox-worker', daemon=True)
+        _worker.start()
+    return _worker
+
+
+def get_status():
+    """Returns ({status: count}, [recent emails that failed or gave up]) for the admin page."""
+    counts = dict(db.session.query(OutboundEmail.status, db.func.count(OutboundEmail.id))
+                  .group_by(OutboundEmail.status).all())
+    problems = OutboundEmail.query.filter(OutboundEmail.last_error.isnot(None),
+                                          OutboundEmail.status != 'sent') \
+        .order_by(OutboundEmail.id.desc()).limit(50).all()
+    return counts, problems
+
+
+def retry_dead():
+    """Puts every dead email back in the queue. Returns how many."""
+    count = OutboundEmail.query.filter_by(status='dead') \
+        .update({'status': 'pending', 'attempts': 0, 'next_attempt': datetime.utcnow()})
+    db.session.commit()
+    _wake.set()
+    return count
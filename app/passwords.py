@@ -0,0 +1,42 @@
+"""Hashes and checks passwords with the settings in config.py.
+
+    Hashing is slow on purpose, so a rush of logins at the start of term is mostly spent here.
+    Checks run in a pool of PASSWORD_WORKERS threads, so only that many happen at once in each
+    process and the rest of the request threads stay free to serve pages.
+    (hashlib lets go of the GIL while it hashes, so the pool's threads really do run alongside them.)
+
+    When the settings change, old hashes keep working. needs_rehash tells User.check_password
+    to store the password again with the new settings the next time that user logs in.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+from config import PASSWORD_METHOD, PASSWORD_ITERATIONS, PASSWORD_SALT_LENGTH, PASSWORD_WORKERS
+
+
+class PasswordHasher(object):
+    """Hashes with one method, iteration count and salt length, and checks hashes made with any."""
+
+    def __init__(self, method=PASSWORD_METHOD, iterations=PASSWORD_ITERATIONS, salt_length=PASSWORD_SALT_LENGTH,
+                 workers=PASSWORD_WORKERS):
+        self.method = '{0}:{1}'.format(method, iterations)  # i.e. pbkdf2:sha256:150000
+        self.salt_length = salt_length
+        self._pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+
+    def hash(self, password):
+        return generate_password_hash(password, method=self.method, salt_length=self.salt_length)
+
+    def verify(self, pwdhash, password):
+        """Returns True if the password matches the hash, waiting for a free worker if they're all busy."""
+        if self._pool is None:
+            return check_password_hash(pwdhash, password)
+        return self._pool.submit(check_password_hash, pwdhash, password).result()
+
+    def needs_rehash(self, pwdhash):
+        """Returns True if the hash was made with different settings than this hasher uses."""
+        if pwdhash.count('$') != 2:
+            return True
+        method, salt, hashval = pwdhash.split('$')
+        return method != self.method or len(salt) != self.salt_length
+
+
+hasher = PasswordHasher()
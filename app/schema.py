@@ -0,0 +1,74 @@
+"""The layout of the Calendar and Subjects tables, worked out once.
+
+    The period and subject columns are generated from config.py by update_calendar() and
+    update_subjects() in data.py, which rebuild this registry when they run.
+    Everything here is a tuple or a read-only mapping, so it can be shared freely
+    between requests without being copied.
+
+    slots - every period, sorted, as one tuple. i.e. (MB, M1, M2, MA, TB, T1, ... FA)
+    day_slots - the same periods grouped by day. i.e. ((MB, M1, M2, MA), (TB, T1, TA))
+    slot_days - slot -> (day name, period number), where before school is 0
+                and after school is the number of periods + 1. i.e. {"M2": ("Monday", 2)}
+    slot_labels - slot -> SlotLabel, everything needed to show a period to people. i.e. {"M3": SlotLabel(
+                  day="Monday", period="3rd", name="3rd Period", display="Monday 3rd", number=4)}
+                  number is the period as stored in StudentTutorPairings: 0 for before school,
+                  -1 for after school, and the period number + 1 otherwise.
+    pairing_periods - StudentTutorPairings.period -> name. i.e. {0: "Before School", 4: "3rd", -1: "After School"}
+    subject_columns - subject columns grouped by category, in config order.
+                      i.e. (("Algebra1", "Geometry"), ("English9", ...))
+    subject_list - the same subject columns as one tuple
+"""
+from collections import namedtuple
+from types import MappingProxyType
+from config import periods, labels, days_attended, subjects, period_names
+
+Schema = namedtuple('Schema', ['slots', 'day_slots', 'slot_days', 'slot_labels', 'pairing_periods',
+                               'subject_columns', 'subject_list'])
+
+SlotLabel = namedtuple('SlotLabel', ['day', 'period', 'name', 'display', 'number'])
+
+_schema = None
+
+
+def build_schema():
+    """Works out the table layout from config and stores it as the current schema."""
+    global _schema
+
+    day_slots = []
+    slot_days = {}
+    slot_labels = {}
+    pairing_periods = {0: "Before School", -1: "After School"}
+    for (i, label) in enumerate(labels):
+        day = [label + 'B'] + [label + str(n + 1) for n in range(periods[i])] + [label + 'A']
+        for (number, slot) in enumerate(day):
+            slot_days[slot] = (days_attended[i], number)
+            if number == 0:
+                slot_labels[slot] = SlotLabel(days_attended[i], "Before", "Before School",
+                                              days_attended[i] + " Before", 0)
+            elif number == len(day) - 1:
+                slot_labels[slot] = SlotLabel(days_attended[i], "After", "After School",
+                                              days_attended[i] + " After", -1)
+            else:
+                period = period_names[number - 1]
+                slot_labels[slot] = SlotLabel(days_attended[i], period, period + " Period",
+                                              days_attended[i] + " " + period, number + 1)
+                pairing_periods[number + 1] = period
+        day_slots.append(tuple(day))
+
+    subject_columns = tuple(tuple(course.replace(" ", "") for course in category) for category in subjects)
+
+    _schema = Schema(slots=tuple(slot for day in day_slots for slot in day),
+                     day_slots=tuple(day_slots),
+                     slot_days=MappingProxyType(slot_days),
+                     slot_labels=MappingProxyType(slot_labels),
+                     pairing_periods=MappingProxyType(pairing_periods),
+                     subject_columns=subject_columns,
+                     subject_list=tuple(column for category in subject_columns for column in category))
+    return _schema
+
+
+def get_schema():
+    """Returns the current schema, building it the first time it's needed."""
+    if _schema is None:
+        return build_schema()
+    return _schema
@@ -0,0 +1,98 @@
+"""Keeps the tutors offered to a student between /tutor-request and /tutor-selection.
+
+    The list used to live in the session cookie, which meant signing it and sending it
+    back and forth on every request until the student picked somebody. Now it's kept
+    on the server, and the cookie only holds a short random token.
+
+    Shortlists are kept in memory, the most recently used SHORTLIST_CACHE_SIZE of them,
+    and forgotten after SHORTLIST_TTL seconds. With SHORTLIST_IN_DATABASE they're also
+    written to the Shortlist table, so any process can find them (i.e. under gunicorn,
+    where the next request may go to a different worker).
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import session
+from app import db
+from .models import Shortlist
+from config import SHORTLIST_TTL, SHORTLIST_CACHE_SIZE, SHORTLIST_IN_DATABASE
+
+
+class ShortlistStore(object):
+    """An LRU cache of shortlists with a time limit, optionally backed by the database."""
+
+    def __init__(self, size=SHORTLIST_CACHE_SIZE, ttl=SHORTLIST_TTL, in_database=SHORTLIST_IN_DATABASE):
+        self.size = size
+        self.ttl = ttl
+        self.in_database = in_database
+        self._cache = OrderedDict()  # token -> (owner, shortlist, expires), least recently used first
+        self._lock = threading.Lock()
+
+    def put(self, owner, shortlist):
+        """Stores the shortlist and returns its token."""
+        token = uuid.uuid4().hex
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._cache[token] = (owner, shortlist, expires)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+        if self.in_database:
+            now = datetime.utcnow()
+            Shortlist.query.filter(Shortlist.expires < now).delete(synchronize_session=False)
+            db.session.add(Shortlist(token, owner, json.dumps(shortlist), now + timedelta(seconds=self.ttl)))
+            db.session.commit()
+        return token
+
+    def get(self, token, owner):
+        """Returns the shortlist, or None if it's expired, unknown, or belongs to somebody else."""
+        with self._lock:
+            entry = self._cache.get(token)
+            if entry is not None:
+                self._cache.move_to_end(token)
+
+        if entry is None and self.in_database:
+            row = Shortlist.query.get(token)
+            if row is not None:
+                expires = time.time() + (row.expires - datetime.utcnow()).total_seconds()
+                entry = (row.owner, json.loads(row.data), expires)
+                with self._lock:
+                    self._cache[token] = entry
+
+        if entry is None or entry[0] != owner or entry[2] < time.time():
+            return None
+        return entry[1]
+
+    def discard(self, token):
+        """Forgets the shortlist."""
+        with self._lock:
+            self._cache.pop(token, None)
+        if self.in_database:
+            Shortlist.query.filter_by(token=token).delete(synchronize_session=False)
+            db.session.commit()
+
+
+store = ShortlistStore()
+
+
+def save_shortlist(shortlist):
+    """Stores the logged in user's shortlist, replacing any earlier one, and puts its token in their cookie."""
+    discard_shortlist()
+    session['shortlist'] = store.put(session['username'], shortlist)
+
+
+def load_shortlist():
+    """Returns the logged in user's shortlist, or None if they don't have one (or it's expired)."""
+    if 'shortlist' not in session:
+        return None
+    return store.get(session['shortlist'], session['username'])
+
+
+def discard_shortlist():
+    """Forgets the logged in user's shortlist."""
+    token = session.pop('shortlist', None)
+    if token is not None:
+        store.discard(token)
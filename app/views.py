@@ -10,30 +10,41 @@
     Comments for what each particular route does are included in that route.
 """
 from app import app, db
-from flask import render_template, flash, redirect, url_for, session, request
+from flask import render_template, flash, redirect, url_for, session, request, Response, stream_with_context, \
+    make_response, jsonify
 from sqlalchemy.exc import IntegrityError
+import datetime
 import time
+import hashlib
+import hmac
 import logging
-import csv
-from smtplib import SMTPAuthenticationError
 import string
 import random
 from .forms import LoginForm, StudentRegisterForm, TutorRegisterForm, ChangePasswordForm, OfficialPasswordResetForm, \
-    FreePeriodsForm, SubjectForm, TutorRequestForm, create_tutor_selection_form, AdminRegisterForm, MassEmailForm
-from .models import User, Calendar, Subjects, StudentTutorPairings
-from .emailing import send_email, password_change_message, confirmation_message, tutor_message, student_message
-from .data import create_pairing
-from config import periods, subjects as config_subjects, get_homepage_text, tutoring_head, period_names, \
-    allow_password_reset, subject_names
-
-#Logger information to print things to the log file efficiently.
-logging.basicConfig(level=logging.INFO)
+    FreePeriodsForm, SubjectForm, TutorRequestForm, create_tutor_selection_form, AdminRegisterForm, MassEmailForm, \
+    RetryEmailsForm, BatchAssignForm
+from .models import User, Calendar, Subjects, get_current_user, get_data_version
+from .emailing import password_change_message, confirmation_message, tutor_message, student_message
+from .outbox import queue_email, queue_many, queue_bulk, get_status as get_outbox_status, retry_dead
+from .data import create_pairing, is_still_available, session_dates, book_sessions, get_week_grid, get_schedule_grid, get_subject_recipients, _jinja2_datetime_filter
+from .schema import get_schema
+from .shortlist import save_shortlist, load_shortlist, discard_shortlist
+from .export import iter_csv
+from .metrics import render_metrics
+from .batch import add_pending_request, fulfil_pending_request, count_pending, batch_assign
+from .availability import find_subject, make_etag, get_availability
+from config import periods, subjects as config_subjects, get_homepage, get_homepage_text, tutoring_head, \
+    allow_password_reset, METRICS_TOKEN
+
+#Where things are written to the log file is set up in logs.py.
 logger = logging.getLogger(__name__)
-hdlr = logging.FileHandler('log.txt')
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-hdlr.setFormatter(formatter)
-logger.addHandler(hdlr)
-logger.setLevel(logging.INFO)
+
+@app.before_request
+def load_current_user():
+    """Looks up the logged in user, with their calendars and subjects, once for the whole request."""
+    if request.endpoint != 'static':
+        get_current_user()
+
 
 def if_logged_out():
     flash('Please log in')
@@ -48,11 +59,36 @@ def check_login():
         return redirect(url_for('login'))
 
 
+_started = time.time()
+_anonymous_index = {}  # homepage_text.txt modified time -> (html, etag)
+
+
 @app.route('/')
 @app.route('/index')
 def index():
-    """Render the homepage, with body text dependent upon the homepage_text.txt in the app."""
-    return render_template("index.html", title='Home', bodytext=get_homepage_text())
+    """Render the homepage, with body text dependent upon the homepage_text.txt in the app.
+
+        Everybody who isn't logged in sees the same page, so it's only rendered again when
+        homepage_text.txt changes, and browsers that already have it get a 304 instead.
+    """
+    if 'username' in session or '_flashes' in session:
+        return render_template("index.html", title='Home', bodytext=get_homepage_text())
+
+    text, modified = get_homepage()
+    cached = _anonymous_index.get(modified)
+    if cached is None:
+        html = render_template("index.html", title='Home', bodytext=text)
+        cached = (html, hashlib.md5(html.encode('utf-8')).hexdigest())
+        _anonymous_index.clear()
+        _anonymous_index[modified] = cached
+    html, etag = cached
+
+    response = make_response(html)
+    response.set_etag(etag)
+    response.last_modified = max(modified, _started)  # the templates may have changed when the site restarted
+    response.cache_control.no_cache = True  # always check, the page is different once logged in
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
 
 
 
@@ -119,11 +155,7 @@ def register():
             flash('Registration Successful!')
             session['username'] = newuser.username
 
-            try:
-                send_email([newuser.email], message=confirmation_message, username=newuser.username)
-
-            except SMTPAuthenticationError:
-                flash('Sending email failed')
+            queue_email([newuser.email], message=confirmation_message, username=newuser.username)
 
             return redirect(url_for('profile'))
 
@@ -370,7 +402,7 @@ def subjects():
 def profile():
     """The profile page. Also shows the signed in user's schedule for this week.
 
-        For more information about the schedule, see profile.html
+        The schedule is built here by data.py's get_week_grid(), profile.html only displays it.
     """
     if check_login():
         if_logged_out()
@@ -380,7 +412,7 @@ def profile():
     if user is None:
         return redirect(url_for('login'))
     else:
-        return render_template('profile.html', title="My Profile", schedule=None)
+        return render_template('profile.html', title="My Profile", schedule=get_week_grid(user))
 
 
 @app.route('/logout')
@@ -420,7 +452,7 @@ def change_password():
 
             crypto = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(8))
 
-            send_email([user_email], message=password_change_message, code=crypto)
+            queue_email([user_email], message=password_change_message, code=crypto)
             flash('Password Email sent!')
             logger.info('Sent password reset email to {username} at {email}'.format(username=user.username,
                                                                                     email=user.email))
@@ -473,6 +505,7 @@ def tutorrequest():
     """Shows a dropdown with every subject, then redirects to a page with tutors.
 
         Tutors are chosen via data.py's create_pairing() function.
+        If there aren't any, the student is put on the waiting list for the admins' batch (see batch.py).
     """
     if check_login():
         if_logged_out()
@@ -481,7 +514,7 @@ def tutorrequest():
     user = User.query_from_cookie()
     form = TutorRequestForm()
 
-    if user.calendars.filter_by(cal_type=0).first() is None:
+    if user.get_calendar_0() is None:
         flash('Please submit your schedule so we can match you with a tutor who is free when you are.')
         return redirect(url_for('change_periods'))
 
@@ -490,9 +523,17 @@ def tutorrequest():
             return render_template("tutor request.html", title="Request Tutor", form=form)
 
         else:
-            session['tutor list'] = create_pairing(form.subject_request.data)
+            shortlist = create_pairing(form.subject_request.data)
             logger.info('user {username} requested tutor in {subject}'.format(username=user.username,
-                                                                              subject=form.subject_request.data))
+                                                                              subject=form.subject_request.data),
+                        extra={'subject': form.subject_request.data})
+            if not shortlist:
+                # Nobody's free right now, so they wait for the next batch an admin runs
+                add_pending_request(user, form.subject_request.data.replace(" ", ""))
+                flash("We're sorry. There are no tutors for that subject available when you are right now. "
+                      "You've been added to the waiting list, and you'll get an email when you're matched.")
+                return redirect(url_for('profile'))
+            save_shortlist(shortlist)
             return redirect(url_for('tutorselection'))
 
 
@@ -506,19 +547,22 @@ def tutorselection():
 
         Once the user chooses, the user and the selected tutor are both emailed, and have their second calendar
         change that period to 0, to show that they are both busy that day and period.
+        They can book just the next week, or the same time every week for a number of weeks or until a date,
+        which adds a TutoringSession for each week (see data.py's book_sessions).
     """
     if check_login():
         if_logged_out()
         return check_login()
 
-    if 'tutor list' not in session:
+    shortlist = load_shortlist()
+    if shortlist is None:
         flash("Please request a tutor")
         return redirect(url_for('tutorrequest'))
 
-    form = create_tutor_selection_form()
+    form = create_tutor_selection_form(shortlist)
 
     if not form:
-        session.pop('tutor list', None)
+        discard_shortlist()
         flash("We're sorry. There are no tutors for that subject available when you are. "
               "Please contact {0}.".format(tutoring_head))
         return redirect(url_for('profile'))
@@ -528,74 +572,100 @@ def tutorselection():
             return render_template('tutor selection.html', title='Select Tutor', form=form)
 
         else:
-            new_user_cal_1 = User.query_from_cookie().get_calendar_1()
+            new_user = User.query_from_cookie()
+            new_user_cal_1 = new_user.get_calendar_1()
+            slot_labels = get_schema().slot_labels
+            emails = []
+
+            # Every week from the next one, for as many weeks as they asked for
+            dates = {key: session_dates(new_user_cal_1.get_next_weekday(key).date(), form.weeks.data, form.until.data)
+                     for key in form.potential_tutors.data}
 
+            # The shortlist may be a few minutes old, so make sure nobody has been booked since.
             for key in form.potential_tutors.data:
-                tutor = User.query_from_field(username=session['tutor list'][key][1])
-                tutor_cal_1 = tutor.get_calendar_1()
-                new_user_cal_1.set_0(key)
-                tutor_cal_1.set_0(key)
-
-                date_dict = {'M': 'Monday', 'T': 'Tuesday', 'W': 'Wednesday',
-                             'R': 'Thursday', 'F': 'Friday', 'S': 'Saturday', 'U': 'Sunday'}
-
-                period_names.insert(0, 'Before School')
-                period_names.append('After School')
-
-                subject = session['tutor list'][key][2]
-                date_precurser = session['tutor list'][key][3]  # MB, T3, etc.
-                date_name = date_dict[date_precurser[0]]  # Monday, Wednesday, etc.
-                date = tutor_cal_1.get_next_weekday(date_precurser).date()
-
-                date_string = date_name + " " + str(date)
-
-                if date_precurser[1] != 'B' and date_precurser[1] != 'A':
-                    period = str(period_names[int(date_precurser[1])]) + " Period"  # 3rd Period
-                    period_for_stp = int(date_precurser[1]) + 1
-                elif date_precurser[1] == 'B':
-                    period = period_names[0]  # Before School
-                    period_for_stp = 0
-                else:
-                    period = period_names[-1]  # After School
-                    period_for_stp = -1
-
-                logger.info('{student} to be tutored by {tutor} in {subject}, {period} on {date}'.format(
-                    student=User.query_from_cookie().username, tutor=tutor.username, subject=subject,
-                    period=period, date=date_string))
-
-                new_pairing = StudentTutorPairings(User.query_from_cookie().username, tutor.username, subject, date,
-                                                   period_for_stp)
-                db.session.add(new_pairing)
-
-                try:
-                    send_email([tutor.email], tutor_message, student=User.query_from_cookie().username,
-                                                        subject=subject, date=date_string, period_number=period,
-                                                        email=User.query_from_cookie().email)
-
-                    send_email([User.query_from_cookie().email], student_message, tutor=tutor.username,
-                                                        subject=subject, date=date_string, period_number=period,
-                                                        email=tutor.email)
-                except SMTPAuthenticationError:
-                    flash('Sending email failed')
-                    logger.error('Email sending failed')
+                if not is_still_available(new_user, User.query_from_field(username=shortlist[key][1]), key,
+                                          dates[key]):
+                    discard_shortlist()
+                    flash("Sorry, that time is no longer available. Please request a tutor again.")
+                    return redirect(url_for('tutorrequest'))
 
-            db.session.commit()
+            try:
+                for key in form.potential_tutors.data:
+                    tutor = User.query_from_field(username=shortlist[key][1])
+                    subject = shortlist[key][2]
+                    slot = shortlist[key][3]  # MB, T3, etc.
+                    label = slot_labels[slot]
+                    book_sessions(new_user_cal_1, tutor.get_calendar_1(), subject, slot, dates[key])
+                    fulfil_pending_request(new_user, subject)  # so a batch doesn't book them another tutor
+
+                    date_string = label.day + " " + str(dates[key][0])  # Monday 2016-05-02
+                    if len(dates[key]) > 1:
+                        date_string += ", and every week until " + str(dates[key][-1])
+                    period = label.name  # 3rd Period, Before School...
+
+                    logger.info('{student} to be tutored by {tutor} in {subject}, {period} on {date}'.format(
+                        student=new_user.username, tutor=tutor.username, subject=subject,
+                        period=period, date=date_string), extra={'subject': subject, 'slot': slot})
+
+                    emails.append(([tutor.email], tutor_message,
+                                   dict(student=new_user.username, subject=subject, date=date_string,
+                                        period_number=period, email=new_user.email)))
+                    emails.append(([new_user.email], student_message,
+                                   dict(tutor=tutor.username, subject=subject, date=date_string,
+                                        period_number=period, email=tutor.email)))
 
-            # Removes the inserted values so that they aren't inserted every time this runs.
-            period_names.remove("Before School")
-            period_names.remove("After School")
+                db.session.commit()
+            except IntegrityError:
+                # Somebody else booked that tutor for the same period between showing the list and now.
+                db.session.rollback()
+                discard_shortlist()
+                flash("Sorry, that tutor was just booked by someone else. Please request a tutor again.")
+                return redirect(url_for('tutorrequest'))
+
+            queue_many(emails)
 
-            session.pop('tutor list', None)
+            discard_shortlist()
             return redirect(url_for('profile'))
     elif request.method == 'GET':
         return render_template('tutor selection.html', title='Select Tutor', form=form)
 
 
+@app.route('/api/availability', methods=['GET'])
+def availability_api():
+    """JSON of the periods ?subject= (i.e. "Algebra 1") can be tutored in for the logged in student, and by whom.
+
+        Doesn't book or save anything, see availability.py. Sends an ETag, and a 304 if the
+        client already has this answer, after just looking up the user and the data version.
+    """
+    if 'username' not in session:
+        return make_response(jsonify(error='Please log in'), 401)
+    user = User.query_from_cookie()
+    if user is None:
+        return make_response(jsonify(error='Please log in'), 401)
+    subject = find_subject(request.args.get('subject'))
+    if subject is None:
+        return make_response(jsonify(error='Unknown subject'), 400)
+
+    version = get_data_version()
+    today = datetime.date.today()
+    etag = make_etag(version, today.isoformat(), user.uid, subject)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(get_availability(user, subject, version, today))
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # always check, it's different for every student
+    response.vary.add('Cookie')
+    return response
+
+
 @app.route('/schedule', methods=['GET'])
 def schedule():
     """Renders a master schedule for the week. - accessible by admins only.
 
-        Also creates a CSV file of all the student tutor pairings.
+        ?weeks=n shows the week n weeks from this one (negative for past weeks).
+
+        The CSV of every pairing can be downloaded from /schedule.csv
     """
     if 'username' not in session:
         flash('Please log in to continue')
@@ -605,29 +675,39 @@ def schedule():
         flash('You must be an admin to see the master schedule')
         return redirect(url_for('profile'))
 
-    csv_array = [["student", "tutor", "subject", "date", "active"]]
-    for pairing in StudentTutorPairings.query.all():
-        row = [pairing.student, pairing.tutor, pairing.subject, pairing.date_str, pairing.active]
-        csv_array.append(row)
+    weeks = request.args.get('weeks', 0, type=int)  # 0 is this week, -1 last week, 1 next week...
+    monday = _jinja2_datetime_filter(weeks)
+    grid = get_schedule_grid(monday, active_only=weeks >= 0)  # past weeks show what happened, even if expired
+
+    return render_template('schedule.html', title="Master Schedule", schedule=grid, weeks=weeks, monday=monday)
+
+@app.route('/schedule.csv', methods=['GET'])
+def export_schedule():
+    """Downloads every student tutor pairing as a CSV file. - accessible by admins only.
+
+        The rows are streamed as they're read from the database, so the whole history
+        never has to fit in memory.
+    """
+    if 'username' not in session:
+        flash('Please log in to continue')
+        return redirect(url_for('login'))
+
+    if User.query_from_cookie().user_type != 2:
+        flash('You must be an admin to see the master schedule')
+        return redirect(url_for('profile'))
 
-    with open('StudentTutorPairings.csv', 'w') as STP:
-        writer = csv.writer(STP)
-        for row in csv_array:
-            writer.writerow(row)
+    return Response(stream_with_context(iter_csv()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=StudentTutorPairings.csv'})
 
-    return render_template('schedule.html', title="Master Schedule")
 
 @app.route('/mass-email', methods=['GET', 'POST'])
 def mass_email():
     """Allows to send emails to any targeted group of students/tutors
 
         First identifies the subjects checked in the form,
-        Then sorts those ticked boxes into a dictionary of lists,
-        Then compares the values in each list of that dictionary
-            to the values in each corresponding list of each tutor's
-            dictionary,
-        Finally it makes a list of the emails of every tutor who tutors
-        the subject required.
+        Then finds the email of every tutor who tutors any of them in one query,
+        Finally it queues one copy of the email, sent to the tutors in BCC batches
+        of MASS_EMAIL_BATCH_SIZE by the outbox worker, so the page returns right away.
     """
 
     if 'username' not in session:
@@ -644,61 +724,89 @@ def mass_email():
         if not form.validate_on_submit():
             return render_template("mass email.html", title="Mass Email", form=form)
         else:
-            subject_list = []
+            columns = []  # the database column of every ticked subject
             y = 0
             for field in form:
                 if field.type not in ["HiddenField", "CSRFTokenField", "TextAreaField"]:
-                    for i in range(len(config_subjects[y])):
-                        counted = False
-                        for point in field.data:
-                            if point == i:
-                                subject_list.append(1)
-                                counted = True
-                        else:
-                            if counted is False:
-                                subject_list.append(0)
+                    for i in field.data:
+                        columns.append(Subjects.sort_attrs()[y][i])
                     y += 1
 
-            # creates a dict of lists to line up with user.subjects layout
-            transition_dict = {}
-            for i in range(len(config_subjects)):
-                subsection = []
-                for x in range(len(config_subjects[i])):
-                    subsection.append(subject_list[0])
-                    subject_list.pop(0)
-                transition_dict[subject_names[i]] = subsection
-
-            final_dict = {}
-
-            for key in transition_dict:
-                value = transition_dict[key]
-                final_dict[key] = []
-                for i in range(len(value)):
-                    if value[i]:
-                        final_dict[key].append(i)
-
-            recipient_tutors = []
-            possible_recipients = User.query.filter_by(user_type=1).all()
-            for tutor in possible_recipients:
-                tutor_subjects = tutor.get_subjects().get_data_dict()
-                for key in tutor_subjects:
-                    if tutor not in recipient_tutors:
-                        for i in tutor_subjects[key]:
-                            if i in final_dict[key]:
-                                recipient_tutors.append(tutor)
-
-            recipients = []
-            for tutor in recipient_tutors:
-                recipients.append(tutor.email)
-
-            try:
-                send_email(recipients, form.body.data)
-                flash('email sent successfully!')
-            except SMTPAuthenticationError:
-                flash('Sending email failed')
-                logger.error('Mass Email sending failed')
+            recipients = get_subject_recipients(columns)
+            if recipients:
+                emails = queue_bulk(recipients, form.body.data)
+                flash('email queued for {0} tutors in {1} batches! '
+                      'You can check on it from the outbox page.'.format(len(recipients), len(emails)))
+            else:
+                flash('Nobody tutors those subjects, so no email was sent.')
 
             return render_template('mass email.html', title='Mass Email', form=form)
 
     elif request.method == 'GET':
-        return render_template('mass email.html', title='Mass Email', form=form)
\ No newline at end of file
+        return render_template('mass email.html', title='Mass Email', form=form)
+
+
+@app.route('/outbox', methods=['GET', 'POST'])
+def outbox():
+    """Shows how many emails are waiting, sent, or have failed. - accessible by admins only.
+
+        Posting to this page puts every email that was given up on back in the queue.
+    """
+    if 'username' not in session:
+        flash('Please log in to continue')
+        return redirect(url_for('login'))
+
+    if User.query_from_cookie().user_type != 2:
+        flash('You must be an admin to see the outbox')
+        return redirect(url_for('profile'))
+
+    form = RetryEmailsForm()
+    if form.validate_on_submit():
+        flash('{0} emails will be retried'.format(retry_dead()))
+        return redirect(url_for('outbox'))
+
+    counts, problems = get_outbox_status()
+    return render_template('outbox.html', title='Outbox', counts=counts, problems=problems, form=form)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Request timings and counts in Prometheus' text format (see metrics.py). - accessible by admins only.
+
+        Prometheus can't log in, so it sends "Authorization: Bearer <METRICS_TOKEN>" instead.
+    """
+    token = request.headers.get('Authorization', '')
+    if not (METRICS_TOKEN and hmac.compare_digest(token, 'Bearer ' + METRICS_TOKEN)):
+        if 'username' not in session:
+            return Response('Please log in, or send the metrics token\n', status=401, mimetype='text/plain')
+        if User.query_from_cookie().user_type != 2:
+            return Response('You must be an admin to see the metrics\n', status=403, mimetype='text/plain')
+
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/batch-assign', methods=['GET', 'POST'])
+def batch_assign_page():
+    """Shows how many students are waiting for a tutor, and matches them all at once. - accessible by admins only.
+
+        Posting to this page runs the batch, see batch.py.
+    """
+    if 'username' not in session:
+        flash('Please log in to continue')
+        return redirect(url_for('login'))
+
+    if User.query_from_cookie().user_type != 2:
+        flash('You must be an admin to assign tutors')
+        return redirect(url_for('profile'))
+
+    form = BatchAssignForm()
+    if form.validate_on_submit():
+        try:
+            report = batch_assign()
+        except IntegrityError:
+            flash('Somebody booked a tutor while the batch was running, so nothing was changed. Please try again.')
+            return redirect(url_for('batch_assign_page'))
+        flash('Matched {matched} of {requests} waiting students in {seconds:.1f} seconds.'.format(**report))
+        return redirect(url_for('batch_assign_page'))
+
+    return render_template('batch assign.html', title='Batch Assign', waiting=count_pending(), form=form)
@@ -0,0 +1,5 @@
+"""Benchmarks for NHS Tutoring.
+
+    Each module can be run on its own from the root of the repository, i.e.
+    python -m benchmarks.schema_registry
+"""
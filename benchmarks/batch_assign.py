@@ -0,0 +1,101 @@
+"""Compares the batch solver in app/batch.py with matching students one at a time.
+
+    Fills a throw away database with benchmarks/datagen.py, puts --requests students on the
+    waiting list for random subjects, and solves the same options two ways:
+
+    one at a time - each student, oldest first, takes the least busy tutor still free,
+                    like create_pairing and the tutor selection page do
+    batch         - app.batch.Assignment
+
+    Prints how many were matched, and the most and average new bookings per tutor.
+    Then times batch_assign() itself, writing everything to the database.
+
+    Run with: python -m benchmarks.batch_assign [--students 3000] [--tutors 300] [--requests 2000]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+
+def one_at_a_time(requests, options, load):
+    """Gives each request its first option that's still free. Returns {request id: (tutor uid, slot)}."""
+    taken = set()
+    assigned = {}
+    load = dict(load)
+    for request in requests:
+        free = [pair for pair in options.get(request, ()) if pair not in taken]
+        if free:
+            pair = min(free, key=lambda pair: load.get(pair[0], 0))
+            taken.add(pair)
+            load[pair[0]] = load.get(pair[0], 0) + 1
+            assigned[request] = pair
+    return assigned
+
+
+def describe(assigned, seconds):
+    per_tutor = {}
+    for (uid, slot) in assigned.values():
+        per_tutor[uid] = per_tutor.get(uid, 0) + 1
+    busiest = max(per_tutor.values()) if per_tutor else 0
+    average = sum(per_tutor.values()) / len(per_tutor) if per_tutor else 0
+    return '{0:6d} matched  {1:3d} most new bookings for one tutor  {2:5.2f} average  {3:8.3f}s'.format(
+        len(assigned), busiest, average, seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=3000)
+    parser.add_argument('--tutors', type=int, default=300)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    from app import app, db
+    from app.data import setup_app
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(folder, 'batch.db')
+    try:
+        setup_app(app)
+        from app import batch, matching
+        from app.models import User, PendingRequest
+        from app.schema import get_schema
+        from benchmarks import datagen
+
+        made = datagen.generate(args.students, args.tutors, args.students // 4, seed=args.seed)
+        rng = random.Random(args.seed)
+        subjects = get_schema().subject_list
+        uids = dict(db.session.query(User.username, User.uid).filter(User.username.in_(made['students'])).all())
+        waiting = rng.sample(made['students'], min(args.requests, len(made['students'])))
+        db.session.add_all([PendingRequest(uids[name], rng.choice(subjects)) for name in waiting])
+        db.session.commit()
+
+        # the same options batch_assign would build, solved both ways
+        index = matching.get_index()
+        students = {user.uid: user for user in User.query.filter(User.uid.in_(uids.values())).all()}
+        pending = PendingRequest.query.order_by(PendingRequest.id).all()
+        options = {}
+        for request in pending:
+            student = students[request.student_id]
+            mask = index.calendar_mask(student.get_calendar_0()) & index.calendar_mask(student.get_calendar_1())
+            options[request.id] = batch.best_options(index.match(request.subject, mask), index.business)
+        load = {uid: 0 for uid in index.usernames}
+        order = [request.id for request in pending]
+
+        start = time.time()
+        greedy = one_at_a_time(order, options, load)
+        print('one at a time ' + describe(greedy, time.time() - start))
+        start = time.time()
+        solved = batch.Assignment(order, options, load).solve()
+        print('batch         ' + describe(solved, time.time() - start))
+
+        report = batch.batch_assign()
+        print('batch_assign() matched {matched} of {requests} and wrote them in {seconds:.2f}s'.format(**report))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
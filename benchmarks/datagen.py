@@ -0,0 +1,109 @@
+"""Fills the database with made up students, tutors and pairings for benchmarks.
+
+    The same seed always gives the same data, so runs on different commits can be compared.
+    Everything is written with bulk inserts, and every user gets the same password
+    ("password"), hashed once, so 10,000 users take seconds rather than hours.
+"""
+import datetime
+import random
+from sqlalchemy import func
+from app import db
+from app.models import User, Calendar, CalendarSlot, Subjects, StudentTutorPairings, TutoringSession, \
+    refresh_workload, bump_data_version
+from app.passwords import hasher
+from app.schema import get_schema
+from config import proto_labels
+
+PASSWORD = 'password'
+
+
+def _week_dates(today):
+    """{day label: (that day last week, this week, next week)}"""
+    monday = today - datetime.timedelta(days=today.weekday())
+    return {label: tuple(monday + datetime.timedelta(days=n + 7 * week) for week in (-1, 0, 1))
+            for (n, label) in enumerate(proto_labels)}
+
+
+def generate(students, tutors, pairings, seed=0, today=None):
+    """Adds students, tutors (plus one admin named Admin) and about pairings StudentTutorPairings.
+
+        Users are named Student0.. and Tutor0.., and are free for about a third of the periods.
+        Tutors tutor about a quarter of the subjects. Pairings are spread over last week, this week
+        and next, so some have already passed and need expiring, and some may be today.
+        Returns {'students': [username, ...], 'tutors': [...], 'admin': 'Admin', 'pairings': number made}.
+    """
+    rng = random.Random(seed)
+    today = today or datetime.datetime.utcnow().date()
+    schema = get_schema()
+    pwdhash = hasher.hash(PASSWORD)
+    connection = db.session.connection()
+
+    first_uid = (db.session.query(func.max(User.uid)).scalar() or 0) + 1
+    people = [('Student%d' % n, 0) for n in range(students)] + [('Tutor%d' % n, 1) for n in range(tutors)]
+    people.append(('Admin', 2))
+    connection.execute(User.__table__.insert(), [
+        dict(uid=first_uid + n, created=today, username=name, user_type=user_type,
+             email=name + '@Example.Com', pwdhash=pwdhash)
+        for (n, (name, user_type)) in enumerate(people)])
+    uids = {name: first_uid + n for (n, (name, user_type)) in enumerate(people)}
+
+    # Calendar 0 is the free periods (a row means free), Calendar 1 the bookings (a row means booked)
+    first_calendar = (db.session.query(func.max(Calendar.id)).scalar() or 0) + 1
+    calendars = {}  # (uid, cal_type) -> calendar id
+    for (name, user_type) in people:
+        for cal_type in (0, 1):
+            calendars[(uids[name], cal_type)] = first_calendar + len(calendars)
+    connection.execute(Calendar.__table__.insert(), [dict(id=calendar_id, tutor_id=uid, cal_type=cal_type)
+                                                     for ((uid, cal_type), calendar_id) in calendars.items()])
+
+    free = {}  # uid -> [slot, ...]
+    slot_rows = []
+    for (name, user_type) in people:
+        uid = uids[name]
+        free[uid] = [slot for slot in schema.slots if rng.random() < 0.33]
+        slot_rows.extend(dict(calendar_id=calendars[(uid, 0)], slot=slot) for slot in free[uid])
+
+    subject_rows = []
+    for n in range(tutors):
+        row = {column: int(rng.random() < 0.25) for column in schema.subject_list}
+        row['tutor_id'] = uids['Tutor%d' % n]
+        subject_rows.append(row)
+    if subject_rows:
+        connection.execute(Subjects.__table__.insert(), subject_rows)
+
+    dates = _week_dates(today)
+    booked = set()  # (uid, slot)
+    pairing_rows = []
+    session_rows = []
+    first_pairing = (db.session.query(func.max(StudentTutorPairings.id)).scalar() or 0) + 1
+    for _ in range(pairings if students and tutors else 0):
+        student = 'Student%d' % rng.randrange(students)
+        tutor = 'Tutor%d' % rng.randrange(tutors)
+        shared = [slot for slot in free[uids[student]] if slot in free[uids[tutor]]
+                  and (uids[student], slot) not in booked and (uids[tutor], slot) not in booked]
+        if not shared:
+            continue
+        slot = rng.choice(shared)
+        date = rng.choice(dates[slot[0]])
+        label = schema.slot_labels[slot]
+        for uid in (uids[student], uids[tutor]):
+            booked.add((uid, slot))
+            slot_rows.append(dict(calendar_id=calendars[(uid, 1)], slot=slot,
+                                  expires=date + datetime.timedelta(weeks=1)))
+        pairing_id = first_pairing + len(pairing_rows)
+        pairing_rows.append(dict(id=pairing_id, student=student, tutor=tutor, subject=rng.choice(schema.subject_list),
+                                 date=date, date_str=str(date), active=1, day=label.day, period=label.number))
+        session_rows.append(dict(pairing_id=pairing_id, user_id=uids[student], role='student', date=date, slot=slot))
+        session_rows.append(dict(pairing_id=pairing_id, user_id=uids[tutor], role='tutor', date=date, slot=slot))
+
+    if slot_rows:
+        connection.execute(CalendarSlot.__table__.insert(), slot_rows)
+    if pairing_rows:
+        connection.execute(StudentTutorPairings.__table__.insert(), pairing_rows)
+        connection.execute(TutoringSession.__table__.insert(), session_rows)
+
+    refresh_workload()
+    bump_data_version()
+    db.session.commit()
+    return {'students': ['Student%d' % n for n in range(students)], 'tutors': ['Tutor%d' % n for n in range(tutors)],
+            'admin': 'Admin', 'pairings': len(pairing_rows)}
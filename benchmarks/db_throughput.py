@@ -0,0 +1,144 @@
+"""Reads and writes per second against SQLite with each of the settings in config.SQLITE_PRAGMAS.
+
+    Reader threads load a random calendar with its periods, the way most pages do.
+    Writer threads book and free a period in a transaction, the way /tutor-selection
+    and check_date.py do. Each setting runs on a new database in a temporary folder,
+    and every write that fails with "database is locked" is counted.
+
+    Run with: python -m benchmarks.db_throughput [--readers 8] [--writers 4] [--seconds 5]
+    Add --url to also run it against a database server. i.e. --url postgresql://localhost/scratch
+    (it creates and fills its own tables there, so use a throw away database)
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine, select, bindparam, MetaData, Table, Column, Integer, String, Date, ForeignKey, \
+    UniqueConstraint
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool, QueuePool
+from app.database import apply_sqlite_pragmas
+from config import SQLITE_PRAGMAS, DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW
+
+metadata = MetaData()
+
+# The same layout as Calendar and CalendarSlot in models.py
+calendar = Table('bench_calendar', metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('tutor_id', Integer),
+                 Column('cal_type', Integer))
+
+calendar_slot = Table('bench_calendar_slot', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('calendar_id', Integer, ForeignKey('bench_calendar.id'), index=True),
+                      Column('slot', String(4)),
+                      Column('expires', Date),
+                      UniqueConstraint('calendar_id', 'slot'))
+
+SLOTS = ['M1', 'M2', 'M3', 'T1', 'T2', 'W1', 'R1', 'F1', 'F2', 'FA']
+
+
+def _settings():
+    """[(name, pool options, pragmas)] from the old defaults up to what config.py uses."""
+    pool = dict(poolclass=QueuePool, pool_size=DATABASE_POOL_SIZE, max_overflow=DATABASE_MAX_OVERFLOW,
+                connect_args={'check_same_thread': False})
+    chosen = dict(SQLITE_PRAGMAS)
+    return [
+        ('old defaults', dict(poolclass=NullPool), []),
+        ('+ pool', pool, []),
+        ('+ WAL', pool, [('journal_mode', chosen['journal_mode'])]),
+        ('+ busy_timeout', pool, [(name, chosen[name]) for name in ('journal_mode', 'busy_timeout')]),
+        ('+ synchronous', pool, [(name, chosen[name]) for name in ('journal_mode', 'busy_timeout', 'synchronous')]),
+        ('config.py', pool, SQLITE_PRAGMAS),
+    ]
+
+
+def fill(engine, calendars):
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(calendar.insert(), [dict(id=n + 1, tutor_id=n + 1, cal_type=1) for n in range(calendars)])
+        connection.execute(calendar_slot.insert(), [dict(calendar_id=n + 1, slot=slot)
+                                                    for n in range(calendars) for slot in SLOTS[:3]])
+
+
+def reader(engine, calendars, stop, counts):
+    query = select([calendar_slot.c.slot, calendar_slot.c.expires]).select_from(calendar.join(calendar_slot)) \
+        .where(calendar.c.tutor_id == bindparam('tutor'))
+    while not stop.is_set():
+        try:
+            with engine.connect() as connection:
+                connection.execute(query, tutor=random.randint(1, calendars)).fetchall()
+            counts['reads'] += 1
+        except OperationalError:
+            counts['locked'] += 1
+
+
+def writer(engine, calendars, stop, counts):
+    while not stop.is_set():
+        calendar_id = random.randint(1, calendars)
+        slot = random.choice(SLOTS[3:])
+        try:
+            with engine.begin() as connection:
+                connection.execute(calendar_slot.insert(), calendar_id=calendar_id, slot=slot)
+                connection.execute(calendar_slot.delete().where(calendar_slot.c.calendar_id == calendar_id)
+                                   .where(calendar_slot.c.slot == slot))
+            counts['writes'] += 1
+        except OperationalError:
+            counts['locked'] += 1
+
+
+def run(engine, args):
+    """Returns {'reads': per second, 'writes': per second, 'locked': errors}."""
+    fill(engine, args.calendars)
+    stop = threading.Event()
+    counts = {'reads': 0, 'writes': 0, 'locked': 0}  # += on a dict item is close enough for a count
+    threads = [threading.Thread(target=reader, args=(engine, args.calendars, stop, counts))
+               for _ in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(engine, args.calendars, stop, counts))
+                for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    metadata.drop_all(engine)
+    engine.dispose()
+    return {'reads': counts['reads'] / args.seconds, 'writes': counts['writes'] / args.seconds,
+            'locked': counts['locked']}
+
+
+def report(name, result):
+    print('{0:<16} {1:9.0f} reads/s {2:8.0f} writes/s {3:6d} locked'.format(
+        name, result['reads'], result['writes'], result['locked']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--calendars', type=int, default=500)
+    parser.add_argument('--url', help='also run against this database server')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        for (n, (name, options, pragmas)) in enumerate(_settings()):
+            engine = create_engine('sqlite:///' + os.path.join(folder, '%d.db' % n), **options)
+            apply_sqlite_pragmas(engine, pragmas)
+            report(name, run(engine, args))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if args.url:
+        engine = create_engine(args.url, pool_size=DATABASE_POOL_SIZE, max_overflow=DATABASE_MAX_OVERFLOW)
+        report(engine.dialect.name, run(engine, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Compares the development server with gunicorn under a burst of sign-ups.
+
+    Starts each server on a throw away database, then has --clients people at once register,
+    look at their profile and go back to the homepage. Prints requests per second,
+    latency and errors for each server.
+
+    The servers' databases, logs, log socket and metrics files all go in a temporary folder,
+    so it's safe to run next to the live website.
+
+    Run with: python -m benchmarks.load_test [--clients 20] [--rounds 5] [--workers 3] [--threads 4]
+    Or against a server that's already running: python -m benchmarks.load_test --url http://host:port
+    (that one registers real accounts, so don't point it at the live website)
+"""
+import argparse
+import http.cookiejar
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_app():
+    """The app on the database in LOAD_TEST_DB, with CSRF off so the script can post forms.
+
+        Used by the servers this script starts. i.e. gunicorn 'benchmarks.load_test:test_app()'
+        The confirmation emails are only queued, the email thread is never started.
+    """
+    from app import app, create_app, outbox
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.environ['LOAD_TEST_DB']
+    app.config['WTF_CSRF_ENABLED'] = False
+    outbox.start_worker = lambda: None
+    return create_app()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(kind, folder, workers, threads):
+    """Starts the dev server or gunicorn on a new database. Returns (url, process)."""
+    port = _free_port()
+    env = dict(os.environ, LOAD_TEST_DB=os.path.join(folder, kind + '.db'), LOG_FILE=os.path.join(folder, kind + '.log'),
+               LOG_SOCKET=os.path.join(folder, kind + '.sock'), METRICS_DIR=os.path.join(folder, kind + '-metrics'))
+    if kind == 'dev':
+        command = [sys.executable, '-m', 'benchmarks.load_test', '--serve-dev', str(port)]
+    else:
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-b', '127.0.0.1:%d' % port,
+                   '-w', str(workers), '--threads', str(threads), 'benchmarks.load_test:test_app()']
+    process = subprocess.Popen(command, cwd=_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    url = 'http://127.0.0.1:%d' % port
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url + '/', timeout=1)
+            return url, process
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('{0} server did not start'.format(kind))
+
+
+def person(url, name, rounds, latencies, errors):
+    """Registers, then looks at the profile and homepage rounds times."""
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    form = urllib.parse.urlencode(dict(username=name, password='password', password_check='password',
+                                       email=name + '@example.com')).encode()
+    requests = [('/register', form)] + [('/profile', None), ('/', None)] * rounds
+    for (path, data) in requests:
+        start = time.time()
+        try:
+            opener.open(url + path, data, timeout=30).read()
+            latencies.append(time.time() - start)
+        except (urllib.error.URLError, OSError) as error:
+            errors.append(error)
+
+
+def load(url, clients, rounds, prefix):
+    """Runs clients people at once. Returns (requests per second, p50, p95, errors)."""
+    latencies = []
+    errors = []
+    people = [threading.Thread(target=person, args=(url, '%s%d' % (prefix, n), rounds, latencies, errors))
+              for n in range(clients)]
+    start = time.time()
+    for thread in people:
+        thread.start()
+    for thread in people:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    if not latencies:
+        return 0, 0, 0, len(errors)
+    return (len(latencies) / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)],
+            len(errors))
+
+
+def report(name, result):
+    print('{0:<10} {1:8.1f} req/s   p50 {2:7.1f}ms   p95 {3:7.1f}ms   {4} errors'.format(
+        name, result[0], result[1] * 1000, result[2] * 1000, result[3]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--url', help='load test a server that is already running')
+    parser.add_argument('--serve-dev', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_dev:  # the development server the way run.py starts it, one request at a time
+        test_app().run(host='127.0.0.1', port=args.serve_dev, threaded=False)
+        return
+    if args.url:
+        report(args.url, load(args.url, args.clients, args.rounds, 'load%d_' % int(time.time())))
+        return
+
+    folder = tempfile.mkdtemp()
+    try:
+        for kind in ('dev', 'gunicorn'):
+            url, process = start_server(kind, folder, args.workers, args.threads)
+            try:
+                report(kind, load(url, args.clients, args.rounds, 'load'))
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Logins per second at different password hashing settings.
+
+    --clients threads log in over and over for --seconds each, through a PasswordHasher
+    like the one User.check_password uses. Prints logins per second and the average time
+    one login waits, for each method and iteration count, and each size of worker pool.
+
+    Run with: python -m benchmarks.login_throughput [--clients 16] [--seconds 3] [--workers 1 2 4]
+"""
+import argparse
+import threading
+import time
+from app.passwords import PasswordHasher
+from config import PASSWORD_METHOD, PASSWORD_ITERATIONS, PASSWORD_SALT_LENGTH
+
+SETTINGS = [
+    ('pbkdf2:sha1', 1000),  # what older versions of werkzeug used
+    ('pbkdf2:sha256', 50000),
+    ('pbkdf2:sha256', 150000),
+    ('pbkdf2:sha256', 260000),
+]
+
+
+def run(hasher, clients, seconds):
+    """Returns (logins per second, average seconds per login)."""
+    pwdhash = hasher.hash('correct horse battery staple')
+    stop = threading.Event()
+    times = []
+
+    def client():
+        while not stop.is_set():
+            start = time.time()
+            hasher.verify(pwdhash, 'correct horse battery staple')
+            times.append(time.time() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return len(times) / seconds, sum(times) / len(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    settings = SETTINGS
+    if (PASSWORD_METHOD, PASSWORD_ITERATIONS) not in settings:
+        settings = settings + [(PASSWORD_METHOD, PASSWORD_ITERATIONS)]
+    for (method, iterations) in settings:
+        for workers in args.workers:
+            hasher = PasswordHasher(method, iterations, PASSWORD_SALT_LENGTH, workers)
+            logins, wait = run(hasher, args.clients, args.seconds)
+            print('{0:<14} {1:>7} iterations  {2} workers  {3:8.1f} logins/s  {4:7.1f}ms per login'.format(
+                method, iterations, workers, logins, wait * 1000))
+
+
+if __name__ == '__main__':
+    main()
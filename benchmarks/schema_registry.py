@@ -0,0 +1,91 @@
+"""Times the Calendar/Subjects layout lookups before and after the schema registry.
+
+    The "before" numbers come from legacy copies of the old functions, which scanned
+    dir() on the model and sorted the result with list inserts every call.
+
+    Run with: python -m benchmarks.schema_registry
+"""
+import timeit
+from app import app
+from app.models import QueryMixin, Calendar, Subjects
+from app.data import update_subjects, update_calendar
+from config import labels, subjects
+
+# calls per request, roughly what create_pairing plus one profile render used to do
+CALLS_PER_REQUEST = {'Calendar.sort_attrs': 8, 'Calendar.get_attrs_list': 40, 'Subjects.sort_attrs': 2}
+
+
+def legacy_get_attrs(cls):
+    return QueryMixin.get_attrs.__func__(cls)
+
+
+def legacy_calendar_sort_attrs():
+    day_dict = {letter: [] for letter in 'MTWRFSU'}
+    for attr in legacy_get_attrs(Calendar):
+        for letter in labels:
+            if str(attr).startswith(letter):
+                if str(attr).endswith('B'):
+                    day_dict[letter].insert(0, attr)
+                elif str(attr).endswith('A'):
+                    day_dict[letter].append(attr)
+                else:
+                    day_dict[letter].insert(int(str(attr)[-1]), attr)
+    return [attr for letter in labels for attr in day_dict[letter]]
+
+
+def legacy_calendar_get_attrs_list():
+    day_dict = {letter: [] for letter in 'MTWRFSU'}
+    for attr in legacy_get_attrs(Calendar):
+        for letter in labels:
+            if str(attr).startswith(letter):
+                if str(attr).endswith('B'):
+                    day_dict[letter].insert(0, attr)
+                elif str(attr).endswith('A'):
+                    day_dict[letter].append(attr)
+                else:
+                    day_dict[letter].insert(int(str(attr)[-1]), attr)
+    return [day_dict[letter] for letter in labels if day_dict[letter]]
+
+
+def legacy_subjects_sort_attrs():
+    final_list = []
+    for subject in subjects:
+        buffer = []
+        for (i, course) in enumerate(subject):
+            for attr in legacy_get_attrs(Subjects):
+                if attr == course.replace(" ", ""):
+                    buffer.insert(i, attr)
+        final_list.append(buffer)
+    return final_list
+
+
+def time_call(function, number):
+    """Returns the average time of one call, in microseconds."""
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def main(number=200):
+    update_subjects()
+    update_calendar()
+
+    cases = [
+        ('Calendar.sort_attrs', legacy_calendar_sort_attrs, Calendar.sort_attrs),
+        ('Calendar.get_attrs_list', legacy_calendar_get_attrs_list, Calendar.get_attrs_list),
+        ('Subjects.sort_attrs', legacy_subjects_sort_attrs, Subjects.sort_attrs),
+    ]
+
+    with app.app_context():
+        print('{0:<26}{1:>14}{2:>14}'.format('call', 'before (us)', 'after (us)'))
+        request_before = request_after = 0
+        for name, before, after in cases:
+            assert [list(day) if isinstance(day, tuple) else day for day in after()] == before()
+            before_time = time_call(before, number)
+            after_time = time_call(after, number)
+            request_before += before_time * CALLS_PER_REQUEST[name]
+            request_after += after_time * CALLS_PER_REQUEST[name]
+            print('{0:<26}{1:>14.1f}{2:>14.1f}'.format(name, before_time, after_time))
+        print('{0:<26}{1:>14.1f}{2:>14.1f}'.format('per request', request_before, request_after))
+
+
+if __name__ == '__main__':
+    main()
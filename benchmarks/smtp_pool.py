@@ -0,0 +1,107 @@
+"""Messages per second through the pooled MailTransport versus one connection per message.
+
+    Runs against a local stand-in SMTP server, so no real mail is sent. If aiosmtpd
+    is installed it's used, otherwise a tiny built in sink that accepts everything.
+    --handshake adds a delay when a connection opens, to stand in for the TLS handshake
+    and login a real server needs.
+
+    Run with: python -m benchmarks.smtp_pool [--messages 200] [--handshake 0.05]
+"""
+import argparse
+import socketserver
+import threading
+import time
+from smtplib import SMTP
+from app.emailing import MailTransport, build_message
+
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP to accept and throw away messages."""
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        time.sleep(self.server.handshake)
+        self.reply('220 sink ready')
+        in_data = False
+        for raw in self.rfile:
+            line = raw.decode(errors='replace').rstrip('\r\n')
+            if in_data:
+                if line == '.':
+                    in_data = False
+                    self.reply('250 queued')
+                continue
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self.reply('250 sink')
+            elif command == 'DATA':
+                in_data = True
+                self.reply('354 go ahead')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:  # HELO, MAIL, RCPT, RSET, NOOP
+                self.reply('250 ok')
+
+
+class SinkServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handshake):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), _SinkHandler)
+        self.handshake = handshake
+
+
+def start_server(handshake):
+    """Starts a stand-in server and returns (host:port, stop function)."""
+    try:
+        from aiosmtpd.controller import Controller
+        from aiosmtpd.handlers import Sink
+    except ImportError:
+        server = SinkServer(handshake)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return '127.0.0.1:{0}'.format(server.server_address[1]), server.shutdown
+
+    controller = Controller(Sink(), hostname='127.0.0.1', port=8025)
+    controller.start()
+    return '127.0.0.1:8025', controller.stop
+
+
+def one_connection_per_message(server, messages):
+    """What send_email used to do: connect, send and close for every message."""
+    host, port = server.split(':')
+    for recipient_list, message in messages:
+        connection = SMTP(host, int(port))
+        connection.sendmail('bench@example.com', recipient_list, message)
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--handshake', type=float, default=0.02, help='seconds to open a connection')
+    args = parser.parse_args()
+
+    server, stop = start_server(args.handshake)
+    messages = [build_message(['student{0}@example.com'.format(i)], 'Message {n}', n=i) for i in range(args.messages)]
+
+    start = time.time()
+    one_connection_per_message(server, messages)
+    before = args.messages / (time.time() - start)
+
+    transport = MailTransport(server=server, username='', use_tls=False)
+    start = time.time()
+    transport.send_many(messages)
+    after = args.messages / (time.time() - start)
+    transport.close()
+    stop()
+
+    print('{0} messages, {1}s per new connection'.format(args.messages, args.handshake))
+    print('one connection per message: {0:8.1f} messages/sec'.format(before))
+    print('pooled send_many:           {0:8.1f} messages/sec'.format(after))
+
+
+if __name__ == '__main__':
+    main()
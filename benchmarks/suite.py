@@ -0,0 +1,238 @@
+"""Times the slow parts of the app against made up data at several sizes, and saves the results as JSON.
+
+    For each --scales size (the number of users, about 30% of them tutors) a fresh throw away
+    SQLite database is filled by benchmarks/datagen.py, with half as many pairings as users.
+    The same seed gives the same data every run, so results from two commits can be compared:
+
+        python -m benchmarks.suite --output before.json
+        (check out the other commit)
+        python -m benchmarks.suite --output after.json --compare before.json
+
+    With --compare, anything more than --threshold slower than before (and at least --min-ms,
+    so noise in the quick timings isn't reported) is listed, and the exit code is 1,
+    so it can be run as a check.
+
+    check_date.py's steps are timed one by one (main() would write the CSV into the repo),
+    with emails going to a local stand-in SMTP server from benchmarks/smtp_pool.py.
+    Reminders are for today's pairings, so on a weekend send_emails has nobody to email.
+
+    Run with: python -m benchmarks.suite [--scales 100 1000 10000] [--repeat 20]
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+TUTOR_SHARE = 0.3
+
+
+def timed(function, repeat):
+    """Calls function repeat times. Returns {'median_ms': ..., 'min_ms': ..., 'runs': repeat}."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': round(statistics.median(times), 3), 'min_ms': round(min(times), 3), 'runs': repeat}
+
+
+def get_commit():
+    """Returns the checked out commit's hash (with + on the end if there are uncommitted changes), or None."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+
+def reset_database():
+    """Empties the database, leaving the tables and indexes in place."""
+    from app import db
+    from app.data import create_missing_indexes
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    create_missing_indexes()
+
+
+def run_scale(app, users, repeat, folder, seed):
+    """Generates the data for one size and times everything. Returns {name: timing}."""
+    from flask import session
+    from app import availability, db, matching, outbox
+    from app.data import create_pairing, get_subject_recipients
+    from app.emailing import MailTransport
+    from app.export import export_new_pairings
+    from app.models import User, get_data_version
+    from app.schema import get_schema
+    from benchmarks import datagen
+    from benchmarks.smtp_pool import start_server
+    import check_date
+
+    results = {}
+    reset_database()
+    tutors = int(users * TUTOR_SHARE)
+    start = time.perf_counter()
+    made = datagen.generate(users - tutors, tutors, users // 2, seed=seed)
+    results['generate'] = {'median_ms': round((time.perf_counter() - start) * 1000, 3), 'min_ms': None, 'runs': 1}
+    results['pairings'] = made['pairings']
+
+    rng = random.Random(seed)
+    schema = get_schema()
+    students = [rng.choice(made['students']) for _ in range(repeat)]
+    tutor_ids = [uid for (uid,) in db.session.query(User.uid).filter(User.username.in_(made['tutors'][:repeat]))]
+
+    def build_index():
+        matching.invalidate()
+        matching.get_index()
+    results['matching index'] = timed(build_index, repeat)
+
+    def update_index():
+        free_cal = User.query.get(rng.choice(tutor_ids)).get_calendar_0()
+        setattr(free_cal, schema.slots[0], 0 if getattr(free_cal, schema.slots[0]) else 1)
+        db.session.commit()
+        matching.get_index(get_data_version())  # reloads just that tutor
+    results['matching index after a tutor change'] = timed(update_index, 1 if not tutor_ids else repeat)
+
+    def pick_tutors():
+        with app.test_request_context():
+            session['username'] = students.pop()
+            create_pairing(rng.choice(schema.subject_list))
+    results['create_pairing'] = timed(pick_tutors, repeat)
+
+    def business_value():
+        for uid in tutor_ids:
+            User.query.get(uid).get_business_value()
+        db.session.remove()
+    results['get_business_value (%d tutors)' % len(tutor_ids)] = timed(business_value, 1 if not tutor_ids else repeat)
+
+    def get_page(client, path):
+        response = client.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+
+    student = app.test_client()
+    with student.session_transaction() as cookie:
+        cookie['username'] = made['students'][0]
+    results['GET /profile'] = timed(lambda: get_page(student, '/profile'), repeat)
+
+    availability_path = '/api/availability?subject=' + schema.subject_list[0]
+
+    def work_out_availability():
+        availability.cache.clear()
+        get_page(student, availability_path)
+    results['GET /api/availability'] = timed(work_out_availability, repeat)
+
+    etag = student.get(availability_path).headers['ETag']
+
+    def revalidate_availability():
+        response = student.get(availability_path, headers={'If-None-Match': etag})
+        assert response.status_code == 304, response.status_code
+    results['GET /api/availability unchanged'] = timed(revalidate_availability, repeat)
+
+    admin = app.test_client()
+    with admin.session_transaction() as cookie:
+        cookie['username'] = made['admin']
+    results['GET /schedule'] = timed(lambda: get_page(admin, '/schedule'), repeat)
+
+    def recipients():
+        get_subject_recipients(list(schema.subject_columns[0]))
+        db.session.remove()
+    results['mass email recipients'] = timed(recipients, repeat)
+
+    # check_date.py changes the data, so each step only runs once
+    address, stop = start_server(0)
+    real_transport = outbox.transport
+    outbox.transport = MailTransport(address, username='', use_tls=False)
+    csv_path = os.path.join(folder, 'StudentTutorPairings.csv')
+    steps = [('check_calendar_expiration', check_date.check_calendar_expiration),
+             ('send_emails', check_date.send_emails),
+             ('export_new_pairings', lambda: export_new_pairings(csv_path))]
+    total = 0
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for (name, step) in steps:
+                results['check_date ' + name] = timed(step, 1)
+                total += results['check_date ' + name]['median_ms']
+    finally:
+        outbox.transport.close()
+        outbox.transport = real_transport
+        stop()
+    results['check_date total'] = {'median_ms': round(total, 3), 'min_ms': None, 'runs': 1}
+    db.session.remove()
+    return results
+
+
+def compare(old, new, threshold, min_ms):
+    """Returns [(scale, name, old ms, new ms)] for everything more than threshold (i.e. 0.2 for 20%)
+        and min_ms slower.
+    """
+    slower = []
+    for (scale, results) in new['scales'].items():
+        for (name, timing) in results.items():
+            before = old.get('scales', {}).get(scale, {}).get(name)
+            if not isinstance(timing, dict) or not isinstance(before, dict) or not before['median_ms']:
+                continue
+            if timing['median_ms'] > max(before['median_ms'] * (1 + threshold), before['median_ms'] + min_ms):
+                slower.append((scale, name, before['median_ms'], timing['median_ms']))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help='results from an earlier run to check against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='how much slower counts as a regression')
+    parser.add_argument('--min-ms', type=float, default=1.0, help='smallest slow down in ms that counts')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    from app import app
+    from app.data import setup_app
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(folder, 'suite.db')
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['TESTING'] = True
+
+    report = {'commit': get_commit(), 'date': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+              'python': sys.version.split()[0], 'repeat': args.repeat, 'seed': args.seed, 'scales': {}}
+    try:
+        setup_app(app)
+        for users in args.scales:
+            results = run_scale(app, users, args.repeat, folder, args.seed)
+            report['scales'][str(users)] = results
+            print('{0} users, {1} pairings'.format(users, results['pairings']))
+            for (name, timing) in results.items():
+                if isinstance(timing, dict):
+                    print('  {0:<40} {1:10.2f}ms'.format(name, timing['median_ms']))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print('saved to ' + args.output)
+
+    if args.compare:
+        with open(args.compare) as old_file:
+            old = json.load(old_file)
+        slower = compare(old, report, args.threshold, args.min_ms)
+        for (scale, name, before, after) in slower:
+            print('SLOWER  {0} users  {1:<40} {2:.2f}ms -> {3:.2f}ms'.format(scale, name, before, after))
+        if not slower:
+            print('nothing more than {0:.0%} slower than {1}'.format(args.threshold, old.get('commit')))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
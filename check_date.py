@@ -1,42 +1,52 @@
 """Script that checks the date and compares it to the dates stored in the Calendar database."""
 #!flask/bin/python
+import logging
+import time
 import app
-from app.models import Calendar
-import app.emailing as e
+import app.data
+from app.outbox import queue_many, deliver_all
+from app.emailing import reminders_message
+from app.export import export_new_pairings
+from app.logs import configure_logging
+from app.metrics import record_job_run
+
+logger = logging.getLogger('app.check_date')
 
 
 def main():
+    """Runs every step, then records the run for the website's /metrics page.
+
+        Logs go to the website's log server if it's running, or straight to the log file.
+    """
+    configure_logging()
+    started = time.time()
     check_calendar_expiration()
     send_emails()
+    export_new_pairings()
+    record_job_run('check_date', time.time() - started)
 
 
 def send_emails():
     """Sends reminder emails to all the tutors/students who are engaged on the day the script is run.
 
-        Includes the period and other person (tutor/student)
+        Includes the period, subject and other person (tutor/student).
+        Everybody gets one email, with a line for each time they're tutoring today.
     """
-    calendars = Calendar.query.filter_by(cal_type=1).all()
-    for calendar in calendars:
-        periods = calendar.check_weekday()
-        for period in periods:
-            message = e.reminder.format(period=period)
-            e.send_email(calendar.tutor.email, message)
+    reminders = app.data.get_reminders()
+    queue_many([([email], reminders_message, {'reminders': '\n'.join(lines)}) for (email, lines) in reminders.items()])
+    deliver_all()  # everything queued, not just the first batch
 
 
 def check_calendar_expiration():
-    """Makes the calendar expire if there's a tutoring that lasts longer than 1 week.
+    """Frees up periods whose tutoring date has passed, and deactivates past pairings.
 
-        This shouldn't happen naturally, but is included for robustness.
-
-        This was originally going to be a feature, with tutors scheduled for a number of weeks
-        as selected by the student, however this made the code too complex for a feature that
-        would be too infrequently used.
+        Runs as one bulk DELETE/UPDATE in a single transaction, see data.py's expire_bookings().
+        Pairings booked for several weeks stay active until their last TutoringSession has passed.
     """
     app.data.update_calendar()
-    calendars = Calendar.query.filter_by(cal_type=1).all()
-
-    for calendar in calendars:
-        calendar.check_expiration()
+    report = app.data.expire_bookings()
+    logger.info('Freed {freed} periods and deactivated {deactivated} pairings in {seconds:.3f}s'.format(**report))
+    return report
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,52 @@
+"""Settings for running the website with gunicorn.
+
+    From this folder, run: gunicorn wsgi:application
+    gunicorn finds this file by itself. The address, workers and threads come from config.py,
+    and can be overridden on the command line. i.e. gunicorn -w 8 --threads 2 wsgi:application
+"""
+from config import WEB_BIND, WEB_WORKERS, WEB_THREADS
+
+bind = WEB_BIND
+workers = WEB_WORKERS
+threads = WEB_THREADS
+
+# The app is loaded once before the workers are started, so the database is only upgraded once.
+preload_app = True
+
+
+def on_starting(server):
+    """Runs in the main process before any workers start.
+
+        Only one process can look after the log file, so it's this one, and the workers send it their logs.
+        If another gunicorn is already doing that from this folder, this one stops with an error instead.
+        Each worker counts its own metrics, so they're shared through files for /metrics to add up.
+    """
+    from app.logs import configure_logging, start_log_server
+    from app.metrics import share_between_processes
+
+    configure_logging(path=None)
+    share_between_processes()
+    server.log_server = start_log_server()
+
+
+def on_exit(server):
+    """Runs in the main process as it stops. Removes the log server's socket file."""
+    log_server = getattr(server, 'log_server', None)
+    if log_server is not None:
+        log_server.server_close()
+
+
+def post_fork(server, worker):
+    """Runs in each worker as it starts.
+
+        Database connections opened while loading the app can't be shared between processes,
+        so they're thrown away and each worker opens its own. Threads don't survive the fork either,
+        so each worker starts its own email thread, and its own thread sending logs to the main process.
+    """
+    from app import db
+    from app.logs import configure_logging
+    from app.outbox import start_worker
+
+    db.engine.dispose()
+    configure_logging()
+    start_worker()
@@ -0,0 +1,13 @@
+"""Runs the outbox worker as its own process, delivering email queued by the website.
+
+    Useful when the website runs in several processes and you'd rather not have a
+    worker thread in each of them. It's safe to run alongside the worker threads anyway.
+"""
+#!flask/bin/python
+from app.data import update_subjects, update_calendar
+from app.outbox import run_worker
+
+if __name__ == '__main__':
+    update_subjects()
+    update_calendar()
+    run_worker()
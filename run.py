@@ -1,10 +1,11 @@
-"""Updates the database, then runs the server."""
-from app import app, db
-from app.data import update_environment_variables, update_subjects, update_calendar, _jinja2_datetime_filter
-
-update_environment_variables(app)
-update_subjects()
-update_calendar()
-db.create_all()
-app.jinja_env.filters['date'] = _jinja2_datetime_filter
-app.run(host="0.0.0.0")
+"""Updates the database, then runs the development server.
+
+    The development server handles one request at a time, which is fine for trying things out.
+    For real use, run the website with gunicorn instead (see gunicorn.conf.py).
+"""
+from app import create_app
+from app.outbox import start_worker
+
+app = create_app()
+start_worker()
+app.run(host="0.0.0.0")
@@ -0,0 +1,53 @@
+"""Shared setup for the tests: a fresh SQLite database per test, and helpers to sign people up.
+
+    Run the tests from the top folder with: python -m pytest
+"""
+import pytest
+from app import app as flask_app, db, matching, availability
+from app.data import setup_app
+from config import tutor_password, days_attended, periods
+
+
+@pytest.fixture
+def site(tmp_path):
+    """The app, on an empty database in a temporary folder, with CSRF checks off and X-Query-Count on."""
+    flask_app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + str(tmp_path / 'test.db'),
+                            WTF_CSRF_ENABLED=False, TESTING=True)
+    setup_app(flask_app, upgrade_database=False)  # that only upgrades the first database in a process
+    with flask_app.app_context():
+        db.create_all()
+    matching.invalidate()
+    availability.cache.clear()  # each test's data versions start from the beginning again
+    yield flask_app
+    with flask_app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+    matching.invalidate()
+
+
+def every_period():
+    """Free periods form data with every period of every day ticked."""
+    return {day: list(range(length + 2)) for (day, length) in zip(days_attended, periods)}  # + before and after school
+
+
+@pytest.fixture
+def sign_up(site):
+    """Returns a function that registers somebody free every period and returns their logged in client.
+
+        Tutors tutor Algebra 1.
+    """
+    def sign_up(name, tutor=False):
+        client = site.test_client()
+        client.post('/register', data=dict(username=name, password='password', password_check='password',
+                                           email=name + '@example.com'))
+        client.post('/free-periods', data=every_period())
+        if tutor:
+            client.post('/tutor-registration', data=dict(registration_code=tutor_password))
+            client.post('/subjects', data={'math': [0]})
+        return client
+    return sign_up
+
+
+def query_count(response):
+    """Returns how many SQL queries the request took (see app/metrics.py)."""
+    return int(response.headers['X-Query-Count'])
@@ -0,0 +1,97 @@
+"""The admins' batch matching of the waiting list (see app/batch.py)."""
+import re
+import pytest
+from sqlalchemy.exc import IntegrityError
+from app import db, batch
+from app.batch import Assignment, batch_assign
+from app.models import User, PendingRequest, StudentTutorPairings, TutoringSession, OutboundEmail
+
+
+def test_work_goes_to_the_least_busy_tutor_first():
+    """The load limit only goes up once every tutor below it has been given what they can take."""
+    options = {n: [('busy', 'M1'), ('free', 'M%d' % n)] for n in (1, 2, 3, 4)}
+    assigned = Assignment([1, 2, 3, 4], options, {'busy': 3, 'free': 0}).solve()
+
+    assert [tutor for (tutor, slot) in assigned.values()].count('free') == 3  # up to busy's 3 booked periods
+    assert len(assigned) == 4  # then busy can take one as well
+
+
+def test_an_earlier_request_is_moved_to_make_room():
+    """The second request can only have busy's M1, so the first is moved to its other choice."""
+    options = {1: [('busy', 'M1'), ('free', 'M1')], 2: [('busy', 'M1')]}
+    assigned = Assignment([1, 2], options, {}).solve()
+
+    assert assigned == {1: ('free', 'M1'), 2: ('busy', 'M1')}
+
+
+def test_every_pair_is_only_taken_once():
+    options = {1: [('tutor', 'M1')], 2: [('tutor', 'M1')], 3: [('tutor', 'M1'), ('tutor', 'T1')]}
+    assigned = Assignment([1, 2, 3], options, {}).solve()
+
+    assert assigned == {1: ('tutor', 'M1'), 3: ('tutor', 'T1')}  # 2 waits, oldest first
+
+
+def wait_for_a_tutor(sign_up, name):
+    """Signs up a student and asks for Algebra 1 while there are no tutors, which puts them on the waiting list."""
+    student = sign_up(name)
+    student.post('/tutor-request', data={'subject_request': 'Algebra 1'})
+    return student
+
+
+def test_batch_books_everybody_waiting(site, sign_up):
+    for n in range(2):
+        wait_for_a_tutor(sign_up, 'student%d' % n)
+    sign_up('tutor0', tutor=True)
+
+    with site.app_context():
+        emails = OutboundEmail.query.count()
+        assert batch_assign()['matched'] == 2
+        assert StudentTutorPairings.query.count() == 2
+        assert TutoringSession.query.count() == 4  # a student's and a tutor's for each
+        assert PendingRequest.query.filter_by(status='pending').count() == 0
+        assert OutboundEmail.query.count() == emails + 4  # one each to tutor and student
+
+
+def test_batch_doesnt_book_a_student_who_booked_themselves(site, sign_up):
+    student = wait_for_a_tutor(sign_up, 'student')
+    sign_up('tutor0', tutor=True)
+    student.post('/tutor-request', data={'subject_request': 'Algebra 1'})
+    choice = re.findall(r'value="([A-Z][0-9AB]+)"', student.get('/tutor-selection').data.decode())[0]
+    student.post('/tutor-selection', data={'potential_tutors': [choice]})
+
+    with site.app_context():
+        assert PendingRequest.query.one().status == 'matched'
+        # and if the request is still pending (i.e. left from before booking marked it), the session is found
+        PendingRequest.query.update({'status': 'pending'})
+        db.session.commit()
+        assert batch_assign()['matched'] == 0
+        assert StudentTutorPairings.query.count() == 1
+        assert PendingRequest.query.one().status == 'matched'
+
+
+def test_batch_writes_everything_or_nothing(site, sign_up, monkeypatch):
+    """Somebody booked during the batch shows up as a clash on the second booking, and the first is undone too."""
+    for n in range(2):
+        wait_for_a_tutor(sign_up, 'student%d' % n)
+    sign_up('tutor0', tutor=True)
+    book_sessions = batch.book_sessions
+    bookings = []
+
+    def book_twice_the_second_time(*args):
+        bookings.append(args)
+        if len(bookings) == 2:
+            book_sessions(*args)  # the same sessions again break the unique (date, slot, user_id) index
+        return book_sessions(*args)
+    monkeypatch.setattr(batch, 'book_sessions', book_twice_the_second_time)
+
+    with site.app_context():
+        emails = OutboundEmail.query.count()
+        free = User.query.filter_by(username='Tutor0').one().get_calendar_1().get_data_dict()
+        with pytest.raises(IntegrityError):
+            batch_assign()
+        assert len(bookings) == 2
+        assert StudentTutorPairings.query.count() == 0
+        assert TutoringSession.query.count() == 0
+        assert PendingRequest.query.filter_by(status='pending').count() == 2
+        assert OutboundEmail.query.count() == emails
+        assert User.query.filter_by(username='Tutor0').one().get_calendar_1().get_data_dict() == free
@@ -0,0 +1,108 @@
+"""Booking a tutor for one or several weeks, and what stops anybody being booked twice."""
+import datetime
+import re
+import pytest
+from sqlalchemy.exc import IntegrityError
+from app import db, views
+from app.data import session_dates, find_conflicts, expire_bookings
+from app.models import User, StudentTutorPairings, TutoringSession
+
+
+def request_first_choice(student):
+    """Has the student request Algebra 1, and returns the first period offered."""
+    student.post('/tutor-request', data={'subject_request': 'Algebra 1'})
+    return re.findall(r'value="([A-Z][0-9AB]+)"', student.get('/tutor-selection').data.decode())[0]
+
+
+def sessions_of(username):
+    user = User.query_from_field(username=username)
+    return TutoringSession.query.filter_by(user_id=user.uid).order_by(TutoringSession.date).all()
+
+
+def test_session_dates():
+    monday = datetime.date(2026, 10, 19)
+    assert session_dates(monday) == [monday]
+    assert session_dates(monday, weeks=3) == [monday, datetime.date(2026, 10, 26), datetime.date(2026, 11, 2)]
+    # until counts every week up to and including it, and always books the first
+    assert session_dates(monday, until=datetime.date(2026, 11, 1)) == [monday, datetime.date(2026, 10, 26)]
+    assert session_dates(monday, until=datetime.date(2026, 11, 2))[-1] == datetime.date(2026, 11, 2)
+    assert session_dates(monday, until=monday - datetime.timedelta(days=1)) == [monday]
+
+
+def test_booking_several_weeks(site, sign_up):
+    sign_up('tutor0', tutor=True)
+    student = sign_up('student')
+    choice = request_first_choice(student)
+    response = student.post('/tutor-selection', data={'potential_tutors': [choice], 'weeks': 3})
+    assert response.status_code == 302 and response.location.endswith('/profile')
+
+    with site.app_context():
+        for name in ('Student', 'Tutor0'):
+            dates = [row.date for row in sessions_of(name)]
+            assert len(dates) == 3
+            assert dates == session_dates(dates[0], weeks=3)
+            assert {row.slot for row in sessions_of(name)} == {choice}
+        assert StudentTutorPairings.query.count() == 1  # one pairing, with a session a week
+        tutor = User.query_from_field(username='Tutor0')
+        assert find_conflicts([tutor.uid], choice, dates) == [row for row in sessions_of('Tutor0')]
+        assert find_conflicts([tutor.uid], choice, [dates[0] - datetime.timedelta(weeks=1)]) == []
+
+
+def test_nobody_is_booked_twice_for_a_period(site, sign_up):
+    sign_up('tutor0', tutor=True)
+    student = sign_up('student')
+    choice = request_first_choice(student)
+    student.post('/tutor-selection', data={'potential_tutors': [choice]})
+
+    with site.app_context():
+        booked = sessions_of('Tutor0')[0]
+        pairing = StudentTutorPairings('Other', 'Tutor0', 'Algebra 1', booked.date, 1)
+        pairing.sessions.append(TutoringSession(booked.user_id, 'tutor', booked.date, booked.slot))
+        db.session.add(pairing)
+        with pytest.raises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+
+def test_booking_taken_in_the_meantime_changes_nothing(site, sign_up, monkeypatch):
+    """Two students pick the same tutor and period. The one who's second gets the unique index's
+        IntegrityError instead of a booking, and nothing of theirs is half saved.
+    """
+    sign_up('tutor0', tutor=True)
+    first, second = sign_up('first'), sign_up('second')
+    choice = request_first_choice(first)
+    assert request_first_choice(second) == choice
+    first.post('/tutor-selection', data={'potential_tutors': [choice], 'weeks': 2})
+
+    monkeypatch.setattr(views, 'is_still_available', lambda *args: True)  # both checked before either booked
+    response = second.post('/tutor-selection', data={'potential_tutors': [choice], 'weeks': 2})
+    assert response.status_code == 302 and response.location.endswith('/tutor-request')
+
+    with site.app_context():
+        assert sessions_of('Second') == []
+        assert StudentTutorPairings.query.filter_by(student='Second').count() == 0
+        assert getattr(User.query_from_field(username='Second').get_calendar_1(), choice) == 1  # still not booked
+        assert len(sessions_of('First')) == 2 and len(sessions_of('Tutor0')) == 2
+    assert second.get('/tutor-selection').location.endswith('/tutor-request')  # the shortlist was used up
+
+
+def test_booking_ends_with_its_last_session(site, sign_up):
+    sign_up('tutor0', tutor=True)
+    student = sign_up('student')
+    choice = request_first_choice(student)
+    student.post('/tutor-selection', data={'potential_tutors': [choice], 'weeks': 3})
+
+    with site.app_context():
+        dates = [row.date for row in sessions_of('Student')]
+        tutor, pupil = User.query_from_field(username='Tutor0'), User.query_from_field(username='Student')
+
+        # Between the first and second sessions, both are still booked
+        assert expire_bookings(dates[0] + datetime.timedelta(days=1))['freed'] == 0
+        assert getattr(tutor.get_calendar_1(), choice) == 0 and getattr(pupil.get_calendar_1(), choice) == 0
+
+        # A cancelled session frees the period as soon as nothing's left, whatever date it was booked until
+        TutoringSession.query.filter(TutoringSession.date > dates[0]).delete(synchronize_session=False)
+        db.session.commit()
+        report = expire_bookings(dates[0] + datetime.timedelta(days=1))
+        assert report == dict(report, freed=2, deactivated=1)
+        assert getattr(tutor.get_calendar_1(), choice) == 1 and getattr(pupil.get_calendar_1(), choice) == 1
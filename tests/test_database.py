@@ -0,0 +1,12 @@
+"""The connection setup in app/database.py."""
+from sqlalchemy.pool import QueuePool
+from app import db
+
+
+def test_sqlite_connections_are_pooled_with_the_pragmas(site):
+    """Only happens if Flask-SQLAlchemy builds the engine through Database.create_engine."""
+    with site.app_context():
+        assert isinstance(db.engine.pool, QueuePool)
+        with db.engine.connect() as connection:
+            assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+            assert connection.execute('PRAGMA busy_timeout').scalar() == 5000
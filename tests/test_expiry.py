@@ -0,0 +1,97 @@
+"""The nightly sweep (data.py's expire_bookings, run by check_date.py) that frees periods once their sessions are over."""
+import datetime
+import logging
+from sqlalchemy import event
+import check_date
+from app import db
+from app.data import expire_bookings
+from app.models import User, StudentTutorPairings, TutoringSession, TutorWorkload, get_data_version
+from test_bookings import request_first_choice
+
+
+def book(student, weeks):
+    """Books the student's first choice of Algebra 1 tutor for weeks, returns the period."""
+    choice = request_first_choice(student)
+    student.post('/tutor-selection', data={'potential_tutors': [choice], 'weeks': weeks})
+    return choice
+
+
+def booked(username, slot):
+    return getattr(User.query_from_field(username=username).get_calendar_1(), slot) == 0
+
+
+def statements(site):
+    """Returns a list that fills up with the first word of every SQL statement run, and 'COMMIT' for each commit."""
+    run = []
+    with site.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: run.append(statement.split()[0]))
+    event.listen(engine, 'commit', lambda conn: run.append('COMMIT'))
+    return run
+
+
+def test_sweep_frees_what_is_over(site, sign_up):
+    """One student's single session has passed and another has two more weeks to go."""
+    sign_up('tutor0', tutor=True)
+    once, weekly = sign_up('once'), sign_up('weekly')
+    once_slot, weekly_slot = book(once, 1), book(weekly, 3)
+
+    with site.app_context():
+        first_week = max(row.date for row in TutoringSession.query.all()) - datetime.timedelta(weeks=2)
+        tutor = User.query_from_field(username='Tutor0')
+        assert TutorWorkload.query.get(tutor.uid).booked_slots == 2
+        version = get_data_version()
+
+        report = expire_bookings(first_week + datetime.timedelta(days=1))
+        assert (report['freed'], report['deactivated']) == (2, 1)  # Once's period, and the tutor's
+        assert not booked('Once', once_slot) and booked('Weekly', weekly_slot) and booked('Tutor0', weekly_slot)
+        assert not booked('Tutor0', once_slot)
+        assert [pairing.active for pairing in StudentTutorPairings.query.order_by(StudentTutorPairings.id)] == [0, 1]
+        assert TutorWorkload.query.get(tutor.uid).booked_slots == 1
+        assert get_data_version() > version  # so every worker's matching index sees the freed period
+
+        report = expire_bookings(first_week + datetime.timedelta(weeks=2, days=1))
+        assert (report['freed'], report['deactivated']) == (2, 1)
+        assert not booked('Weekly', weekly_slot) and not booked('Tutor0', weekly_slot)
+        assert TutorWorkload.query.get(tutor.uid).booked_slots == 0
+
+
+def test_sweep_is_a_few_bulk_statements_in_one_commit(site, sign_up):
+    sign_up('tutor0', tutor=True)
+    for n in range(3):
+        book(sign_up('student%d' % n), 1)
+
+    run = statements(site)
+    with site.app_context():
+        report = expire_bookings(datetime.date.today() + datetime.timedelta(weeks=2))
+    assert (report['freed'], report['deactivated']) == (6, 3)
+    assert run.count('DELETE') == 3  # the booked periods, the workload rows refresh_workload rewrites,
+    # and the tutor's old TutorChange stamp
+    assert run.count('UPDATE') == 2  # the pairings, and the data version
+    assert run.count('COMMIT') == 1
+
+
+def test_sweep_with_nothing_to_do_leaves_the_data_version(site, sign_up):
+    sign_up('tutor0', tutor=True)
+    book(sign_up('student'), 1)
+    with site.app_context():
+        version = get_data_version()
+        assert expire_bookings(datetime.date.today())['freed'] == 0
+        assert get_data_version() == version  # nothing for the matching index to rebuild
+
+
+def test_check_date_logs_its_report(site, capsys):
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    check_date.logger.addHandler(handler)
+    check_date.logger.setLevel(logging.INFO)  # configure_logging does this for the whole "app" logger
+    try:
+        with site.app_context():
+            report = check_date.check_calendar_expiration()
+    finally:
+        check_date.logger.removeHandler(handler)
+        check_date.logger.setLevel(logging.NOTSET)
+    assert [record.getMessage() for record in records] == [
+        'Freed 0 periods and deactivated 0 pairings in {0:.3f}s'.format(report['seconds'])]
+    assert capsys.readouterr().out == ''
@@ -0,0 +1,73 @@
+"""Period labels under parallel requests.
+
+    Labels used to be made by adding "Before"/"After" to config.period_names for the
+    length of a request, so two requests at once would get each other's labels.
+    This has a student per thread request and book tutors at the same time, and checks
+    that every choice shown, every booking and every email has the right period.
+"""
+import re
+import threading
+import config
+from app import app
+from app.models import StudentTutorPairings, OutboundEmail
+from app.schema import get_schema
+
+STUDENTS = 4
+ROUNDS = 3  # enough for the students' requests to overlap, and leaves the tutors free periods for all of them
+TUTORS = 4
+
+_CHOICE = re.compile(r'<input[^>]*value="([A-Z][0-9AB]+)"[^>]*>\s*<label for="potential_tutors-\d+">([^<]*)</label>')
+
+
+def student_thread(name, client, rounds, problems, clashes):
+    """Requests and books a tutor rounds times, adding anything wrong to problems."""
+    slot_labels = get_schema().slot_labels
+    for _ in range(rounds):
+        client.post('/tutor-request', data={'subject_request': 'Algebra 1'})
+        page = client.get('/tutor-selection').data.decode()
+        choices = _CHOICE.findall(page)
+        if not choices:
+            return  # booked every period there is
+        for (slot, text) in choices:
+            if text.split(', ')[-1] != slot_labels[slot].display:
+                problems.append('{0} was shown {1!r} for {2}'.format(name, text, slot))
+
+        slot = choices[0][0]
+        response = client.post('/tutor-selection', data={'potential_tutors': [slot]})
+        if response.status_code != 302:
+            problems.append('{0} got a {1} booking {2}'.format(name, response.status_code, slot))
+            continue
+        if 'tutor-request' in response.headers['Location']:
+            clashes.append(slot)  # another thread booked the same tutor first, which is allowed
+            continue
+        with app.app_context():
+            pairing = StudentTutorPairings.query.filter_by(student=name) \
+                .order_by(StudentTutorPairings.id.desc()).first()
+            email = OutboundEmail.query.filter(OutboundEmail.recipients.like('%' + name.lower() + '%')) \
+                .order_by(OutboundEmail.id.desc()).first()
+            if pairing is None or pairing.period != slot_labels[slot].number:
+                problems.append('{0} booked {1} but the pairing says period {2}'.format(
+                    name, slot, pairing and pairing.period))
+            if email is None or slot_labels[slot].name not in email.message:
+                problems.append('{0} booked {1} but the email does not say {2}'.format(
+                    name, slot, slot_labels[slot].name))
+
+
+def test_parallel_bookings_keep_their_labels(sign_up):
+    period_names = tuple(config.period_names)
+    for n in range(TUTORS):
+        sign_up('tutor%d' % n, tutor=True)
+    clients = [('Student%d' % n, sign_up('student%d' % n)) for n in range(STUDENTS)]
+
+    problems = []
+    clashes = []
+    threads = [threading.Thread(target=student_thread, args=(name, client, ROUNDS, problems, clashes))
+               for (name, client) in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert problems == []
+    assert len(clashes) < STUDENTS * ROUNDS  # some bookings went through and were checked
+    assert tuple(config.period_names) == period_names
@@ -0,0 +1,29 @@
+"""The log server that gunicorn's main process runs for its workers (see app/logs.py)."""
+import errno
+import os
+import pytest
+from app.logs import LogServer, _server_running
+
+
+def test_second_log_server_leaves_the_first_alone(tmp_path):
+    path = str(tmp_path / 'log.sock')
+    first = LogServer(path)
+    try:
+        with pytest.raises(OSError) as error:
+            LogServer(path)
+        assert error.value.errno == errno.EADDRINUSE
+        assert os.path.exists(path)
+        assert oct(os.stat(path).st_mode & 0o777) == oct(0o600)
+    finally:
+        first.server_close()
+    assert not os.path.exists(path)
+
+
+def test_log_server_replaces_a_socket_left_behind(tmp_path):
+    path = str(tmp_path / 'log.sock')
+    open(path, 'w').close()  # nothing's listening on it
+    server = LogServer(path)
+    try:
+        assert _server_running(path)
+    finally:
+        server.server_close()
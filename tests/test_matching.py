@@ -0,0 +1,100 @@
+"""Keeping the matching index (app/matching.py) up to date without building it again."""
+import datetime
+import pytest
+from app import db, matching
+from app.data import expire_bookings
+from app.models import User, StudentTutorPairings, get_data_version
+from conftest import every_period
+from config import admin_password
+from test_query_counts import book_first_choice
+
+FIELDS = ('usernames', 'availability', 'subject_masks', 'business', 'by_subject')
+
+
+@pytest.fixture
+def builds(site, monkeypatch):
+    """Counts the times the index is built from scratch."""
+    count = []
+    build = matching.MatchingIndex.build
+
+    def counted(cls):
+        count.append(1)
+        return build()
+    monkeypatch.setattr(matching.MatchingIndex, 'build', classmethod(counted))
+    return count
+
+
+def current_index():
+    """Returns get_index at the current DataVersion, checking it matches one built from scratch."""
+    index = matching.get_index(get_data_version())
+    fresh = matching.MatchingIndex.build()
+    assert index.version == fresh.version
+    for field in FIELDS:
+        assert getattr(index, field) == getattr(fresh, field), field
+    return index
+
+
+def test_tutor_changes_only_reload_that_tutor(site, sign_up, builds):
+    tutor = sign_up('tutor0', tutor=True)
+    sign_up('tutor1', tutor=True)
+    with site.app_context():
+        uid = User.query_from_field(username='Tutor0').uid
+        before = current_index()
+    assert len(builds) == 2  # get_index's, and the one it was checked against
+
+    tutor.post('/free-periods', data={day: [1] for day in every_period()})  # only 1st period now
+    with site.app_context():
+        after = current_index()
+        assert after.availability[uid] != before.availability[uid]
+
+    tutor.post('/subjects', data={'math': [1]})  # Geometry instead of Algebra 1
+    with site.app_context():
+        index = current_index()
+        assert uid not in index.by_subject['Algebra1'] and uid in index.by_subject['Geometry']
+    assert len(builds) == 4  # only the ones it was checked against
+    assert uid in before.by_subject['Algebra1']  # an index already handed out never changes
+
+
+def test_students_and_pairings_dont_reload_anybody(site, sign_up, builds):
+    sign_up('tutor0', tutor=True)
+    student = sign_up('student')
+    with site.app_context():
+        before = matching.get_index(get_data_version())
+
+        db.session.add(StudentTutorPairings('Student', 'Tutor0', 'Algebra1', datetime.date.today(), 1))
+        db.session.commit()
+        index = matching.get_index(get_data_version())
+    assert index.version > before.version
+    assert all(getattr(index, field) is getattr(before, field) for field in FIELDS)  # nothing was reloaded
+
+    student.post('/free-periods', data={day: [1] for day in every_period()})
+    with site.app_context():
+        index = current_index()
+    assert all(getattr(index, field) == getattr(before, field) for field in FIELDS)
+    assert len(builds) == 2  # the first, and the one current_index checked against
+
+
+def test_bookings_expiry_and_new_tutors_are_picked_up(site, sign_up, builds):
+    sign_up('tutor0', tutor=True)
+    book_first_choice(sign_up('student'))
+    with site.app_context():
+        current_index()
+        expire_bookings(datetime.date.today() + datetime.timedelta(weeks=2))  # goes around the ORM
+        current_index()
+
+    sign_up('tutor1', tutor=True)
+    admin = sign_up('admin', tutor=True)
+    admin.post('/admin', data={'registration_code': admin_password})  # stops being a tutor
+    with site.app_context():
+        index = current_index()
+        assert sorted(index.usernames.values()) == ['Tutor0', 'Tutor1']
+    assert len(builds) == 4  # two of them for checking
+
+
+def test_new_periods_or_subjects_build_it_again(site, sign_up, builds):
+    sign_up('tutor0', tutor=True)
+    with site.app_context():
+        index = matching.get_index(get_data_version())
+        index.slots = index.slots[:-1]  # as if config had another period when it was built
+        assert matching.get_index(get_data_version()) is not index
+    assert len(builds) == 2
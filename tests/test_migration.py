@@ -0,0 +1,106 @@
+"""Upgrading a database made by the original version, with a column per period in the calendar table."""
+import datetime
+import sqlite3
+import pytest
+from werkzeug.security import generate_password_hash
+from app import app as flask_app, db, matching, availability
+from app import data
+from app.models import User, Subjects, CalendarSlot, TutoringSession, TutorWorkload
+from app.schema import build_schema
+
+
+def make_baseline_database(path, monday):
+    """Writes the original layout to path: the tutor Tutor0 is booked with Student for Monday 1st period."""
+    schema = build_schema()
+    slot_columns = ', '.join('{0} INTEGER, {0}_date DATE'.format(slot) for slot in schema.slots)
+    subject_columns = ', '.join('{0} INTEGER'.format(subject) for subject in schema.subject_list)
+    connection = sqlite3.connect(str(path))
+    connection.executescript('''
+        CREATE TABLE users (uid INTEGER PRIMARY KEY, created DATE, username VARCHAR(100) UNIQUE,
+                            user_type INTEGER, email VARCHAR(120), pwdhash VARCHAR(54));
+        CREATE TABLE subjects (id INTEGER PRIMARY KEY, tutor_id INTEGER REFERENCES users(uid), {0});
+        CREATE TABLE calendar (id INTEGER PRIMARY KEY, tutor_id INTEGER REFERENCES users(uid), cal_type INTEGER, {1});
+        CREATE TABLE student_tutor_pairings (id INTEGER PRIMARY KEY, student VARCHAR, tutor VARCHAR,
+                                             subject VARCHAR, date DATE, active INTEGER, date_str VARCHAR,
+                                             day VARCHAR, period INTEGER);
+    '''.format(subject_columns, slot_columns))
+
+    password = generate_password_hash('password')
+    for (uid, name, user_type) in ((1, 'Tutor0', 1), (2, 'Student', 0)):
+        connection.execute('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)',
+                           (uid, str(monday), name, user_type, name + '@example.com', password))
+    connection.execute('INSERT INTO subjects (id, tutor_id, Algebra1) VALUES (1, 1, 1)')
+
+    calendar_id = 0
+    for uid in (1, 2):
+        for cal_type in (0, 1):
+            calendar_id += 1
+            # Calendar 0 was all 0 (busy) apart from the free periods, Calendar 1 all 1 apart from bookings
+            values = {slot: cal_type for slot in schema.slots}
+            values['M1'] = 1 - cal_type
+            columns = ['id', 'tutor_id', 'cal_type'] + list(values) + ['M1_date']
+            row = [calendar_id, uid, cal_type] + list(values.values()) + [str(monday + datetime.timedelta(weeks=1))]
+            connection.execute('INSERT INTO calendar ({0}) VALUES ({1})'.format(', '.join(columns),
+                                                                                 ', '.join('?' * len(row))), row)
+    connection.execute('INSERT INTO student_tutor_pairings VALUES (1, ?, ?, ?, ?, 1, ?, ?, ?)',
+                       ('Student', 'Tutor0', 'Algebra1', str(monday), str(monday), 'Monday',
+                        schema.slot_labels['M1'].number))
+    connection.commit()
+    connection.close()
+
+
+@pytest.fixture
+def upgraded(tmp_path, monkeypatch):
+    """The app after setup_app has upgraded a baseline database."""
+    today = datetime.date.today()
+    monday = today + datetime.timedelta(days=7 - today.weekday())
+    make_baseline_database(tmp_path / 'old.db', monday)
+    flask_app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + str(tmp_path / 'old.db'),
+                            WTF_CSRF_ENABLED=False, TESTING=True)
+    monkeypatch.setattr(data, '_database_ready', False)  # so this process upgrades again
+    matching.invalidate()
+    availability.cache.clear()
+    data.setup_app(flask_app)
+    with flask_app.app_context():
+        yield monday
+        db.session.remove()
+        db.engine.dispose()
+    matching.invalidate()
+
+
+def test_calendars_become_slot_rows(upgraded):
+    columns = [column['name'] for column in db.inspect(db.engine).get_columns('calendar')]
+    assert columns == ['id', 'tutor_id', 'cal_type']
+
+    for name in ('Tutor0', 'Student'):
+        user = User.query_from_field(username=name)
+        free, booked = user.get_calendar_0(), user.get_calendar_1()
+        assert [slot for slot in build_schema().slots if getattr(free, slot)] == ['M1']
+        assert [slot for slot in build_schema().slots if not getattr(booked, slot)] == ['M1']
+        assert booked.M1_date == upgraded + datetime.timedelta(weeks=1)
+    assert CalendarSlot.query.count() == 4  # only the periods that differ from the default
+
+
+def test_pairings_get_sessions_and_tutors_get_workloads(upgraded):
+    tutor, student = User.query_from_field(username='Tutor0'), User.query_from_field(username='Student')
+    sessions = TutoringSession.query.order_by(TutoringSession.role).all()
+    assert [(row.user_id, row.role, row.date, row.slot) for row in sessions] == [
+        (student.uid, 'student', upgraded, 'M1'), (tutor.uid, 'tutor', upgraded, 'M1')]
+    workload = TutorWorkload.query.get(tutor.uid)
+    assert (workload.free_slots, workload.booked_slots) == (1, 1)
+    assert Subjects.query.filter_by(tutor_id=tutor.uid).first().Algebra1 == 1
+
+
+def test_upgrading_twice_changes_nothing(upgraded):
+    before = [(row.calendar_id, row.slot, row.expires) for row in CalendarSlot.query.order_by(CalendarSlot.id)]
+    data.migrate_calendar()
+    data.create_missing_sessions()
+    assert [(row.calendar_id, row.slot, row.expires) for row in CalendarSlot.query.order_by(CalendarSlot.id)] == before
+    assert TutoringSession.query.count() == 2
+
+
+def test_old_users_can_still_log_in(upgraded):
+    client = flask_app.test_client()
+    response = client.post('/login', data=dict(username='tutor0', password='password'))
+    assert response.status_code == 302
+    assert client.get('/profile').status_code == 200
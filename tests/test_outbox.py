@@ -0,0 +1,109 @@
+"""The outbox (app/outbox.py): claiming emails, retrying failures and giving up on them."""
+from datetime import datetime, timedelta
+from smtplib import SMTPException
+import pytest
+from app import db, outbox
+from app.models import OutboundEmail
+from config import EMAIL_MAX_ATTEMPTS, EMAIL_RETRY_DELAY, EMAIL_SENDING_TIMEOUT
+
+
+@pytest.fixture
+def mail(site, monkeypatch):
+    """Returns the list of recipient lists sent to. Set mail.fail to make every send raise SMTPException."""
+    class Mail(list):
+        fail = False
+
+    sent = Mail()
+
+    def send_many(messages):
+        if sent.fail:
+            raise SMTPException('the mail server is down')
+        sent.extend(recipients for (recipients, message) in messages)
+        return []
+    monkeypatch.setattr(outbox.transport, 'send_many', send_many)
+    with site.app_context():
+        yield sent
+
+
+def add_email(address='someone@example.com'):
+    email = OutboundEmail([address], 'Subject: hello\n\nhello')
+    db.session.add(email)
+    db.session.commit()
+    return email
+
+
+def make_due(email):
+    """Moves the email's next attempt into the past, as if the time had gone by."""
+    email.next_attempt = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+
+
+def test_a_claim_keeps_other_workers_away_until_it_runs_out(mail):
+    email = add_email()
+    assert outbox._claim(email, datetime.utcnow())
+    db.session.refresh(email)
+    assert email.status == 'sending'
+    assert email.next_attempt > datetime.utcnow() + timedelta(seconds=EMAIL_SENDING_TIMEOUT - 60)
+    assert outbox.deliver_pending() == (0, 0)  # still claimed
+    assert mail == []
+
+    make_due(email)  # the worker that claimed it died part way
+    assert outbox.deliver_pending() == (1, 0)
+    db.session.refresh(email)
+    assert (email.status, email.attempts, mail) == ('sent', 1, [['someone@example.com']])
+
+
+def test_only_one_worker_gets_an_abandoned_email(mail):
+    email = add_email()
+    outbox._claim(email, datetime.utcnow())
+    make_due(email)
+    second_worker = OutboundEmail.query.get(email.id)
+    db.session.expunge(second_worker)  # what the second worker loaded, before the first claimed it
+    now = datetime.utcnow()
+    assert outbox._claim(OutboundEmail.query.get(email.id), now)
+    assert not outbox._claim(second_worker, now)  # the row changed since the second worker loaded it
+
+
+def test_failures_back_off_then_give_up(mail):
+    mail.fail = True
+    email = add_email()
+    for attempt in range(1, EMAIL_MAX_ATTEMPTS):
+        before = datetime.utcnow()
+        assert outbox.deliver_pending() == (0, 1)
+        db.session.refresh(email)
+        assert (email.status, email.attempts) == ('pending', attempt)
+        delay = timedelta(seconds=EMAIL_RETRY_DELAY * 2 ** (attempt - 1))  # 1, 2, 4... times the delay
+        assert before + delay <= email.next_attempt <= datetime.utcnow() + delay
+        assert outbox.deliver_pending() == (0, 0)  # not due yet
+        make_due(email)
+
+    assert outbox.deliver_pending() == (0, 1)
+    db.session.refresh(email)
+    assert (email.status, email.attempts) == ('dead', EMAIL_MAX_ATTEMPTS)
+    assert 'the mail server is down' in email.last_error
+    make_due(email)
+    assert outbox.deliver_pending() == (0, 0)  # dead emails stay dead
+    assert outbox.get_status()[0] == {'dead': 1}
+
+
+def test_retry_dead_sends_them_again(mail):
+    mail.fail = True
+    email = add_email()
+    for attempt in range(EMAIL_MAX_ATTEMPTS):
+        make_due(email)
+        outbox.deliver_pending()
+    assert OutboundEmail.query.get(email.id).status == 'dead'
+
+    mail.fail = False
+    assert outbox.retry_dead() == 1
+    assert outbox.deliver_pending() == (1, 0)
+    db.session.refresh(email)
+    assert (email.status, email.attempts, email.last_error) == ('sent', 1, None)
+
+
+def test_deliver_all_empties_the_outbox(mail):
+    for n in range(25):
+        add_email('person%d@example.com' % n)
+    assert outbox.deliver_all(limit=10) == (25, 0)
+    assert len(mail) == 25
+    assert outbox.get_status()[0] == {'sent': 25}
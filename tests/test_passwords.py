@@ -0,0 +1,53 @@
+"""Passwords stored with old settings are upgraded the next time their owner logs in (see app/passwords.py)."""
+from werkzeug.security import generate_password_hash
+from app import db
+from app.models import User
+from app.passwords import hasher
+from config import PASSWORD_METHOD, PASSWORD_ITERATIONS, PASSWORD_SALT_LENGTH
+
+
+def stored_hash():
+    return User.query_from_field(username='Student').pwdhash
+
+
+def store_old_hash(password):
+    """Stores the password the way werkzeug used to by default, with SHA-1 and an 8 character salt."""
+    User.query_from_field(username='Student').pwdhash = generate_password_hash(password, method='pbkdf2:sha1')
+    db.session.commit()
+
+
+def log_in(site, password):
+    return site.test_client().post('/login', data=dict(username='student', password=password))
+
+
+def test_old_hash_is_upgraded_on_login(site, sign_up):
+    sign_up('student')
+    with site.app_context():
+        store_old_hash('password')
+        assert stored_hash().startswith('pbkdf2:sha1:')
+        assert hasher.needs_rehash(stored_hash())
+
+    response = log_in(site, 'password')
+    assert response.status_code == 302 and response.location.endswith('/profile')
+
+    with site.app_context():
+        method, salt, _ = stored_hash().split('$')
+        assert method == '{0}:{1}'.format(PASSWORD_METHOD, PASSWORD_ITERATIONS)
+        assert len(salt) == PASSWORD_SALT_LENGTH
+        assert not hasher.needs_rehash(stored_hash())
+        upgraded = stored_hash()
+
+    assert log_in(site, 'password').status_code == 302  # the new hash works
+    with site.app_context():
+        assert stored_hash() == upgraded  # and isn't made again every login
+
+
+def test_wrong_password_leaves_old_hash_alone(site, sign_up):
+    sign_up('student')
+    with site.app_context():
+        store_old_hash('password')
+        old = stored_hash()
+
+    assert log_in(site, 'wrong').status_code == 200  # back to the login form
+    with site.app_context():
+        assert stored_hash() == old
@@ -0,0 +1,109 @@
+"""How many SQL queries pages take.
+
+    Each budget says where its queries go. A page that needs more has a reason to,
+    and the budget should only go up along with a comment saying what the new query is for.
+"""
+import re
+from conftest import query_count
+
+# Every page starts with 1 query: the logged in user, with their calendars and subjects (see models.get_current_user).
+# Building the matching index (matching.MatchingIndex.build) takes 5 more: the data version it was built from,
+# then tutors, calendars, subjects and workloads.
+
+# (description, method, path, form data, most queries allowed)
+TUTOR_ROUTES = [
+    ('tutor free periods', 'GET', '/free-periods', None, 1),  # the form is filled in from the user's calendar
+    ('tutor subjects', 'GET', '/subjects', None, 1),  # and this one from their subjects
+]
+
+STUDENT_ROUTES = [
+    ('homepage', 'GET', '/', None, 1),  # the homepage text comes from a file
+    ('free periods', 'GET', '/free-periods', None, 1),
+    ('request form', 'GET', '/tutor-request', None, 1),
+    # + 1 data version to check the index, 5 to build it for the first time,
+    # 2 to clear out expired shortlists and save this one for other workers (SHORTLIST_IN_DATABASE)
+    ('request', 'POST', '/tutor-request', {'subject_request': 'Algebra 1'}, 9),
+    ('shortlist', 'GET', '/tutor-selection', None, 1),  # this worker still has the shortlist in memory
+    ('availability', 'GET', '/api/availability?subject=Algebra 1', None, 2),  # + 1 data version; the index is already built
+    ('availability unchanged', 'GET', '/api/availability?subject=Algebra 1', 'last etag', 2),  # + 1 data version
+    # + 6 reads: the tutor, their 2 calendars and any sessions already booked then (is_still_available),
+    # then the tutor and their calendar again to book them.
+    # 15 to save it: the pairing, 2 session rows, 2 calendar periods, the workload (read, delete, insert),
+    # 1 data version, 2 to stamp the student and tutor as changed (models.mark_users_changed),
+    # the pending request marked matched, 2 emails and the used shortlist
+    ('booking', 'POST', '/tutor-selection', 'first choice', 22),
+    # + 1 data version, then the booking made it out of date: 1 for who changed since,
+    # and 3 to reload the tutor's calendars, subjects and workload (MatchingIndex.updated)
+    ('availability changed', 'GET', '/api/availability?subject=Algebra 1', 'last etag', 6),
+]
+
+
+def visit(client, routes):
+    """Visits each route the way a person would, returns [(description, queries)]."""
+    results = []
+    choice = None
+    etag = None
+    for (description, method, path, data, budget) in routes:
+        headers = {}
+        if data == 'first choice':
+            data = {'potential_tutors': [choice]}
+        elif data == 'last etag':
+            data = None
+            headers['If-None-Match'] = '"{0}"'.format(etag)
+        response = client.open(path, method=method, data=data, headers=headers)
+        assert response.status_code < 400, description
+        etag = response.headers.get('ETag', '').strip('"') or etag
+        if path == '/tutor-selection' and method == 'GET':
+            choice = re.findall(r'value="([A-Z][0-9AB]+)"', response.data.decode())[0]
+        results.append((description, query_count(response)))
+    return results
+
+
+def over_budget(routes, results):
+    """Returns [(description, queries, budget)] for each route that took more queries than allowed."""
+    return [(description, queries, route[-1]) for (route, (description, queries)) in zip(routes, results)
+            if queries > route[-1]]
+
+
+def book_first_choice(student):
+    """Has the student request Algebra 1 and book the first period offered."""
+    student.post('/tutor-request', data={'subject_request': 'Algebra 1'})
+    choice = re.findall(r'value="([A-Z][0-9AB]+)"', student.get('/tutor-selection').data.decode())[0]
+    student.post('/tutor-selection', data={'potential_tutors': [choice]})
+
+
+def test_profile_is_one_query(sign_up):
+    """The profile's week grid is built from the user loaded before the request (see models.get_current_user),
+        which brings both calendars with it, so the page and base.html's menu need nothing else.
+    """
+    tutor = sign_up('tutor0', tutor=True)
+    student = sign_up('student')
+    book_first_choice(student)
+
+    for client in (student, tutor):
+        response = client.get('/profile')
+        assert response.status_code == 200
+        assert query_count(response) == 1  # the logged in user, with their calendars
+        assert 'background-color: red' in response.data.decode()  # the booked period shows as busy
+
+
+def test_tutor_pages(sign_up):
+    tutor = sign_up('tutor0', tutor=True)
+    assert over_budget(TUTOR_ROUTES, visit(tutor, TUTOR_ROUTES)) == []
+
+
+def test_student_pages(sign_up):
+    """Goes from the homepage through a request and a booking, on a school with 5 tutors."""
+    for n in range(5):
+        sign_up('tutor%d' % n, tutor=True)
+    student = sign_up('student')
+    assert over_budget(STUDENT_ROUTES, visit(student, STUDENT_ROUTES)) == []
+
+
+def test_unchanged_availability_is_not_sent_again(sign_up):
+    """The ETag includes the data version, so asking again with it gets a 304 until something is booked."""
+    sign_up('tutor0', tutor=True)
+    student = sign_up('student')
+    url = '/api/availability?subject=Algebra 1'
+    etag = student.get(url).headers['ETag']
+    assert student.get(url, headers={'If-None-Match': etag}).status_code == 304
@@ -0,0 +1,4 @@
+"""The entry point for WSGI servers. i.e. gunicorn wsgi:application"""
+from app import create_app
+
+application = create_app()